@@ -0,0 +1,824 @@
+"""
+This script benchmarks the pipeline on randomly sampled data. The vectorized
+feature engineering functions are timed against the row-by-row apply
+implementations they replaced on samples from sample_data.py, checking that
+both return identical output, the memory of each stage's output is compared
+between categorical and object columns, and the stage storage formats are
+compared on wall time and peak memory. Every pipeline function is also
+profiled on synthetic MIMIC shaped source files and the profiles are stored
+by code version, so that regressions between versions show up.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from sklearn.linear_model import LinearRegression
+
+import cross_validation
+import feature_engineering as fe
+import importing_and_cleaning_data as ic
+import instrumentation
+import load_generator
+import models
+import sample_data
+import scoring
+import server
+import stage_cache
+import storage
+import synthetic_data
+
+# Pipeline profiles of every run, one JSON object per line
+RESULTS_PATH = 'benchmark_results.jsonl'
+
+# Slowdowns and memory growth beyond this fraction are flagged. Single runs
+# of the fastest functions vary by 10-20%, so smaller changes are noise.
+REGRESSION_THRESHOLD = .25
+
+def time_call(func, *args):
+    """Returns the result of calling func and the wall time in seconds."""
+
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def trace_call(func, *args):
+    """Returns the result of calling func, the wall time in seconds and the
+    peak traced memory allocated during the call in MB.
+    """
+
+    tracemalloc.start()
+    result, secs = time_call(func, *args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, secs, peak / 2**20
+
+# The compressing functions as they were before the rules were moved into
+# fe.COMPRESSION_RULES, kept verbatim so that the registry is checked
+# against the original apply chains rather than against itself
+
+def legacy_compressing_admission_type(data):
+    """Returns the dataframe with addmission type compressed so that emergency
+    and urgent are both marked as urgent.
+    """
+
+    data.admission_type = data.admission_type.apply(lambda x: 'EMERGENCY' if x
+                                                    == 'URGENT' else x)
+    return data
+
+def legacy_compressing_careunit(data):
+    """Returns the dataframe with all ICU subcategories combined into a single
+    'ICU' category.
+    """
+
+    data.first_careunit = data.first_careunit.apply(lambda x: 'ICU' if
+                                                    (x == 'MICU') |
+                                                    (x == 'SICU') |
+                                                    (x == 'CCU') |
+                                                    (x == 'CSRU') |
+                                                    (x == 'TSICU')
+                                                    else x)
+    return data
+
+def legacy_compressing_curr_serv(data):
+    """Returns the dataframe with the survice area compressed to only
+    SURGERY, MED, GYNOCOLOGY/NEWBORN, and OTHER.
+    """
+    data.curr_service = data.curr_service.apply(lambda x: 'SURGERGY' if
+                                                (x == 'CSURG') |
+                                                (x == 'NSURG') |
+                                                (x == 'ORTHO') |
+                                                (x == 'PSURG') |
+                                                (x == 'SURG') |
+                                                (x == 'TSURG') |
+                                                (x == 'VSURG')
+                                                else x)
+
+    data.curr_service = data.curr_service.apply(lambda x: "MED"
+                                                if (x == 'CMED') |
+                                                (x == 'OMED') |
+                                                (x == 'NMED') |
+                                                (x == 'TRAUM')
+                                                else x)
+
+    data.curr_service = data.curr_service.apply(lambda x: "GYNOCOLOGY/NEWBORN"
+                                                if (x == 'NB') |
+                                                (x == 'NBB') |
+                                                (x == 'OBS') |
+                                                (x == 'GYN')
+                                                else x)
+
+    data.curr_service = data.curr_service.apply(lambda x: "OTHER"
+                                                if (x == "GU") |
+                                                (x == "ENT") |
+                                                (x == "DENT") |
+                                                (x == "PSYCH")
+                                                else x)
+
+    return data
+
+def legacy_compressing_ethnicity(data):
+    """Returns the dataframe with ethnicity compressed into only the majority
+    groups, WHITE, ASIAN, HISPANIC/LATINO, BLACK_AFRICAN/OTHER and
+    OTHER/UNKOWN.
+    """
+
+    data.ethnicity = data.ethnicity.apply(lambda x: 'WHITE'
+                                          if ("WHITE" in x) else x)
+
+    data.ethnicity = data.ethnicity.apply(lambda x: "ASIAN"
+                                          if ("ASIAN" in x)  else x)
+
+    data.ethnicity = data.ethnicity.apply(lambda x: "HISPANIC/LATINO"
+                                          if ("LATINA" in x) |
+                                          ("HISPANIC" in x)
+                                          else x)
+
+    data.ethnicity = data.ethnicity.apply(lambda x: "OTHER/UNKNOWN"
+                                          if (x == "AMERICAN INDIAN/ALASKA NATIVE FEDERALLY RECOGNIZED TRIBE") |
+                                          (x == "SOUTH AMERICAN") |
+                                          (x == "CARIBBEAN ISLAND") |
+                                          (x == "NATIVE HAWAIIAN OR OTHER PACIFIC ISLANDER") |
+                                          (x == "AMERICAN INDIAN/ALASKA NATIVE") |
+                                          (x == "MIDDLE EASTERN") |
+                                          (x == "PORTUGUESE") |
+                                          (x == "MULTI RACE ETHNICITY") |
+                                          (x == "PATIENT DECLINED TO ANSWER") |
+                                          (x == "OTHER") |
+                                          ("UNKNOWN" in x) |
+                                          ("OBTAIN" in x)
+                                          else x)
+
+    data.ethnicity = data.ethnicity.apply(lambda x: "BLACK_AFRICAN/OTHER"
+                                          if ("BLACK" in x) else x)
+
+    return data
+
+def legacy_compressing_marital_status(data):
+    """Returns the dataframe with marital status compressed to only
+    LIFE_PARTNER, SINGLE, OTHER/UNKOWN.
+    """
+
+    data.marital_status = data.marital_status.apply(lambda x: 'LIFE_PARTNER'
+                                                    if (x == 'MARRIED') |
+                                                    (x == 'LIFE PARTNER')
+                                                    else x)
+
+    data.marital_status = data.marital_status.apply(lambda x: 'SINGLE'
+                                                    if (x == 'WIDOWED') |
+                                                    (x == 'DIVORCED') |
+                                                    (x == 'SEPARATED')
+                                                    else x)
+
+    data.marital_status = data.marital_status.apply(lambda x: 'OTHER/UNKNOWN'
+                                                    if (x == 'UNKNOWN (DEFAULT)')
+                                                    else x)
+
+    return data
+
+def legacy_compressing_religion(data):
+    """Returns the dataframe with relgion compressed to either RELIGIOUS or
+    NOT RELIGOUS.
+    """
+
+    data.religion = data.religion.apply(lambda x: 'RELIGIOUS'
+                                        if (x == "LUTHERAN") |
+                                        (x == "METHODIST") |
+                                        (x == "HEBREW") |
+                                        (x == "BAPTIST") |
+                                        (x == "HINDU") |
+                                        (x == "UNITARIAN-UNIVERSALIST") |
+                                        (x == "ROMANIAN EAST. ORTH") |
+                                        (x == "7TH DAY ADVENTIST") |
+                                        (x == "JEHOVAH'S WITNESS") |
+                                        (x == 'MUSLIM') |
+                                        (x == 'BUDDHIST') |
+                                        (x == 'CHRISTIAN SCIENTIST') |
+                                        (x == 'GREEK ORTHODOX') |
+                                        (x == 'EPISCOPALIAN') |
+                                        (x == 'OTHER') |
+                                        (x == 'JEWISH') |
+                                        (x == 'CATHOLIC') |
+                                        (x == 'PROTESTANT QUAKER')
+                                        else x)
+
+    return data
+
+def legacy_compressing_admit_location(data):
+    """Returns the dataframe with admit location compressed to only ER_ADMIT,
+    REFERRAL, TRANSFER, and OTHER/UNKNOWN.
+    """
+
+    data.admission_location = data.admission_location.apply(lambda x: 'ER_ADMIT'
+                                                            if (x == 'EMERGENCY ROOM ADMIT ')
+                                                            else x)
+
+    data.admission_location = data.admission_location.apply(lambda x: 'REFERRAL'
+                                                            if (x == 'HMO REFERRAL/SICK') |
+                                                            (x == 'PHYS REFERRAL/NORMAL DELI') |
+                                                            (x == 'CLINIC REFERRAL/PREMATURE')
+                                                            else x)
+
+    data.admission_location = data.admission_location.apply(lambda x: 'TRANSFER'
+                                                            if (x == 'TRANSFER FROM HOSP/EXTRAM') |
+                                                            (x == 'TRANSFER FROM SKILLED NUR') |
+                                                            (x == 'TRANSFER FROM OTHER HEALT') |
+                                                            (x == 'TRSF WITHIN THIS FACILITY')
+                                                            else x)
+
+    data.admission_location = data.admission_location.apply(lambda x: 'OTHER/UNKNOWN'
+                                                            if (x == '** INFO NOT AVAILABLE **')
+                                                            else x)
+
+    return data
+
+# Each compressed column's compressing function and the legacy apply chain
+# it replaced
+COMPRESSING_FUNCTIONS = {
+    'admission_type': (fe.compressing_admission_type,
+                       legacy_compressing_admission_type),
+    'first_careunit': (fe.compressing_careunit, legacy_compressing_careunit),
+    'curr_service': (fe.compressing_curr_serv, legacy_compressing_curr_serv),
+    'ethnicity': (fe.compressing_ethnicity, legacy_compressing_ethnicity),
+    'marital_status': (fe.compressing_marital_status,
+                       legacy_compressing_marital_status),
+    'religion': (fe.compressing_religion, legacy_compressing_religion),
+    'admission_location': (fe.compressing_admit_location,
+                           legacy_compressing_admit_location),
+}
+
+def legacy_icd9_descriptions(row):
+    """Returns the diagnoses category for a single row, as the row-wise
+    icd9_descriptions did before the ICD9 codes were binned.
+    """
+
+    if 1 <= row['icd9_code'] <= 139:
+        val = 'Parasitic_Disease'
+    elif 140 <= row['icd9_code'] <= 239:
+        val = 'Neoplasm'
+    elif 240 <= row['icd9_code'] <= 279:
+        val = 'Endocrine'
+    elif 280 <= row['icd9_code'] <= 289:
+        val = "Blood"
+    elif 290 <= row['icd9_code'] <= 319:
+        val = "Mental_Disorder"
+    elif 320 <= row['icd9_code'] <= 389:
+        val = "Nervous_System"
+    elif 390 <= row['icd9_code'] <= 459:
+        val = "Circulatory_System"
+    elif 460 <= row['icd9_code'] <= 519:
+        val = "Respiratory_System"
+    elif 520 <= row['icd9_code'] <= 579:
+        val = "Digestive_System"
+    elif 580 <= row['icd9_code'] <= 629:
+        val = "Genitourinary_System"
+    elif 630 <= row['icd9_code'] <= 679:
+        val = "Pregnancy"
+    elif 680 <= row['icd9_code'] <= 709:
+        val = "Skin"
+    elif 710 <= row['icd9_code'] <= 739:
+        val = "Musculoskeletal"
+    elif 740 <= row['icd9_code'] <= 759:
+        val = "Congenital_Anomalies"
+    elif 760 <= row['icd9_code'] <= 779:
+        val = "Perinatal"
+    elif 780 <= row['icd9_code'] <= 799:
+        val = "Ill-Defined"
+    elif 800 <= row['icd9_code'] <= 999:
+        val = "Injury/Poison"
+    elif row['icd9_code'] < .4:
+        val = "Supplemental_factors"
+    elif .4 <= row['icd9_code'] < .7:
+        val = "External_Cause_Inj_Poison"
+    elif .7 <= row['icd9_code'] < .9:
+        val = "Morphology_of_Neoplasms"
+    else:
+        val = row['icd9_code']
+
+    return val
+
+def legacy_compress_icd9_codes(data):
+    """Returns the dataframe with diagnoses assigned by string apply passes
+    and a row-wise icd9_descriptions call.
+    """
+
+    data.icd9_code = data.icd9_code.apply(lambda x: '.1' if 'V' in x else x)
+    data.icd9_code = data.icd9_code.apply(lambda x: '.8' if 'M' in x else x)
+    data.icd9_code = data.icd9_code.apply(lambda x: '.5' if 'E' in x else x)
+    data.icd9_code = data.icd9_code.apply(lambda x: x[:3] if ('E' not in x) &
+                                          ('M' not in x) &
+                                          ('V' not in x)
+                                          else x)
+    data.icd9_code = data.icd9_code.astype(float)
+
+    data['diagnoses'] = data.apply(legacy_icd9_descriptions, axis=1)
+    return data.drop(columns=['icd9_code'])
+
+def imported_tables(tables):
+    """Returns copies of the source tables with the compact dtypes that
+    read_source imports them with.
+    """
+
+    imported = []
+    for table in tables:
+        imported.append(table.astype({col: ic.read_dtype(col)
+                                      for col in table.columns
+                                      if ic.read_dtype(col) == 'category'}))
+    return imported
+
+def object_dtypes(data):
+    """Returns the dataframe with its categorical columns as object columns,
+    the dtypes the stages produced before categories were carried through.
+    """
+
+    return data.astype({col: object for col in
+                        data.select_dtypes(include=['category']).columns})
+
+def legacy_merging_data(dataframes_list):
+    """Returns the source tables combined with chained outer joins, as
+    merging_data did before the tables were pre-aggregated.
+    """
+
+    adm, pat, diag, serv, icu = dataframes_list
+
+    raw_data = adm.merge(pat, how='outer', on='subject_id')
+    raw_data = raw_data.merge(diag, how='outer', on=['subject_id', 'hadm_id'])
+    raw_data = raw_data.merge(serv, how='outer', on=['subject_id', 'hadm_id'])
+    raw_data = raw_data.merge(icu, how='outer', on=['subject_id', 'hadm_id'])
+
+    return raw_data[ic.KEEPING_COLS]
+
+def legacy_first_visits(data):
+    """Returns the rows kept by the groupby and merge first visit selection
+    data_cleaning used before it selected first visits with a sorted mask.
+    """
+
+    data = data.loc[data.deathtime.isna(), data.columns.drop('deathtime')]
+    first_vis_grp = data.groupby(['subject_id', 'hadm_id'])['admittime'] \
+                    .agg(['first']).reset_index()
+    first_vis = first_vis_grp.merge(data, how='left',
+                                    on=('subject_id', 'hadm_id'))
+    return first_vis.drop(['first'], axis=1)
+
+def sorted_first_visits(data):
+    """Returns the rows kept by the sorted first visit mask."""
+
+    first_visit = ic.first_visit_mask(data, data.deathtime.isna().to_numpy())
+    return data.loc[first_visit, data.columns.drop('deathtime')]
+
+def model_matrix(merged_data):
+    """Returns the per admission model matrix for a merged dataframe, with
+    columns in sorted order.
+    """
+
+    cleaned = ic.data_cleaning(merged_data)
+    matrix = models.dummy_cat_cols(fe.feature_engineering(cleaned))
+    return matrix[sorted(matrix.columns)].astype(float)
+
+def stage_handoffs(fmt, directory):
+    """Runs the pipeline from the cleaned raw data through the stage files of
+    one format to a fitted model: the raw stage is saved and reloaded, feature
+    engineered, saved and reloaded again, then encoded and fit. Returns the
+    end to end and feature engineering stage wall times and the peak RSS
+    growth in MB of this process, measured from a reset baseline.
+    """
+
+    raw_data = pd.read_pickle(os.path.join(directory, 'raw_data.pkl'))
+    instrumentation.reset_peak_rss()
+    baseline_mb = instrumentation.peak_rss_mb()
+    start = time.perf_counter()
+
+    storage.save_stage(raw_data, 'raw_hospital_data', fmt, directory)
+    del raw_data
+    stage_start = time.perf_counter()
+    raw_data = storage.load_stage('raw_hospital_data', fmt=fmt,
+                                  directory=directory)
+
+    fe_data = fe.feature_engineering(raw_data)
+    del raw_data
+
+    storage.save_stage(fe_data, 'feature_engineering_data', fmt, directory)
+    del fe_data
+    fe_data = storage.load_stage('feature_engineering_data', fmt=fmt,
+                                 directory=directory)
+    stage_secs = time.perf_counter() - stage_start
+
+    X, y, _, _ = models.encode(fe_data)
+    LinearRegression().fit(X, y)
+
+    return (time.perf_counter() - start, stage_secs,
+            instrumentation.peak_rss_mb() - baseline_mb)
+
+def bench_compression(n_rows=1_000_000):
+    """Prints apply and vectorized timings for each compressing function."""
+
+    data = sample_data.sample_categorical_data(n_rows)
+    print(f'\nCompression benchmark ({n_rows:,} rows)')
+
+    for column, (func, legacy) in COMPRESSING_FUNCTIONS.items():
+        expected, apply_secs = time_call(legacy, data[[column]].copy())
+        result, vector_secs = time_call(func, data[[column]].copy())
+
+        assert result[column].tolist() == expected[column].tolist(), column
+        print(f'{column:>20}: apply {apply_secs:.3f}s, vectorized '
+              f'{vector_secs:.3f}s ({apply_secs / vector_secs:.0f}x)')
+
+def bench_icd9(n_rows=500_000):
+    """Prints row-wise and binned timings for compress_icd9_codes."""
+
+    data = sample_data.sample_icd9_codes(n_rows).to_frame()
+    print(f'\nICD9 benchmark ({n_rows:,} rows)')
+
+    expected, apply_secs = time_call(legacy_compress_icd9_codes, data.copy())
+    result, vector_secs = time_call(fe.compress_icd9_codes, data.copy())
+
+    assert result.diagnoses.tolist() == expected.diagnoses.tolist()
+    print(f'{"icd9_code":>20}: apply {apply_secs:.3f}s, vectorized '
+          f'{vector_secs:.3f}s ({apply_secs / vector_secs:.0f}x)')
+
+def bench_merging(n_admissions=50_000):
+    """Prints timings and merged row counts for the outer join chain and the
+    pre-aggregated join, checking both give the same model matrix.
+    """
+
+    tables = sample_data.sample_source_tables(n_admissions)
+    print(f'\nMerging benchmark ({n_admissions:,} admissions)')
+
+    expected, outer_secs = time_call(legacy_merging_data, tables)
+    result, planned_secs = time_call(ic.merging_data, tables)
+
+    pd.testing.assert_frame_equal(model_matrix(result),
+                                  model_matrix(expected))
+    print(f'{"outer joins":>20}: {outer_secs:.3f}s, {len(expected):,} rows')
+    print(f'{"pre-aggregated":>20}: {planned_secs:.3f}s, {len(result):,} rows')
+
+def bench_first_visit(n_diagnoses=synthetic_data.N_DIAGNOSES):
+    """Prints the time and peak traced memory of first visit selection with
+    the groupby and merge and with the sorted mask on synthetic data joined
+    with every visit kept, as merging_data now selects first visits before
+    joining, checking that the mask keeps only each patient's earliest
+    admission.
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic_data.generate(directory, n_diagnoses)
+        tables = ic.importing(ic.SOURCE_FILES, directory=directory)
+    data = legacy_merging_data(tables)
+    print(f'\nFirst visit benchmark ({len(data):,} merged rows)')
+
+    expected, legacy_secs, legacy_mb = trace_call(legacy_first_visits, data)
+    result, sorted_secs, sorted_mb = trace_call(sorted_first_visits, data)
+
+    earliest = data[data.deathtime.isna()] \
+                   .sort_values(['admittime', 'hadm_id']) \
+                   .drop_duplicates('subject_id').hadm_id
+    assert set(result.hadm_id) == set(earliest)
+    assert result.groupby('subject_id').hadm_id.nunique().max() == 1
+
+    for name, kept, secs, peak_mb in [
+            ('groupby and merge', expected, legacy_secs, legacy_mb),
+            ('sorted mask', result, sorted_secs, sorted_mb)]:
+        _, fe_secs, fe_mb = trace_call(fe.feature_engineering, kept.copy())
+        print(f'{name:>20}: {secs:.3f}s, peak {peak_mb:.1f} MB, '
+              f'{len(kept):,} rows of {kept.hadm_id.nunique():,} admissions '
+              f'kept, feature engineering {fe_secs:.3f}s, peak {fe_mb:.1f} MB')
+
+def bench_design_matrix(n_admissions=50_000):
+    """Prints encoding plus fit timings and matrix sizes for the dense
+    get_dummies path and the sparse design matrix, checking both encode the
+    same features.
+    """
+
+    tables = sample_data.sample_source_tables(n_admissions)
+    data = fe.feature_engineering(ic.data_cleaning(ic.merging_data(tables)))
+    print(f'\nDesign matrix benchmark ({len(data):,} rows)')
+
+    def dense_fit(data):
+        dummied = models.dummy_cat_cols(data.copy())
+        X, y = dummied.drop(columns='los'), dummied.los
+        return X, LinearRegression().fit(X, y)
+
+    def sparse_fit(data):
+        vocabulary = models.fit_vocabulary(data)
+        X, y = models.sparse_design_matrix(data, vocabulary)
+        return X, LinearRegression().fit(X, y)
+
+    (dense_X, _), dense_secs, dense_mb = trace_call(dense_fit, data)
+    (sparse_X, _), sparse_secs, sparse_mb = trace_call(sparse_fit, data)
+
+    names = models.feature_names(data, models.fit_vocabulary(data))
+    assert np.array_equal(dense_X[names].to_numpy(float), sparse_X.toarray())
+
+    print(f'{"dense":>20}: {dense_secs:.3f}s, peak {dense_mb:.1f} MB')
+    print(f'{"sparse":>20}: {sparse_secs:.3f}s, peak {sparse_mb:.1f} MB')
+
+def bench_dtypes(n_admissions=100_000):
+    """Prints the memory of each stage's output with categorical columns and
+    with the same columns as object strings.
+    """
+
+    tables = imported_tables(sample_data.sample_source_tables(n_admissions))
+    print(f'\nStage memory benchmark ({n_admissions:,} admissions)')
+
+    stages = [ic.merging_data, ic.data_cleaning, fe.new_features,
+              fe.compressing_admission_type, fe.age_to_cat,
+              fe.compressing_careunit, fe.compressing_curr_serv,
+              fe.compressing_ethnicity, fe.compressing_marital_status,
+              fe.compressing_religion, fe.compressing_admit_location,
+              fe.compress_icd9_codes]
+
+    data = tables
+    for func in stages:
+        data, secs, peak_mb = trace_call(func, data)
+        object_mb = object_dtypes(data).memory_usage(deep=True).sum() / 2**20
+        compact_mb = data.memory_usage(deep=True).sum() / 2**20
+        print(f'{func.__name__:>26}: object {object_mb:.1f} MB, categorical '
+              f'{compact_mb:.1f} MB ({1 - compact_mb / object_mb:.0%} less), '
+              f'{secs:.3f}s, peak {peak_mb:.1f} MB')
+
+def bench_partitioned(n_rows=4_000_000, n_jobs=(1, 2, 4, 8)):
+    """Prints feature engineering wall time on one process and partitioned
+    by subject across n_jobs processes, checking every run gives the same
+    output.
+    """
+
+    raw_data = storage.compact_dtypes(sample_data.sample_raw_data(n_rows))
+    print(f'\nPartitioned feature engineering benchmark ({n_rows:,} rows, '
+          f'{os.cpu_count()} cores)')
+
+    expected, serial_secs = time_call(fe.feature_engineering, raw_data.copy())
+    print(f'{"serial":>20}: {serial_secs:.3f}s')
+
+    for jobs in n_jobs:
+        result, secs = time_call(fe.partitioned_feature_engineering,
+                                 raw_data, jobs)
+        assert result.equals(expected)
+        print(f'{f"{jobs} processes":>20}: {secs:.3f}s '
+              f'({serial_secs / secs:.1f}x)')
+
+def fit_scorer(tables):
+    """Returns a scorer for a linear model fit on the source tables through
+    the pipeline, with the model, design matrix and admission ids.
+    """
+
+    data = fe.feature_engineering(ic.data_cleaning(ic.merging_data(tables)))
+    vocabulary = models.fit_vocabulary(data)
+    X, y = models.sparse_design_matrix(data, vocabulary)
+    lm = LinearRegression().fit(X, y)
+
+    scorer = scoring.LOSScorer(scoring.make_bundle(
+        lm, vocabulary, models.numeric_feature_cols(data)))
+    return scorer, lm, X, np.unique(data.hadm_id)
+
+def bench_scoring(n_admissions=50_000):
+    """Prints batch scoring throughput for predict_los, checking it matches
+    the fitted model's predictions on the pipeline design matrix.
+    """
+
+    tables = sample_data.sample_source_tables(n_admissions)
+    scorer, lm, X, hadm_ids = fit_scorer(tables)
+    records = sample_data.sample_records(tables)
+    print(f'\nScoring benchmark ({len(records):,} admissions)')
+
+    scorer.predict(records[:1000])
+    predictions, secs = time_call(scorer.predict, records)
+
+    fitted = pd.Series(lm.predict(X), index=hadm_ids)
+    scored = pd.Series(predictions, index=[r['hadm_id'] for r in records])
+    assert np.allclose(scored[fitted.index], fitted)
+
+    print(f'{"predict_los":>20}: {secs:.3f}s, '
+          f'{len(records) / secs:,.0f} admissions/s')
+
+def bench_server(n_admissions=20_000, concurrency=64, n_requests=10_000):
+    """Prints client and server side latency and throughput for single
+    admission requests to a local scoring server.
+    """
+
+    tables = sample_data.sample_source_tables(n_admissions)
+    scorer = fit_scorer(tables)[0]
+    records = sample_data.sample_records(tables)
+    print(f'\nServer benchmark ({n_requests:,} requests, {concurrency} '
+          'clients)')
+
+    async def run():
+        scoring_server = server.ScoringServer(scorer)
+        listener = await scoring_server.start(port=0)
+        port = listener.sockets[0].getsockname()[1]
+
+        client = await load_generator.generate_load(
+            records, port=port, concurrency=concurrency,
+            n_requests=n_requests)
+        listener.close()
+        return client, scoring_server.stats.summary()
+
+    client, served = asyncio.run(run())
+    for name, stats in [('client', client), ('server', served)]:
+        print(f'{name:>20}: p50 {stats["p50_ms"]:.2f} ms, p99 '
+              f'{stats["p99_ms"]:.2f} ms, {stats["requests_per_s"]:,.0f} '
+              'requests/s')
+    print(f'{"batches":>20}: {served["batches"]:,}, mean size '
+          f'{served["mean_batch_size"]:.1f}')
+
+def bench_cross_validation(n_admissions=50_000, alphas=(.1, 10)):
+    """Prints cross validation wall time on one process and on one process
+    per core, checking both give the same scores.
+    """
+
+    tables = sample_data.sample_source_tables(n_admissions)
+    data = fe.feature_engineering(ic.data_cleaning(ic.merging_data(tables)))
+    X, y = models.sparse_design_matrix(data, models.fit_vocabulary(data))
+    candidates = cross_validation.candidate_models(alphas)
+    print(f'\nCross validation benchmark ({X.shape[0]:,} admissions, '
+          f'{len(candidates)} models x {cross_validation.N_FOLDS} folds)')
+
+    serial, serial_secs = time_call(cross_validation.cross_validate, X, y,
+                                    candidates, cross_validation.N_FOLDS, 1)
+    pooled, pooled_secs = time_call(cross_validation.cross_validate, X, y,
+                                    candidates)
+
+    cols = ['r2', 'rmse', 'mae']
+    assert np.allclose(serial[cols], pooled[cols])
+    print(f'{"1 process":>20}: {serial_secs:.3f}s')
+    print(f'{f"{os.cpu_count()} processes":>20}: {pooled_secs:.3f}s')
+
+def bench_storage(n_rows=2_000_000, formats=('csv', 'parquet', 'feather')):
+    """Prints end to end wall time from the cleaned raw data to a fitted
+    model, feature engineering stage wall time, peak RSS growth and file
+    sizes for each stage format. Each format runs in a fresh process, which
+    measures its peak RSS from a reset baseline.
+    """
+
+    raw_data = sample_data.sample_raw_data(n_rows)
+    print(f'\nStage storage benchmark ({n_rows:,} rows)')
+
+    with tempfile.TemporaryDirectory() as directory:
+        raw_data.to_pickle(os.path.join(directory, 'raw_data.pkl'))
+        del raw_data
+        context = multiprocessing.get_context('spawn')
+
+        for fmt in formats:
+            with context.Pool(1) as pool:
+                total_secs, stage_secs, peak_mb = pool.apply(
+                    stage_handoffs, (fmt, directory))
+
+            size_mb = sum(os.path.getsize(storage.stage_path(name, fmt,
+                                                             directory))
+                          for name in ['raw_hospital_data',
+                                       'feature_engineering_data']) / 2**20
+            print(f'{fmt:>20}: end to end {total_secs:.2f}s, feature '
+                  f'engineering stage {stage_secs:.2f}s, peak RSS '
+                  f'+{peak_mb:.0f} MB, files {size_mb:.0f} MB')
+
+def code_version():
+    """Returns the short git commit of the working tree, marked dirty when
+    there are uncommitted changes.
+    """
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain',
+                                '--untracked-files=no'],
+                               capture_output=True, text=True,
+                               check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+    return f'{commit}-dirty' if dirty else commit
+
+def profile_pipeline(n_diagnoses=synthetic_data.N_DIAGNOSES,
+                     seed=synthetic_data.SEED):
+    """Returns the wall time, peak traced memory and row counts of every
+    pipeline function, run in order on synthetic source files with about
+    n_diagnoses diagnoses rows.
+    """
+
+    profile = []
+
+    def run(name, func, *args):
+        result, secs, peak_mb = trace_call(func, *args)
+        profile.append({'function': name, 'secs': secs, 'peak_mb': peak_mb,
+                        'rows_in': instrumentation.n_rows(args[0]),
+                        'rows_out': instrumentation.n_rows(result)})
+        return result
+
+    # Cached stage outputs would be timed as cache hits
+    directory = stage_cache._settings['directory']
+    stage_cache.disable()
+
+    try:
+        with tempfile.TemporaryDirectory() as source_dir:
+            synthetic_data.generate(source_dir, n_diagnoses, seed)
+            tables = [run(f'read_source:{file}', ic.read_source, file,
+                          ic.CHUNK_SIZE, source_dir)
+                      for file in ic.SOURCE_FILES]
+
+        data = run('merging_data', ic.merging_data, tables)
+        data = run('data_cleaning', ic.data_cleaning, data)
+        data = run('new_features', fe.new_features, data)
+        for func in [fe.compressing_admission_type, fe.age_to_cat,
+                     fe.compressing_careunit, fe.compressing_curr_serv,
+                     fe.compressing_ethnicity, fe.compressing_marital_status,
+                     fe.compressing_religion, fe.compressing_admit_location,
+                     fe.compress_icd9_codes]:
+            data = run(func.__name__, func, data)
+
+        vocabulary = models.fit_vocabulary(data)
+        X, y = run('sparse_design_matrix', models.sparse_design_matrix, data,
+                   vocabulary)
+        run('fit', LinearRegression().fit, X, y)
+    finally:
+        if directory is not None:
+            stage_cache.enable(directory, stage_cache._settings['max_bytes'])
+
+    return profile
+
+def load_results(path=RESULTS_PATH):
+    """Returns every stored pipeline profile run, oldest first."""
+
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def compare_profiles(current, previous):
+    """Returns a dataframe of each function's time and peak memory in two
+    profiles, with the relative change and whether it is a regression.
+    """
+
+    columns = ['secs', 'peak_mb']
+    joined = pd.DataFrame(current).set_index('function')[columns].join(
+        pd.DataFrame(previous).set_index('function')[columns],
+        rsuffix='_previous')
+
+    for col in columns:
+        joined[f'{col}_change'] = joined[col] / joined[f'{col}_previous'] - 1
+    joined['regression'] = (joined[[f'{col}_change' for col in columns]] >
+                            REGRESSION_THRESHOLD).any(axis=1)
+    return joined
+
+def bench_pipeline(n_diagnoses=synthetic_data.N_DIAGNOSES,
+                   path=RESULTS_PATH):
+    """Profiles every pipeline function on synthetic data, stores the
+    profile with the code version and prints it against the latest stored
+    profile of a different version at the same scale.
+    """
+
+    print(f'\nPipeline profile ({n_diagnoses:,} diagnoses rows)')
+    run = {'version': code_version(),
+           'timestamp': datetime.now().isoformat(timespec='seconds'),
+           'n_diagnoses': n_diagnoses,
+           'profile': profile_pipeline(n_diagnoses)}
+
+    previous = [stored for stored in load_results(path)
+                if stored['n_diagnoses'] == n_diagnoses and
+                stored['version'] != run['version']]
+
+    with open(path, 'a') as file:
+        file.write(json.dumps(run) + '\n')
+
+    if not previous:
+        for stage in run['profile']:
+            print(f'{stage["function"]:>30}: {stage["secs"]:.3f}s, peak '
+                  f'{stage["peak_mb"]:.1f} MB, {stage["rows_in"]} -> '
+                  f'{stage["rows_out"]} rows')
+        return
+
+    print(f'{"":>30}  compared with {previous[-1]["version"]}')
+    comparison = compare_profiles(run['profile'], previous[-1]['profile'])
+    for function, stage in comparison.iterrows():
+        flag = '  REGRESSION' if stage.regression else ''
+        print(f'{function:>30}: {stage.secs:.3f}s ({stage.secs_change:+.0%}), '
+              f'peak {stage.peak_mb:.1f} MB ({stage.peak_mb_change:+.0%})'
+              f'{flag}')
+
+def main():
+    """Runs every benchmark."""
+
+    bench_compression()
+    bench_icd9()
+    bench_merging()
+    bench_first_visit()
+    bench_dtypes()
+    bench_partitioned()
+    bench_design_matrix()
+    bench_scoring()
+    bench_server()
+    bench_cross_validation()
+    bench_storage()
+    bench_pipeline()
+
+if __name__ == '__main__':
+    main()
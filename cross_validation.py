@@ -0,0 +1,175 @@
+"""
+This script cross validates the length of stay regression and sweeps the
+regularization strength of ridge and lasso alternatives. Folds and
+candidate models run across a process pool. The sparse design matrix is
+placed in shared memory once and every worker reads it from there, so it is
+never pickled per task. Per fold R^2, RMSE, MAE and fit times are returned.
+"""
+
+import time
+from contextlib import contextmanager
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+from sklearn.linear_model import Lasso, LinearRegression, Ridge
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from sklearn.model_selection import KFold
+
+import models
+import storage
+
+N_FOLDS = 10
+ALPHAS = [.01, .1, 1, 10, 100]
+RANDOM_STATE = 10
+
+ESTIMATORS = {
+    'linear': LinearRegression,
+    'ridge': Ridge,
+    'lasso': Lasso,
+}
+
+# Design matrix arrays attached from shared memory in each worker
+_shared = {}
+
+def candidate_models(alphas=ALPHAS):
+    """Returns (estimator, alpha) pairs for plain linear regression and for
+    ridge and lasso at each alpha.
+    """
+
+    candidates = [('linear', None)]
+    for name in ['ridge', 'lasso']:
+        candidates.extend((name, alpha) for alpha in alphas)
+    return candidates
+
+def make_estimator(name, alpha):
+    """Returns an unfitted estimator for a candidate model."""
+
+    if alpha is None:
+        return ESTIMATORS[name]()
+    return ESTIMATORS[name](alpha=alpha)
+
+def share_arrays(arrays):
+    """Copies each named array into a new shared memory block. Returns the
+    blocks, which the caller must close and unlink, and the spec workers use
+    to attach to them. shared_pool does both.
+    """
+
+    blocks, spec = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        spec[name] = (block.name, array.shape, array.dtype.str)
+
+    return blocks, spec
+
+def attach(spec, shape):
+    """Pool initializer that maps the shared design matrix into a worker."""
+
+    for name, (block_name, array_shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared[name + '_block'] = block
+        _shared[name] = np.ndarray(array_shape, dtype, buffer=block.buf)
+
+    _shared['X'] = sparse.csr_matrix((_shared['data'], _shared['indices'],
+                                      _shared['indptr']), shape=shape,
+                                     copy=False)
+
+@contextmanager
+def shared_pool(arrays, shape, processes=None):
+    """Context manager that places the named arrays, which include the data,
+    indices and indptr of a CSR design matrix of the given shape, in shared
+    memory and yields a pool of processes attached to them. The shared
+    memory is released on exit.
+    """
+
+    blocks, spec = share_arrays(arrays)
+    try:
+        with Pool(processes, initializer=attach,
+                  initargs=(spec, shape)) as pool:
+            yield pool
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+def shared(name):
+    """Returns an array attached by attach in this worker, or the design
+    matrix X built from them.
+    """
+
+    return _shared[name]
+
+def _run_fold(task):
+    """Fits one candidate model on one fold and returns its scores."""
+
+    name, alpha, fold, n_folds, random_state = task
+    X, y = _shared['X'], _shared['y']
+
+    splits = KFold(n_folds, shuffle=True, random_state=random_state)
+    train, test = list(splits.split(np.arange(X.shape[0])))[fold]
+
+    estimator = make_estimator(name, alpha)
+    start = time.perf_counter()
+    estimator.fit(X[train], y[train])
+    fit_secs = time.perf_counter() - start
+    predicted = estimator.predict(X[test])
+
+    return {
+        'estimator': name,
+        'alpha': alpha,
+        'fold': fold,
+        'r2': r2_score(y[test], predicted),
+        'rmse': np.sqrt(mean_squared_error(y[test], predicted)),
+        'mae': mean_absolute_error(y[test], predicted),
+        'fit_secs': fit_secs,
+        'total_secs': time.perf_counter() - start,
+    }
+
+def cross_validate(X, y, candidates=None, n_folds=N_FOLDS, n_jobs=None,
+                   random_state=RANDOM_STATE):
+    """Returns a dataframe with the R^2, RMSE, MAE and timings of every fold
+    of every candidate model. Tasks run on n_jobs processes, defaulting to
+    one per core.
+    """
+
+    candidates = candidates or candidate_models()
+    X = sparse.csr_matrix(X)
+    arrays = {'data': X.data, 'indices': X.indices, 'indptr': X.indptr,
+              'y': np.asarray(y, dtype=float)}
+
+    tasks = [(name, alpha, fold, n_folds, random_state)
+             for name, alpha in candidates for fold in range(n_folds)]
+
+    with shared_pool(arrays, X.shape, n_jobs) as pool:
+        results = pool.map(_run_fold, tasks)
+
+    return pd.DataFrame(results)
+
+def summarize(results):
+    """Returns the mean scores and fit time of each candidate model across
+    folds, best out of sample RMSE first.
+    """
+
+    summary = results.fillna({'alpha': 0}) \
+                     .groupby(['estimator', 'alpha'])[['r2', 'rmse', 'mae',
+                                                       'fit_secs']].mean()
+    return summary.sort_values('rmse').reset_index()
+
+def main(fmt=storage.DEFAULT_FORMAT):
+    """Loads the feature engineered hospital data and prints the cross
+    validated scores of each candidate model.
+    """
+
+    hospital_data = storage.load_stage('feature_engineering_data', fmt=fmt)
+    vocabulary = models.fit_vocabulary(hospital_data)
+    X, y = models.sparse_design_matrix(hospital_data, vocabulary)
+
+    print(summarize(cross_validate(X, y)).to_string(index=False))
+
+if __name__ == '__main__':
+    main()
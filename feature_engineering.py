@@ -18,305 +18,333 @@ Compressed features:
   -- ICD9 Codes
 """
 
+import os
+from functools import reduce
+from multiprocessing import Pool
+
+import numpy as np
 import pandas as pd
 
+import instrumentation
+import stage_cache
+import storage
+
+# Age group edges in whole years. Bins are closed on the right, so the groups
+# are 0-3, 4-18, 19-40, 41-60 and 61-100.
+AGE_BINS = [-1, 3, 18, 40, 60, 100]
+AGE_LABELS = ['Baby', 'Child/Teen', 'Young_Aduld', 'Adult', 'Senior']
+
+# Compression rules for each categorical column. Rules are applied in order,
+# matching the original chain of apply calls: a value is replaced by the
+# rule's 'value' when it equals one of 'equals' or contains one of 'contains'.
+COMPRESSION_RULES = {
+    'admission_type': [
+        {'value': 'EMERGENCY', 'equals': ['URGENT']},
+    ],
+    'first_careunit': [
+        {'value': 'ICU', 'equals': ['MICU', 'SICU', 'CCU', 'CSRU', 'TSICU']},
+    ],
+    'curr_service': [
+        {'value': 'SURGERGY', 'equals': ['CSURG', 'NSURG', 'ORTHO', 'PSURG',
+                                         'SURG', 'TSURG', 'VSURG']},
+        {'value': 'MED', 'equals': ['CMED', 'OMED', 'NMED', 'TRAUM']},
+        {'value': 'GYNOCOLOGY/NEWBORN', 'equals': ['NB', 'NBB', 'OBS', 'GYN']},
+        {'value': 'OTHER', 'equals': ['GU', 'ENT', 'DENT', 'PSYCH']},
+    ],
+    'ethnicity': [
+        {'value': 'WHITE', 'contains': ['WHITE']},
+        {'value': 'ASIAN', 'contains': ['ASIAN']},
+        {'value': 'HISPANIC/LATINO', 'contains': ['LATINA', 'HISPANIC']},
+        {'value': 'OTHER/UNKNOWN',
+         'equals': ['AMERICAN INDIAN/ALASKA NATIVE FEDERALLY RECOGNIZED TRIBE',
+                    'SOUTH AMERICAN',
+                    'CARIBBEAN ISLAND',
+                    'NATIVE HAWAIIAN OR OTHER PACIFIC ISLANDER',
+                    'AMERICAN INDIAN/ALASKA NATIVE',
+                    'MIDDLE EASTERN',
+                    'PORTUGUESE',
+                    'MULTI RACE ETHNICITY',
+                    'PATIENT DECLINED TO ANSWER',
+                    'OTHER'],
+         'contains': ['UNKNOWN', 'OBTAIN']},
+        {'value': 'BLACK_AFRICAN/OTHER', 'contains': ['BLACK']},
+    ],
+    'marital_status': [
+        {'value': 'LIFE_PARTNER', 'equals': ['MARRIED', 'LIFE PARTNER']},
+        {'value': 'SINGLE', 'equals': ['WIDOWED', 'DIVORCED', 'SEPARATED']},
+        {'value': 'OTHER/UNKNOWN', 'equals': ['UNKNOWN (DEFAULT)']},
+    ],
+    'religion': [
+        {'value': 'RELIGIOUS',
+         'equals': ['LUTHERAN', 'METHODIST', 'HEBREW', 'BAPTIST', 'HINDU',
+                    'UNITARIAN-UNIVERSALIST', 'ROMANIAN EAST. ORTH',
+                    '7TH DAY ADVENTIST', "JEHOVAH'S WITNESS", 'MUSLIM',
+                    'BUDDHIST', 'CHRISTIAN SCIENTIST', 'GREEK ORTHODOX',
+                    'EPISCOPALIAN', 'OTHER', 'JEWISH', 'CATHOLIC',
+                    'PROTESTANT QUAKER']},
+    ],
+    'admission_location': [
+        {'value': 'ER_ADMIT', 'equals': ['EMERGENCY ROOM ADMIT ']},
+        {'value': 'REFERRAL', 'equals': ['HMO REFERRAL/SICK',
+                                         'PHYS REFERRAL/NORMAL DELI',
+                                         'CLINIC REFERRAL/PREMATURE']},
+        {'value': 'TRANSFER', 'equals': ['TRANSFER FROM HOSP/EXTRAM',
+                                         'TRANSFER FROM SKILLED NUR',
+                                         'TRANSFER FROM OTHER HEALT',
+                                         'TRSF WITHIN THIS FACILITY']},
+        {'value': 'OTHER/UNKNOWN', 'equals': ['** INFO NOT AVAILABLE **']},
+    ],
+}
+
+# ICD9 diagnoses categories as (lower bound, upper bound, upper bound is
+# inclusive, category), sorted by lower bound. Supplemental (V), external cause
+# (E) and morphology (M) codes are recoded below 1 before binning.
+ICD9_BINS = [
+    (-np.inf, .4, False, 'Supplemental_factors'),
+    (.4, .7, False, 'External_Cause_Inj_Poison'),
+    (.7, .9, False, 'Morphology_of_Neoplasms'),
+    (1, 139, True, 'Parasitic_Disease'),
+    (140, 239, True, 'Neoplasm'),
+    (240, 279, True, 'Endocrine'),
+    (280, 289, True, 'Blood'),
+    (290, 319, True, 'Mental_Disorder'),
+    (320, 389, True, 'Nervous_System'),
+    (390, 459, True, 'Circulatory_System'),
+    (460, 519, True, 'Respiratory_System'),
+    (520, 579, True, 'Digestive_System'),
+    (580, 629, True, 'Genitourinary_System'),
+    (630, 679, True, 'Pregnancy'),
+    (680, 709, True, 'Skin'),
+    (710, 739, True, 'Musculoskeletal'),
+    (740, 759, True, 'Congenital_Anomalies'),
+    (760, 779, True, 'Perinatal'),
+    (780, 799, True, 'Ill-Defined'),
+    (800, 999, True, 'Injury/Poison'),
+]
+
+ICD9_BIN_LOWER = np.array([b[0] for b in ICD9_BINS], dtype=float)
+ICD9_BIN_UPPER = np.array([b[1] for b in ICD9_BINS], dtype=float)
+ICD9_BIN_INCLUSIVE = np.array([b[2] for b in ICD9_BINS])
+ICD9_BIN_LABELS = np.array([b[3] for b in ICD9_BINS], dtype=object)
+
+# Rows and shard assignments of a partitioned run, set in each worker
+_partition = {}
+
+@instrumentation.instrumented
+@stage_cache.cached(config=lambda: storage.DATETIME_FORMAT)
 def new_features(data):
     """Returns the dataframe with two additional features: length of stay in
     the hospital and patient age.
     """
 
+    admit = pd.to_datetime(data.admittime, format=storage.DATETIME_FORMAT)
+    disch = pd.to_datetime(data.dischtime, format=storage.DATETIME_FORMAT)
+    dob = pd.to_datetime(data.dob, format=storage.DATETIME_FORMAT)
+
     # Add length of stay column as the dependent variable, 'y'
-    start = pd.to_datetime(data.admittime)
-    end = pd.to_datetime(data.dischtime)
-    data['los'] = (start - end).dt.total_seconds()/86400
-
-    # Add age feature and remove outliers
-    admit = pd.to_datetime(data.admittime).dt.date
-    dob = pd.to_datetime(data.dob).dt.date
-    data['age'] = (admit - dob).apply(lambda x: round(x.days / 365, 0))
-    data = data[data.age < 105].drop(columns='dob')
+    data['los'] = (disch - admit) / np.timedelta64(1, 'D')
+
+    # Add age feature in whole years between calendar dates. Day resolution
+    # avoids nanosecond overflow on the shifted dobs of patients over 89.
+    admit_day = admit.to_numpy().astype('datetime64[D]')
+    dob_day = dob.to_numpy().astype('datetime64[D]')
+    data['age'] = np.round((admit_day - dob_day) / np.timedelta64(365, 'D'))
+
+    # Remove age outliers and the timestamps, which are not model features,
+    # selecting rows and columns together so the frame is copied once
+    rows = len(data)
+    data = data.loc[data.age < 105,
+                    data.columns.drop(['admittime', 'dischtime', 'dob'])]
+    instrumentation.record_filter('age_outliers', rows, len(data))
     return data
 
 
-def compressing_admission_type(data):
-    """Returns the dataframe with addmission type compressed so that emergency
-    and urgent are both marked as urgent.
+def remap_categories(categorical, values):
+    """Returns a categorical with each category replaced by the matching
+    entry of values, merging categories that map to the same value. Only the
+    integer codes are remapped, so no row values are rewritten. Unused
+    categories are dropped and the rest sorted, so that one hot encoding
+    gives the same columns as for the plain values.
     """
 
-    data.admission_type = data.admission_type.apply(lambda x: 'EMERGENCY' if x
-                                                    == 'URGENT' else x)
-    return data
+    values = pd.Index(values, dtype=object)
+    used = np.bincount(categorical.codes + 1,
+                       minlength=len(values) + 1)[1:] > 0
+
+    categories = values[used].dropna().unique()
+    try:
+        categories = categories.sort_values()
+    except TypeError:
+        pass
+
+    # Code -1 marks a missing value, which picks up the trailing -1
+    lookup = np.append(categories.get_indexer(values), -1)
+    codes = lookup.astype(categorical.codes.dtype)[categorical.codes]
+    return pd.Categorical.from_codes(codes, categories)
+
+def compress_categories(series, rules):
+    """Returns a categorical copy of the series with the compression rules
+    applied. Rules are evaluated once per category and the categorical codes
+    are remapped to the compressed categories.
+    """
+
+    categorical = pd.Categorical(series)
+    categories = pd.Series(categorical.categories, dtype=object)
+
+    for rule in rules:
+        match = categories.isin(rule.get('equals', []))
+        for substring in rule.get('contains', []):
+            match |= categories.str.contains(substring, regex=False)
+        categories = categories.mask(match, rule['value'])
 
-def assign_cats(row):
-    """Helper function for age_to_cat that assigns categories based on patient
-    age.
+    return pd.Series(remap_categories(categorical, categories),
+                     index=series.index, name=series.name)
+
+def compress_column(data, column):
+    """Returns the dataframe with the registered compression rules applied to
+    the given column.
     """
 
-    if 0 <= row['age'] <= 3:
-        val = 'Baby'
-    elif 3 <= row['age'] <= 18:
-        val = 'Child/Teen'
-    elif 19 <= row['age'] <= 40:
-        val = 'Young_Aduld'
-    elif 41 <= row['age'] <= 60:
-        val = "Adult"
-    elif 61 <= row['age'] <= 100:
-        val = "Senior"
+    data[column] = compress_categories(data[column], COMPRESSION_RULES[column])
+    return data
+
+@instrumentation.instrumented
+@stage_cache.cached(compress_column, compress_categories, remap_categories,
+                    config=lambda: COMPRESSION_RULES['admission_type'])
+def compressing_admission_type(data):
+    """Returns the dataframe with addmission type compressed so that emergency
+    and urgent are both marked as urgent.
+    """
 
-    return val
+    return compress_column(data, 'admission_type')
 
+@instrumentation.instrumented
+@stage_cache.cached(remap_categories,
+                    config=lambda: (AGE_BINS, AGE_LABELS))
 def age_to_cat(data):
     """Returns a dataframe with ages compressed into categorical groups."""
 
-    data['age'] = data.apply(assign_cats, axis=1)
+    ages = pd.cut(data.age, bins=AGE_BINS, labels=AGE_LABELS).array
+    data['age'] = remap_categories(ages, ages.categories)
     return data
 
+@instrumentation.instrumented
+@stage_cache.cached(compress_column, compress_categories, remap_categories,
+                    config=lambda: COMPRESSION_RULES['first_careunit'])
 def compressing_careunit(data):
     """Returns the dataframe with all ICU subcategories combined into a single
     'ICU' category.
     """
 
-    data.first_careunit = data.first_careunit.apply(lambda x: 'ICU' if
-                                                    (x == 'MICU') |
-                                                    (x == 'SICU') |
-                                                    (x == 'CCU') |
-                                                    (x == 'CSRU') |
-                                                    (x == 'TSICU')
-                                                    else x)
-    return data
+    return compress_column(data, 'first_careunit')
 
+@instrumentation.instrumented
+@stage_cache.cached(compress_column, compress_categories, remap_categories,
+                    config=lambda: COMPRESSION_RULES['curr_service'])
 def compressing_curr_serv(data):
     """Returns the dataframe with the survice area compressed to only
     SURGERY, MED, GYNOCOLOGY/NEWBORN, and OTHER.
     """
-    data.curr_service = data.curr_service.apply(lambda x: 'SURGERGY' if
-                                                (x == 'CSURG') |
-                                                (x == 'NSURG') |
-                                                (x == 'ORTHO') |
-                                                (x == 'PSURG') |
-                                                (x == 'SURG') |
-                                                (x == 'TSURG') |
-                                                (x == 'VSURG')
-                                                else x)
-
-    data.curr_service = data.curr_service.apply(lambda x: "MED"
-                                                if (x == 'CMED') |
-                                                (x == 'OMED') |
-                                                (x == 'NMED') |
-                                                (x == 'TRAUM')
-                                                else x)
-
-    data.curr_service = data.curr_service.apply(lambda x: "GYNOCOLOGY/NEWBORN"
-                                                if (x == 'NB') |
-                                                (x == 'NBB') |
-                                                (x == 'OBS') |
-                                                (x == 'GYN')
-                                                else x)
-
-    data.curr_service = data.curr_service.apply(lambda x: "OTHER"
-                                                if (x == "GU") |
-                                                (x == "ENT") |
-                                                (x == "DENT") |
-                                                (x == "PSYCH")
-                                                else x)
 
-    return data
+    return compress_column(data, 'curr_service')
 
+@instrumentation.instrumented
+@stage_cache.cached(compress_column, compress_categories, remap_categories,
+                    config=lambda: COMPRESSION_RULES['ethnicity'])
 def compressing_ethnicity(data):
     """Returns the dataframe with ethnicity compressed into only the majority
     groups, WHITE, ASIAN, HISPANIC/LATINO, BLACK_AFRICAN/OTHER and
     OTHER/UNKOWN.
     """
 
-    data.ethnicity = data.ethnicity.apply(lambda x: 'WHITE'
-                                          if ("WHITE" in x) else x)
-
-    data.ethnicity = data.ethnicity.apply(lambda x: "ASIAN"
-                                          if ("ASIAN" in x)  else x)
-
-    data.ethnicity = data.ethnicity.apply(lambda x: "HISPANIC/LATINO"
-                                          if ("LATINA" in x) |
-                                          ("HISPANIC" in x)
-                                          else x)
-
-    data.ethnicity = data.ethnicity.apply(lambda x: "OTHER/UNKNOWN"
-                                          if (x == "AMERICAN INDIAN/ALASKA NATIVE FEDERALLY RECOGNIZED TRIBE") |
-                                          (x == "SOUTH AMERICAN") |
-                                          (x == "CARIBBEAN ISLAND") |
-                                          (x == "NATIVE HAWAIIAN OR OTHER PACIFIC ISLANDER") |
-                                          (x == "AMERICAN INDIAN/ALASKA NATIVE") |
-                                          (x == "MIDDLE EASTERN") |
-                                          (x == "PORTUGUESE") |
-                                          (x == "MULTI RACE ETHNICITY") |
-                                          (x == "PATIENT DECLINED TO ANSWER") |
-                                          (x == "OTHER") |
-                                          ("UNKNOWN" in x) |
-                                          ("OBTAIN" in x)
-                                          else x)
-
-    data.ethnicity = data.ethnicity.apply(lambda x: "BLACK_AFRICAN/OTHER"
-                                          if ("BLACK" in x) else x)
-
-    return data
+    return compress_column(data, 'ethnicity')
 
+@instrumentation.instrumented
+@stage_cache.cached(compress_column, compress_categories, remap_categories,
+                    config=lambda: COMPRESSION_RULES['marital_status'])
 def compressing_marital_status(data):
     """Returns the dataframe with marital status compressed to only
     LIFE_PARTNER, SINGLE, OTHER/UNKOWN.
     """
 
-    data.marital_status = data.marital_status.apply(lambda x: 'LIFE_PARTNER'
-                                                    if (x == 'MARRIED') |
-                                                    (x == 'LIFE PARTNER')
-                                                    else x)
-
-    data.marital_status = data.marital_status.apply(lambda x: 'SINGLE'
-                                                    if (x == 'WIDOWED') |
-                                                    (x == 'DIVORCED') |
-                                                    (x == 'SEPARATED')
-                                                    else x)
-
-    data.marital_status = data.marital_status.apply(lambda x: 'OTHER/UNKNOWN'
-                                                    if (x == 'UNKNOWN (DEFAULT)')
-                                                    else x)
-
-    return data
+    return compress_column(data, 'marital_status')
 
+@instrumentation.instrumented
+@stage_cache.cached(compress_column, compress_categories, remap_categories,
+                    config=lambda: COMPRESSION_RULES['religion'])
 def compressing_religion(data):
     """Returns the dataframe with relgion compressed to either RELIGIOUS or
     NOT RELIGOUS.
     """
 
-    data.religion = data.religion.apply(lambda x: 'RELIGIOUS'
-                                        if (x == "LUTHERAN") |
-                                        (x == "METHODIST") |
-                                        (x == "HEBREW") |
-                                        (x == "BAPTIST") |
-                                        (x == "HINDU") |
-                                        (x == "UNITARIAN-UNIVERSALIST") |
-                                        (x == "ROMANIAN EAST. ORTH") |
-                                        (x == "7TH DAY ADVENTIST") |
-                                        (x == "JEHOVAH'S WITNESS") |
-                                        (x == 'MUSLIM') |
-                                        (x == 'BUDDHIST') |
-                                        (x == 'CHRISTIAN SCIENTIST') |
-                                        (x == 'GREEK ORTHODOX') |
-                                        (x == 'EPISCOPALIAN') |
-                                        (x == 'OTHER') |
-                                        (x == 'JEWISH') |
-                                        (x == 'CATHOLIC') |
-                                        (x == 'PROTESTANT QUAKER')
-                                        else x)
-
-    return data
+    return compress_column(data, 'religion')
 
+@instrumentation.instrumented
+@stage_cache.cached(compress_column, compress_categories, remap_categories,
+                    config=lambda: COMPRESSION_RULES['admission_location'])
 def compressing_admit_location(data):
     """Returns the dataframe with admit location compressed to only ER_ADMIT,
     REFERRAL, TRANSFER, and OTHER/UNKNOWN.
     """
 
-    data.admission_location = data.admission_location.apply(lambda x: 'ER_ADMIT'
-                                                            if (x == 'EMERGENCY ROOM ADMIT ')
-                                                            else x)
+    return compress_column(data, 'admission_location')
 
-    data.admission_location = data.admission_location.apply(lambda x: 'REFERRAL'
-                                                            if (x == 'HMO REFERRAL/SICK') |
-                                                            (x == 'PHYS REFERRAL/NORMAL DELI') |
-                                                            (x == 'CLINIC REFERRAL/PREMATURE')
-                                                            else x)
+def classify_icd9_values(values):
+    """Returns an object array with the diagnoses category for each numeric
+    ICD9 value. Values outside every bin are returned unchanged.
+    """
 
-    data.admission_location = data.admission_location.apply(lambda x: 'TRANSFER'
-                                                            if (x == 'TRANSFER FROM HOSP/EXTRAM') |
-                                                            (x == 'TRANSFER FROM SKILLED NUR') |
-                                                            (x == 'TRANSFER FROM OTHER HEALT') |
-                                                            (x == 'TRSF WITHIN THIS FACILITY')
-                                                            else x)
+    values = np.asarray(values, dtype=float)
+    idx = np.searchsorted(ICD9_BIN_LOWER, values, side='right') - 1
+    bins = idx.clip(0)
 
-    data.admission_location = data.admission_location.apply(lambda x: 'OTHER/UNKNOWN'
-                                                            if (x == '** INFO NOT AVAILABLE **')
-                                                            else x)
+    upper = ICD9_BIN_UPPER[bins]
+    below_upper = np.where(ICD9_BIN_INCLUSIVE[bins], values <= upper,
+                           values < upper)
+    in_bin = (idx >= 0) & below_upper
 
-    return data
+    diagnoses = values.astype(object)
+    diagnoses[in_bin] = ICD9_BIN_LABELS[bins[in_bin]]
+    return diagnoses
 
-def icd9_descriptions(row):
-    """Assigned a diagnoses string to each icd9_code value. Returns a string
-    value to replace the icd9_code.
+def icd9_categories(codes):
+    """Returns an object array with the diagnoses category for each raw ICD9
+    code string. V, M and E codes are recoded to .1, .8 and .5 and all other
+    codes are truncated to their first three digits before binning.
     """
 
-    if 1 <= row['icd9_code'] <= 139:
-        val = 'Parasitic_Disease'
-    elif 140 <= row['icd9_code'] <= 239:
-        val = 'Neoplasm'
-    elif 240 <= row['icd9_code'] <= 279:
-        val = 'Endocrine'
-    elif 280 <= row['icd9_code'] <= 289:
-        val = "Blood"
-    elif 290 <= row['icd9_code'] <= 319:
-        val = "Mental_Disorder"
-    elif 320 <= row['icd9_code'] <= 389:
-        val = "Nervous_System"
-    elif 390 <= row['icd9_code'] <= 459:
-        val = "Circulatory_System"
-    elif 460 <= row['icd9_code'] <= 519:
-        val = "Respiratory_System"
-    elif 520 <= row['icd9_code'] <= 579:
-        val = "Digestive_System"
-    elif 580 <= row['icd9_code'] <= 629:
-        val = "Genitourinary_System"
-    elif 630 <= row['icd9_code'] <= 679:
-        val = "Pregnancy"
-    elif 680 <= row['icd9_code'] <= 709:
-        val = "Skin"
-    elif 710 <= row['icd9_code'] <= 739:
-        val = "Musculoskeletal"
-    elif 740 <= row['icd9_code'] <= 759:
-        val = "Congenital_Anomalies"
-    elif 760 <= row['icd9_code'] <= 779:
-        val = "Perinatal"
-    elif 780 <= row['icd9_code'] <= 799:
-        val = "Ill-Defined"
-    elif 800 <= row['icd9_code'] <= 999:
-        val = "Injury/Poison"
-    elif row['icd9_code'] < .4:
-        val = "Supplemental_factors"
-    elif .4 <= row['icd9_code'] < .7:
-        val = "External_Cause_Inj_Poison"
-    elif .7 <= row['icd9_code'] < .9:
-        val = "Morphology_of_Neoplasms"
-    else:
-        val = row['icd9_code']
+    codes = pd.Series(codes, dtype=object).astype(str)
+    numeric = codes.str[:3]
+    numeric = numeric.mask(codes.str.contains('E', regex=False), '.5')
+    numeric = numeric.mask(codes.str.contains('M', regex=False), '.8')
+    numeric = numeric.mask(codes.str.contains('V', regex=False), '.1')
 
-    return val
+    return classify_icd9_values(numeric.astype(float))
 
+@instrumentation.instrumented
+@stage_cache.cached(icd9_categories, classify_icd9_values, remap_categories,
+                    config=lambda: ICD9_BINS)
 def compress_icd9_codes(data):
     """Returns the dataframe with the 6000 unique ICD9 codes reduced into 17
     diagnoses categories based on standard definitions. A new column is
     created to contain diagnoses.
     """
 
-    data.icd9_code = data.icd9_code.apply(lambda x: '.1' if 'V' in x else x)
-    data.icd9_code = data.icd9_code.apply(lambda x: '.8' if 'M' in x else x)
-    data.icd9_code = data.icd9_code.apply(lambda x: '.5' if 'E' in x else x)
-    data.icd9_code = data.icd9_code.apply(lambda x: x[:3] if ('E' not in x) &
-                                          ('M' not in x) &
-                                          ('V' not in x)
-                                          else x)
-
-    data.icd9_code = data.icd9_code.astype(float)
-
-
-    data['diagnoses'] = data.apply(icd9_descriptions, axis=1)
-    data = data.drop(columns=['icd9_code'])
+    # Classify each unique code once and remap the codes to the diagnoses
+    categorical = pd.Categorical(data.icd9_code)
+    diagnoses = icd9_categories(categorical.categories)
+    data['diagnoses'] = remap_categories(categorical, diagnoses)
+    del data['icd9_code']
 
     return data
 
-def main():
-    """Loads the raw hospital data and returns a dataframe with feautre
-    engineering applied.
+def feature_engineering(data):
+    """Returns the cleaned hospital dataframe with every feature engineering
+    step applied.
     """
-    raw_data = pd.read_csv('data/raw_hospital_data.csv')
 
-    fe_data = new_features(raw_data)
-    fe_data = compressing_admission_type(data)
+    fe_data = new_features(data)
+    fe_data = compressing_admission_type(fe_data)
     fe_data = age_to_cat(fe_data)
     fe_data = compressing_careunit(fe_data)
     fe_data = compressing_curr_serv(fe_data)
@@ -326,6 +354,90 @@ def main():
     fe_data = compressing_admit_location(fe_data)
     fe_data = compress_icd9_codes(fe_data)
 
-    fe_data.to_csv('data/feature_engineering_data.csv')
+    return fe_data
+
+def concat_categorical(frames, ignore_index=False):
+    """Returns a single dataframe from the frames, with each categorical
+    column recoded to the union of the frames' categories so that it stays
+    categorical after concatenation.
+    """
+
+    for col in frames[0].select_dtypes(include=['category']).columns:
+        categories = reduce(pd.Index.union,
+                            [frame[col].cat.categories for frame in frames])
+        for frame in frames:
+            frame[col] = frame[col].cat.set_categories(categories)
+
+    return pd.concat(frames, ignore_index=ignore_index)
+
+def subject_shards(subject_ids, n_shards):
+    """Returns the shard of each row, from a hash of its subject_id, so that
+    all of a patient's rows land in the same shard.
+    """
+
+    hashes = pd.util.hash_array(np.asarray(subject_ids))
+    return (hashes % np.uint64(n_shards)).astype(np.int64)
+
+def _set_partition(data, shards):
+    """Pool initializer that keeps the rows and their shards in a worker."""
+
+    _partition['data'], _partition['shards'] = data, shards
+
+def _engineer_shard(shard):
+    """Returns one shard of the partitioned rows with feature engineering
+    applied, and the rows dropped by each filter, which would otherwise be
+    lost with the worker process.
+    """
+
+    data, shards = _partition['data'], _partition['shards']
+    with instrumentation.collected_filters() as filters:
+        fe_data = feature_engineering(data[shards == shard])
+    return fe_data, filters
+
+@instrumentation.instrumented
+def partitioned_feature_engineering(data, n_jobs=None, n_shards=None):
+    """Returns the cleaned hospital dataframe with every feature engineering
+    step applied, as feature_engineering does, with the rows split into
+    shards by hashed subject_id and the shards processed on n_jobs
+    processes. n_jobs defaults to one per core and n_shards to n_jobs. The
+    shards are concatenated back in the original row order, so the result
+    does not depend on the number of shards or processes.
+    """
+
+    n_jobs = n_jobs or os.cpu_count()
+    n_shards = n_shards or n_jobs
+    shards = subject_shards(data.subject_id, n_shards)
+
+    # Rows are indexed by position while sharded and the original index is
+    # restored once the shards are back in position order
+    index = data.index
+    data = data.set_axis(pd.RangeIndex(len(data)))
+
+    # The rows are handed to each worker once, inherited without pickling
+    # where processes are forked, and workers select their own shards
+    with Pool(n_jobs, initializer=_set_partition,
+              initargs=(data, shards)) as pool:
+        results = pool.map(_engineer_shard, range(n_shards), chunksize=1)
+
+    parts = []
+    for part, filters in results:
+        parts.append(part)
+        instrumentation.record_filters(filters)
+
+    fe_data = concat_categorical(parts).sort_index()
+    return fe_data.set_axis(index[fe_data.index])
+
+def main(fmt=storage.DEFAULT_FORMAT, n_jobs=1):
+    """Loads the raw hospital data and saves a dataframe with feautre
+    engineering applied, partitioned across n_jobs processes when n_jobs is
+    not 1.
+    """
+    raw_data = storage.load_stage('raw_hospital_data', fmt=fmt)
+    if n_jobs == 1:
+        fe_data = feature_engineering(raw_data)
+    else:
+        fe_data = partitioned_feature_engineering(raw_data, n_jobs)
+    storage.save_stage(fe_data, 'feature_engineering_data', fmt)
 
-main()
+if __name__ == '__main__':
+    main()
@@ -1,89 +1,263 @@
 """
 This script imports csv files downloaded from MIT's patient database. The files
 are turned into Pandas dataframes and a series of joins and cleaning steps are
-implemented. The final dataframe is then saved as a csv file.
+implemented. The final dataframe is then saved as a stage file.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
 
-def importing(files_list):
+import feature_engineering as fe
+import instrumentation
+import stage_cache
+import storage
+
+SOURCE_DIR = 'full_data'
+SOURCE_FILES = ['admissions_data', 'patient_data', 'diagnoses_icd_data',
+                'services_data', 'icustays']
+CHUNK_SIZE = 500_000
+
+KEEPING_COLS = ['subject_id', 'hadm_id', 'admittime', 'dischtime',
+                'admission_type', 'admission_location', 'insurance',
+                'religion', 'marital_status', 'ethnicity', 'gender', 'dob',
+                'deathtime', 'icd9_code', 'curr_service', "first_careunit"
+                ]
+
+# Named row filters applied to each chunk while a source file is read
+ROW_FILTERS = {
+    'admissions_data': {'deaths': lambda chunk: chunk.deathtime.isna()},
+}
+
+def read_dtype(col):
+    """Returns the compact dtype used to read a cleaned source column name."""
+
+    if col in storage.ID_COLS:
+        return 'int32'
+    if col in storage.DATETIME_COLUMNS:
+        return str
+    return 'category'
+
+def read_chunks(file, chunksize=CHUNK_SIZE, directory=SOURCE_DIR):
+    """Yields the chunks of a source file with only the KEEPING_COLS
+    columns, read with compact dtypes and with any row filter for the file
+    applied.
+    """
+
+    path = f'{directory}/{file}.csv'
+    header = pd.read_csv(path, nrows=0).columns
+    names = {raw: raw.strip().lower() for raw in header
+             if raw.strip().lower() in KEEPING_COLS}
+    dtypes = {raw: read_dtype(col) for raw, col in names.items()}
+    row_filters = ROW_FILTERS.get(file, {})
+
+    for chunk in pd.read_csv(path, usecols=list(names), dtype=dtypes,
+                             chunksize=chunksize):
+        chunk = chunk.rename(columns=names)
+        for name, row_filter in row_filters.items():
+            rows = len(chunk)
+            chunk = chunk[row_filter(chunk)]
+            instrumentation.record_filter(name, rows, len(chunk))
+        for col in chunk.columns.intersection(storage.DATETIME_COLUMNS):
+            chunk[col] = pd.to_datetime(chunk[col],
+                                        format=storage.DATETIME_FORMAT)
+        yield chunk
+
+def read_source(file, chunksize=CHUNK_SIZE, directory=SOURCE_DIR):
+    """Returns a dataframe with only the KEEPING_COLS columns of a source
+    file. The file is streamed in chunks with compact dtypes and any row
+    filter for the file is applied to each chunk as it is read.
+    """
+
+    return fe.concat_categorical(list(read_chunks(file, chunksize, directory)),
+                                 ignore_index=True)
+
+@instrumentation.instrumented
+def importing(files_list, chunksize=CHUNK_SIZE, directory=SOURCE_DIR,
+              n_threads=None):
     """Retruns a list of pandas dataframes generated from the files listed
-    in the input argument.
+    in the input argument. The files do not depend on each other, so they are
+    read concurrently on n_threads threads, one per file by default, as the
+    CSV parser releases the GIL while it parses.
     """
 
-    dataframes = []
+    n_threads = n_threads or len(files_list)
+    with ThreadPoolExecutor(n_threads) as pool:
+        return list(pool.map(lambda file: read_source(file, chunksize,
+                                                      directory),
+                             files_list))
+
 
-    for file in files_list:
-        imported_df = pd.read_csv(f'full_data/{file}.csv')(file)
-        imported_df.columns = imported_df.columns.str.strip().str.lower()
-        dataframes.append(imported_df)
+def diagnosis_categories(codes):
+    """Returns the feature engineering diagnoses category of each ICD9 code."""
 
-    return dataframes
+    return fe.compress_icd9_codes(codes.to_frame()).diagnoses
 
+def service_categories(services):
+    """Returns the feature engineering category of each current service."""
 
+    return fe.compress_categories(services, fe.COMPRESSION_RULES['curr_service'])
+
+def careunit_categories(careunits):
+    """Returns the feature engineering category of each first care unit."""
+
+    return fe.compress_categories(careunits,
+                                  fe.COMPRESSION_RULES['first_careunit'])
+
+def representative_rows(table, column, categories):
+    """Returns the table indexed by hadm_id with one row per admission and
+    feature engineering category of the column. Rows sharing an admission and
+    a category produce the same one hot encoded features once grouped by
+    admission, so the first is kept as the representative.
+    """
+
+    table = table.dropna(subset=[column])
+    keys = pd.DataFrame({'hadm_id': table.hadm_id.to_numpy(),
+                         'category': categories(table[column]).to_numpy()})
+
+    return table.loc[~keys.duplicated().to_numpy(), ['hadm_id', column]] \
+                .set_index('hadm_id')
+
+def first_visit_mask(data, eligible):
+    """Returns a boolean mask of the eligible rows that belong to each
+    patient's first eligible admission. The rows are sorted once by
+    subject_id, eligibility and admittime, with hadm_id breaking ties, so
+    each patient's first admission leads its run of rows; that admission is
+    then repeated over the run and compared with each row's own.
+    """
+
+    subject_ids = data.subject_id.to_numpy()
+    hadm_ids = data.hadm_id.to_numpy()
+    order = np.lexsort((hadm_ids, data.admittime.to_numpy(),
+                        ~np.asarray(eligible), subject_ids))
+
+    sorted_subjects = subject_ids[order]
+    starts = np.flatnonzero(sorted_subjects[1:] != sorted_subjects[:-1]) + 1
+    starts = np.append(0, starts) if len(order) else starts
+    del sorted_subjects
+
+    sorted_hadm_ids = hadm_ids[order]
+    first_hadm_ids = np.repeat(sorted_hadm_ids[starts],
+                               np.diff(np.append(starts, len(order))))
+
+    mask = np.empty(len(order), dtype=bool)
+    mask[order] = sorted_hadm_ids == first_hadm_ids
+    return mask & eligible
+
+@instrumentation.instrumented
+@stage_cache.cached(representative_rows, first_visit_mask,
+                    diagnosis_categories, service_categories,
+                    careunit_categories,
+                    fe.compress_categories, fe.remap_categories,
+                    fe.compress_icd9_codes, fe.icd9_categories,
+                    fe.classify_icd9_values,
+                    config=lambda: (KEEPING_COLS, fe.COMPRESSION_RULES,
+                                    fe.ICD9_BINS))
 def merging_data(dataframes_list):
     """Returns a single pandas dataframe that is a combination of the
-    dataframes in the input list. All merges are outer joins on subject_id and
-    hadm_id when available. Only features used for predicting length of stay
+    dataframes in the input list. Dead admissions, rows with null admission
+    or patient details and admissions other than each patient's first are
+    filtered out before joining, and the one to many diagnoses, services
+    and icustays tables are reduced to one row per admission and category.
+    The tables are then joined on a hadm_id index. This returns the same rows per admission, once grouped, as outer
+    joining the full tables while avoiding most of the diagnoses x services x
+    icustays row explosion. Only features used for predicting length of stay
     are returned in the final dataframe.
     """
 
     adm, pat, diag, serv, icu = dataframes_list
 
-    raw_data = adm.merge(pat, how='outer', on='subject_id')
-    raw_data = raw_data.merge(diag, how='outer', on=('subject_id', 'hadm_id'))
-    raw_data = raw_data.merge(serv, how='outer', on=('subject_id', 'hadm_id'))
-    raw_data = raw_data.merge(icu, how='outer', on=('subject_id', 'hadm_id'))
+    # Dead admissions and null details are filtered with a single row mask
+    details = adm.columns.intersection(KEEPING_COLS).drop('deathtime')
+    alive = adm.deathtime.isna()
+    complete = alive & adm[details].notna().all(axis=1)
+    instrumentation.record_filter('deaths', len(adm), alive.sum())
+    instrumentation.record_filter('null_admission_details', alive.sum(),
+                                  complete.sum())
+    adm = adm.loc[complete]
 
-    keeping_cols = ['subject_id', 'hadm_id', 'admittime', 'dischtime',
-                    'admission_type', 'admission_location', 'insurance',
-                    'religion', 'marital_status', 'ethnicity', 'gender', 'dob',
-                    'deathtime', 'icd9_code', 'curr_service', "first_careunit"
-                    ]
+    rows = len(pat)
+    pat = pat.dropna(subset=pat.columns.intersection(KEEPING_COLS))
+    instrumentation.record_filter('null_patient_details', rows, len(pat))
 
-    raw_data = raw_data[keeping_cols]
+    diagnoses = representative_rows(diag, 'icd9_code', diagnosis_categories)
+    services = representative_rows(serv, 'curr_service', service_categories)
+
+    # Non-first visits are dropped before joining. A first visit is chosen
+    # among the admissions that survive the inner joins below, matching the
+    # selection data_cleaning makes on the joined rows
+    eligible = adm.subject_id.isin(pat.subject_id) & \
+        adm.hadm_id.isin(diagnoses.index) & adm.hadm_id.isin(services.index)
+    first_visit = first_visit_mask(adm, eligible.to_numpy())
+    instrumentation.record_filter('first_visit', len(adm), first_visit.sum())
+    adm = adm.loc[first_visit]
+
+    raw_data = adm.merge(pat, how='inner', on='subject_id') \
+                  .set_index('hadm_id')
+    raw_data = raw_data.join(diagnoses, how='inner')
+    raw_data = raw_data.join(services, how='inner')
+    raw_data = raw_data.join(representative_rows(icu, 'first_careunit',
+                                                 careunit_categories),
+                             how='left')
+
+    raw_data = raw_data.reset_index()[KEEPING_COLS]
 
     return raw_data
 
+def complete_rows(data):
+    """Returns a boolean mask of the rows of admissions without a death time
+    and with no null values other than the ICU care unit, which
+    data_cleaning fills.
+    """
+
+    details = data.columns.drop(['deathtime', 'first_careunit'])
+    return data.deathtime.isna().to_numpy() & \
+        data[details].notna().all(axis=1).to_numpy()
+
+@instrumentation.instrumented
+@stage_cache.cached(first_visit_mask, complete_rows)
 def data_cleaning(data):
     """Returns a dataframe with the following cleaning implementations.
        - Drop patients who died in the hospital as LOS is not accurate for
        them
+       - Drop null values
        - Select only first time visits to reduce autocorrelation
        - Indicate if a patient was admitted to the ICU
-       - Drop null values
 
     """
-    # Dropping any patience who died while in the hospital
-    data = data[data.deathtime.isna()]
-    data = data.drop(columns=['deathtime'])
+    # Dropping any patience who died while in the hospital and rows with
+    # null values other than the ICU care unit, which is filled below
+    alive = data.deathtime.isna().to_numpy()
+    complete = complete_rows(data)
+    instrumentation.record_filter('deaths', len(data), alive.sum())
+    instrumentation.record_filter('nulls', alive.sum(), complete.sum())
 
-    # Isolate rows to only first time visits for each patients
-    first_vis_grp = data.groupby(['subject_id', 'hadm_id'])['admittime'] \
-                    .agg(['first']).reset_index()
-    first_vis = first_vis_grp.merge(data, how='left',
-                                    on=('subject_id', 'hadm_id'))
-    first_vis = first_vis.drop(['first'], axis=1)
+    # Isolate rows to only first time visits for each patients, selected
+    # among the complete rows with the same single mask
+    first_visit = first_visit_mask(data, complete)
+    instrumentation.record_filter('first_visit', complete.sum(),
+                                  first_visit.sum())
+    first_vis = data.loc[first_visit, data.columns.drop('deathtime')]
 
     # Indicate if patient was admitted to the ICU
-    first_vis.first_careunit = first_vis.first_careunit.fillna('not_admitted')
-
-    # Drop remaining null values
-    first_vis = first_vis.dropna()
+    careunit = first_vis.first_careunit.astype('category')
+    if 'not_admitted' not in careunit.cat.categories:
+        careunit = careunit.cat.add_categories('not_admitted')
+    first_vis.first_careunit = careunit.fillna('not_admitted')
 
     return first_vis
 
 
-def main():
+def main(fmt=storage.DEFAULT_FORMAT):
     """Imports csv files from the MIT hospital database and saves a single
-    merged and cleaned dataframe with selected columns as a csv file."""
+    merged and cleaned dataframe with selected columns as a stage file."""
 
-    dataframes = importing(['admissions_data', 'patient_data',
-                            'diagnoses_icd_data', 'services_data',
-                            'icustays'])
+    dataframes = importing(SOURCE_FILES)
     merged_data = merging_data(dataframes)
     cleaned = data_cleaning(merged_data)
 
-    cleaned.to_csv('raw_hospital_data.csv')
+    storage.save_stage(cleaned, 'raw_hospital_data', fmt)
 
-main()
+if __name__ == '__main__':
+    main()
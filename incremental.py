@@ -0,0 +1,142 @@
+"""
+This script runs the import, cleaning and feature engineering stages
+incrementally. A local manifest records a fingerprint of each source file and
+a content hash of every processed admission. When sources change, only the
+patients with new, changed or removed admissions are merged, cleaned and
+feature engineered again, and their rows are replaced in the stored stage
+outputs. Whole patients are reprocessed so that first visit selection in
+data_cleaning stays correct when a returning patient appears in a later
+batch.
+"""
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+import feature_engineering as fe
+import importing_and_cleaning_data as ic
+import storage
+
+MANIFEST_PATH = os.path.join(storage.STAGE_DIR, 'manifest.json')
+
+def file_fingerprint(path):
+    """Returns the size and SHA-256 digest of a file."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2**20), b''):
+            digest.update(block)
+
+    return {'size': os.path.getsize(path), 'sha256': digest.hexdigest()}
+
+def load_manifest(path=MANIFEST_PATH):
+    """Returns the manifest, or an empty one before the first run."""
+
+    if not os.path.exists(path):
+        return {'sources': {}, 'admissions': {}}
+
+    with open(path) as file:
+        return json.load(file)
+
+def save_manifest(manifest, path=MANIFEST_PATH):
+    """Writes the manifest as JSON."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(manifest, file)
+
+def admission_hashes(dataframes_list):
+    """Returns a dataframe indexed by hadm_id with the subject_id and a
+    content hash of every source row belonging to the admission, including
+    its patient's row. Row hashes are summed, wrapping around, so the hash
+    does not depend on row order.
+    """
+
+    adm, pat, diag, serv, icu = dataframes_list
+
+    def row_hashes(table, key):
+        return pd.Series(pd.util.hash_pandas_object(table, index=False)
+                         .to_numpy(), index=table[key].to_numpy())
+
+    patients = row_hashes(pat, 'subject_id')
+    patients = patients[~patients.index.duplicated()]
+    parts = [row_hashes(table, 'hadm_id') for table in [adm, diag, serv, icu]]
+    parts.append(pd.Series(patients.reindex(adm.subject_id.to_numpy(),
+                                            fill_value=0).to_numpy(),
+                           index=adm.hadm_id.to_numpy()))
+
+    hashes = pd.concat(parts).groupby(level=0).sum()
+    return pd.DataFrame({'subject_id': adm.subject_id.to_numpy(),
+                         'hash': hashes.reindex(adm.hadm_id.to_numpy())
+                                       .to_numpy()},
+                        index=pd.Index(adm.hadm_id.to_numpy(), name='hadm_id'))
+
+def affected_subjects(admissions, manifest):
+    """Returns the subject_ids with admissions that are new, changed or no
+    longer in the sources since the manifest was written.
+    """
+
+    previous = pd.DataFrame.from_dict(manifest['admissions'], orient='index',
+                                      columns=['subject_id', 'hash'])
+    previous.index = previous.index.astype(admissions.index.dtype)
+    previous = previous.astype({'subject_id': 'int64', 'hash': 'uint64'})
+
+    current = admissions.astype({'subject_id': 'int64', 'hash': 'uint64'})
+    joined = current.join(previous, how='outer', rsuffix='_previous')
+    changed = joined.hash.ne(joined.hash_previous)
+
+    return set(joined.subject_id[changed].dropna().astype(int)) | \
+        set(joined.subject_id_previous[changed].dropna().astype(int))
+
+def replace_subjects(name, updated, subjects, fmt):
+    """Replaces the rows of the given subjects in a stored stage output with
+    the updated rows, or saves the updated rows if the stage does not exist.
+    """
+
+    if os.path.exists(storage.stage_path(name, fmt)):
+        stored = storage.load_stage(name, fmt=fmt)
+        kept = stored[~stored.subject_id.isin(subjects)]
+        updated = fe.concat_categorical([kept, updated], ignore_index=True)
+
+    storage.save_stage(updated, name, fmt)
+
+def run(fmt=storage.DEFAULT_FORMAT, manifest_path=MANIFEST_PATH):
+    """Brings the raw_hospital_data and feature_engineering_data stages up to
+    date with the source files. Returns the number of patients reprocessed.
+    """
+
+    manifest = load_manifest(manifest_path)
+    sources = {file: file_fingerprint(f'{ic.SOURCE_DIR}/{file}.csv')
+               for file in ic.SOURCE_FILES}
+    if sources == manifest['sources']:
+        return 0
+
+    dataframes = ic.importing(ic.SOURCE_FILES)
+    admissions = admission_hashes(dataframes)
+    subjects = affected_subjects(admissions, manifest)
+
+    subset = [table[table.subject_id.isin(subjects)] for table in dataframes]
+    cleaned = ic.data_cleaning(ic.merging_data(subset))
+    fe_data = fe.feature_engineering(cleaned.copy())
+
+    replace_subjects('raw_hospital_data', cleaned, subjects, fmt)
+    replace_subjects('feature_engineering_data', fe_data, subjects, fmt)
+
+    manifest = {'sources': sources,
+                'admissions': {str(hadm_id): [int(subject_id), int(hash_)]
+                               for hadm_id, subject_id, hash_
+                               in zip(admissions.index, admissions.subject_id,
+                                      admissions.hash)}}
+    save_manifest(manifest, manifest_path)
+
+    return len(subjects)
+
+def main():
+    """Runs the stages incrementally and reports the patients updated."""
+
+    print(f'{run()} patients reprocessed')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+This script records per stage instrumentation of a pipeline run: wall time,
+CPU time, peak RSS growth, input and output row counts and the rows dropped
+by each filter (deaths, null details, age outliers, first visits). Stages are
+the pipeline functions marked with the instrumented decorator. A stage called
+from inside another stage is recorded with the enclosing stage as its parent,
+and its time is included in the parent's. Nothing is recorded outside of a
+run, so the decorator costs one check per call. Filter counts of stages run
+in worker processes, or served from the stage cache, are collected with
+collected_filters where the filters run and recorded into the run with
+record_filters.
+
+A run writes a JSON report and can also dump cProfile statistics of its
+slowest stage, for example:
+
+    with instrumentation.run_report(profile_path='slowest_stage.prof'):
+        ic.main()
+"""
+
+import cProfile
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import storage
+
+REPORT_PATH = os.path.join(storage.STAGE_DIR, 'run_report.json')
+
+# Report of the active run, with the stack of stages being recorded and the
+# stack of filter counts being collected by collected_filters
+_state = {'report': None, 'active': [], 'profile': None, 'collectors': []}
+
+# Filters may be recorded from the threads of a stage, such as the source
+# readers of the importing stage
+_filter_lock = threading.Lock()
+
+def n_rows(data):
+    """Returns the rows of a dataframe or matrix, the total rows of a list of
+    dataframes, the rows of the first item of a tuple such as (X, y), or
+    None for other values.
+    """
+
+    if isinstance(data, list):
+        counts = [n_rows(item) for item in data]
+        return None if None in counts else sum(counts)
+    if isinstance(data, tuple):
+        data = data[0]
+    shape = getattr(data, 'shape', ())
+    return shape[0] if len(shape) else None
+
+def _rss_mb():
+    """Returns the current resident set size in MB, where /proc provides it,
+    otherwise the peak so far.
+    """
+
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    """Returns the peak resident set size in MB since the last
+    reset_peak_rss, where /proc provides it. Otherwise returns the process
+    peak, which for a spawned process includes its parent's.
+    """
+
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def reset_peak_rss():
+    """Resets the peak resident set size to the current one where Linux
+    allows it, so that each stage measures its own peak.
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+def _cpu_secs():
+    """Returns the CPU time of this process and its finished children."""
+
+    times = os.times()
+    return times.user + times.system + times.children_user + \
+        times.children_system
+
+def record_filter(name, rows_before, rows_after):
+    """Adds the rows dropped by a filter to the stage being recorded and to
+    the counts being collected. Does nothing outside of a run and of
+    collected_filters.
+    """
+
+    dropped = int(rows_before - rows_after)
+    with _filter_lock:
+        targets = list(_state['collectors'])
+        if _state['active']:
+            targets.append(_state['active'][-1]['filters'])
+        for filters in targets:
+            filters[name] = filters.get(name, 0) + dropped
+
+def record_filters(filters):
+    """Records the rows dropped by each filter of a dictionary of counts,
+    such as collected_filters yields.
+    """
+
+    for name, dropped in filters.items():
+        record_filter(name, dropped, 0)
+
+@contextmanager
+def collected_filters():
+    """Context manager that yields a dictionary of the rows dropped by each
+    filter recorded inside it, whether or not a run is active. Counts
+    recorded in a worker process or stored with a cached stage output are
+    returned this way and recorded again with record_filters.
+    """
+
+    filters = {}
+    with _filter_lock:
+        _state['collectors'].append(filters)
+    try:
+        yield filters
+    finally:
+        with _filter_lock:
+            _state['collectors'] = [collector for collector
+                                    in _state['collectors']
+                                    if collector is not filters]
+
+def instrumented(func):
+    """Decorator that records each call of a pipeline function as a stage of
+    the active run.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _state['report'] is None:
+            return func(*args, **kwargs)
+
+        active = _state['active']
+        stage = {'stage': func.__name__,
+                 'parent': active[-1]['stage'] if active else None,
+                 'rows_in': n_rows(args[0]) if args else None,
+                 'filters': {}}
+        _state['report']['stages'].append(stage)
+
+        # Only outermost stages are profiled, as profilers cannot nest, and
+        # only they measure peak RSS, as resetting the peak inside a stage
+        # would lose the enclosing stage's peak
+        outermost = not active
+        profiler = cProfile.Profile() \
+            if _state['profile'] and outermost else None
+        active.append(stage)
+
+        if outermost:
+            reset_peak_rss()
+        rss = _rss_mb()
+        cpu = _cpu_secs()
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                result = profiler.runcall(func, *args, **kwargs)
+            else:
+                result = func(*args, **kwargs)
+        finally:
+            active.pop()
+
+        stage['wall_secs'] = time.perf_counter() - start
+        stage['cpu_secs'] = _cpu_secs() - cpu
+        stage['peak_rss_delta_mb'] = max(peak_rss_mb() - rss, 0.) \
+            if outermost else None
+        stage['rows_out'] = n_rows(result)
+
+        slowest = _state['profile']
+        if profiler is not None and (slowest['profiler'] is None or
+                                     stage['wall_secs'] > slowest['secs']):
+            slowest.update(profiler=profiler, stage=func.__name__,
+                           secs=stage['wall_secs'])
+        return result
+
+    return wrapper
+
+@contextmanager
+def run_report(report_path=REPORT_PATH, profile_path=None):
+    """Context manager that records the instrumented stages called inside
+    it and writes the JSON run report to report_path when it exits. When
+    profile_path is given every stage is profiled and the cProfile
+    statistics of the slowest are dumped there. Yields the report.
+    """
+
+    report = {'started': datetime.now().isoformat(timespec='seconds'),
+              'stages': []}
+    _state['report'] = report
+    _state['profile'] = {'profiler': None} if profile_path else None
+    start = time.perf_counter()
+
+    try:
+        yield report
+    finally:
+        report['wall_secs'] = time.perf_counter() - start
+        report['peak_rss_mb'] = peak_rss_mb()
+
+        slowest = _state['profile']
+        if slowest is not None and slowest['profiler'] is not None:
+            slowest['profiler'].dump_stats(profile_path)
+            report['profile'] = {'stage': slowest['stage'],
+                                 'path': profile_path}
+
+        _state['report'], _state['profile'] = None, None
+        _state['active'].clear()
+
+        directory = os.path.dirname(report_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(report_path, 'w') as file:
+            json.dump(report, file, indent=2)
+
+def summarize(report):
+    """Returns a one line summary of each stage in a run report."""
+
+    lines = []
+    for stage in report['stages']:
+        dropped = ', '.join(f'{name} -{rows:,}'
+                            for name, rows in stage['filters'].items())
+        name = stage['stage'] if stage['parent'] is None \
+            else f'{stage["parent"]} > {stage["stage"]}'
+        peak = stage['peak_rss_delta_mb']
+        lines.append(f'{name:>40}: {stage["wall_secs"]:.3f}s wall, '
+                     f'{stage["cpu_secs"]:.3f}s cpu, '
+                     + (f'+{peak:.0f} MB, ' if peak is not None else '')
+                     + f'{stage["rows_in"]} -> {stage["rows_out"]} rows'
+                     + (f' ({dropped})' if dropped else ''))
+    return lines
@@ -0,0 +1,81 @@
+"""
+This script drives a running scoring server (server.py) with concurrent
+prediction requests built from sampled admissions and prints the client side
+latency percentiles and throughput.
+"""
+
+import asyncio
+import json
+import time
+
+import numpy as np
+
+import sample_data
+import server
+
+async def _client(host, port, payloads, latencies):
+    """Sends each payload over one keep-alive connection in turn, recording
+    the latency of every request.
+    """
+
+    reader, writer = await asyncio.open_connection(host, port)
+
+    for payload in payloads:
+        body = json.dumps(payload).encode()
+        start = time.perf_counter()
+        writer.write(b'POST /predict HTTP/1.1\r\n'
+                     b'Content-Type: application/json\r\n' +
+                     f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+
+        status = await reader.readline()
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line == b'\r\n':
+                break
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+
+        if b' 200 ' not in status:
+            raise RuntimeError(f'Request failed: {status.decode().strip()}')
+        latencies.append(time.perf_counter() - start)
+
+    writer.close()
+    await writer.wait_closed()
+
+async def generate_load(records, host=server.HOST, port=server.PORT,
+                        concurrency=32, n_requests=5000, batch_size=1):
+    """Returns client latency percentiles in milliseconds and throughput for
+    n_requests requests of batch_size records, sent by concurrency clients.
+    """
+
+    payloads = [[records[(i * batch_size + j) % len(records)]
+                 for j in range(batch_size)] for i in range(n_requests)]
+    latencies = []
+
+    start = time.perf_counter()
+    await asyncio.gather(*[_client(host, port, payloads[i::concurrency],
+                                   latencies)
+                           for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    return {
+        'requests': n_requests,
+        'p50_ms': float(p50),
+        'p99_ms': float(p99),
+        'requests_per_s': n_requests / elapsed,
+        'admissions_per_s': n_requests * batch_size / elapsed,
+    }
+
+def main():
+    """Drives a server running on the default host and port."""
+
+    tables = sample_data.sample_source_tables(10_000)
+    records = sample_data.sample_records(tables)
+    print(asyncio.run(generate_load(records)))
+
+if __name__ == '__main__':
+    main()
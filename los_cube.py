@@ -0,0 +1,261 @@
+"""
+This script pre-aggregates the feature engineered hospital data into a cube
+of length of stay summaries for EDA and plotting. For every categorical
+feature, and for every pair of them, the cube holds one cell per category (or
+pair of categories) with the number of admissions, the LOS total, minimum and
+maximum, and an LOS histogram on fixed logarithmic bins. The histogram is the
+quantile sketch: quantiles, box plot statistics and histograms are read from
+it with a relative error under one bin width (about 5%), without loading the
+row level data.
+
+An admission counts once in each category it has. Admissions have several
+rows when they have several diagnoses, services or care units, so a two
+diagnosis admission counts in both diagnoses' cells.
+
+Cubes built on disjoint sets of admissions add cell by cell, so a cube can be
+built partition by partition and combined, for example:
+
+    cube = los_cube.build_cube(fe_data)
+    los_cube.summary(cube, 'diagnoses', by='first_careunit')
+"""
+
+import itertools
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import storage
+
+CUBE_PATH = os.path.join(storage.STAGE_DIR, 'los_cube.pkl')
+
+# LOS histogram bin edges in days, from one hour to 1,000 days. Shorter and
+# longer stays fall in the first and last bins, which are bounded by each
+# cell's minimum and maximum.
+SKETCH_EDGES = np.geomspace(1 / 24, 1000, 200)
+N_BINS = len(SKETCH_EDGES) + 1
+BIN_COLS = [f'bin_{i}' for i in range(N_BINS)]
+
+# Quantiles of each summary, which must include the quartiles for the box
+# plot whiskers
+QUANTILES = [.05, .25, .5, .75, .95]
+
+def cube_columns(data):
+    """Returns the categorical feature columns summarized by the cube."""
+
+    return list(data.select_dtypes(include=['object', 'string',
+                                            'category']).columns)
+
+def encode(data, columns):
+    """Returns the category codes and the category labels of each column."""
+
+    encoded = {}
+    for col in columns:
+        categorical = pd.Categorical(data[col])
+        encoded[col] = (categorical.codes, categorical.categories.astype(str))
+
+    return encoded
+
+def cells(encoded, columns, los, admissions):
+    """Returns the cells of one combination of the encoded columns: a
+    dataframe indexed by the categories of the columns with the admission
+    count, LOS total, minimum and maximum and the LOS histogram of each non
+    empty cell. admissions is the position of each row's admission among the
+    sorted unique hadm_ids.
+    """
+
+    codes = [encoded[col][0] for col in columns]
+    labels = [encoded[col][1] for col in columns]
+    sizes = [len(categories) for categories in labels]
+    n_cells = int(np.prod(sizes))
+    present = np.logical_and.reduce([col_codes >= 0 for col_codes in codes])
+
+    # One row per admission and combination of categories
+    cell_codes = np.ravel_multi_index([col_codes[present]
+                                       for col_codes in codes], sizes)
+    keys, first = np.unique(admissions[present].astype(np.int64) * n_cells +
+                            cell_codes, return_index=True)
+    codes = keys % n_cells
+    los = los[present][first]
+
+    bins = np.searchsorted(SKETCH_EDGES, los, side='right')
+    hist = np.bincount(codes * N_BINS + bins,
+                       minlength=n_cells * N_BINS).reshape(n_cells, N_BINS)
+
+    los_min = np.full(n_cells, np.inf)
+    los_max = np.full(n_cells, -np.inf)
+    np.minimum.at(los_min, codes, los)
+    np.maximum.at(los_max, codes, los)
+
+    index = pd.MultiIndex.from_product(labels, names=columns)
+    if len(columns) == 1:
+        index = index.get_level_values(0)
+
+    frame = pd.DataFrame(hist, index=index, columns=BIN_COLS)
+    frame.insert(0, 'count', hist.sum(axis=1))
+    frame.insert(1, 'los_sum', np.bincount(codes, los, minlength=n_cells))
+    frame.insert(2, 'los_min', los_min)
+    frame.insert(3, 'los_max', los_max)
+
+    return frame[frame['count'] > 0]
+
+@instrumentation.instrumented
+def build_cube(data, columns=None):
+    """Returns the cube of the categorical columns of the feature engineered
+    data, every column by default, and of each pair of them.
+    """
+
+    columns = columns or cube_columns(data)
+    keys = [(col,) for col in columns] + \
+        list(itertools.combinations(columns, 2))
+
+    hadm_ids, admissions = np.unique(data.hadm_id.to_numpy(),
+                                     return_inverse=True)
+    encoded = encode(data, columns)
+    los = data.los.to_numpy(float)
+
+    return {'columns': columns,
+            'n_admissions': len(hadm_ids),
+            'cells': {key: cells(encoded, key, los, admissions)
+                      for key in keys}}
+
+def combine(cubes):
+    """Returns the cube of the admissions of several cubes built on disjoint
+    sets of admissions.
+    """
+
+    combined = {}
+    for key in cubes[0]['cells']:
+        frames = [cube['cells'][key] for cube in cubes]
+        index = frames[0].index
+        for frame in frames[1:]:
+            index = index.union(frame.index)
+
+        hist = np.zeros((len(index), N_BINS), dtype=np.int64)
+        los_sum = np.zeros(len(index))
+        los_min = np.full(len(index), np.inf)
+        los_max = np.full(len(index), -np.inf)
+        for frame in frames:
+            positions = index.get_indexer(frame.index)
+            hist[positions] += frame[BIN_COLS].to_numpy()
+            los_sum[positions] += frame.los_sum.to_numpy()
+            los_min[positions] = np.fmin(los_min[positions], frame.los_min)
+            los_max[positions] = np.fmax(los_max[positions], frame.los_max)
+
+        cell = pd.DataFrame(hist, index=index, columns=BIN_COLS)
+        cell.insert(0, 'count', hist.sum(axis=1))
+        cell.insert(1, 'los_sum', los_sum)
+        cell.insert(2, 'los_min', los_min)
+        cell.insert(3, 'los_max', los_max)
+        combined[key] = cell
+
+    return {'columns': cubes[0]['columns'],
+            'n_admissions': sum(cube['n_admissions'] for cube in cubes),
+            'cells': combined}
+
+def cells_of(cube, column, by=None):
+    """Returns the cells of a column, or of a pair of columns with column as
+    the first index level.
+    """
+
+    if by is None:
+        return cube['cells'][(column,)]
+    if (column, by) in cube['cells']:
+        return cube['cells'][(column, by)]
+    return cube['cells'][(by, column)].swaplevel().sort_index()
+
+def bin_bounds(frame):
+    """Returns the lower and upper LOS bounds of each histogram bin of each
+    cell, with the open ended bins closed by the cell minimum and maximum.
+    """
+
+    lower = np.append(-np.inf, SKETCH_EDGES)
+    upper = np.append(SKETCH_EDGES, np.inf)
+    los_min = frame.los_min.to_numpy()[:, None]
+    los_max = frame.los_max.to_numpy()[:, None]
+
+    return (np.clip(lower, los_min, los_max),
+            np.clip(upper, los_min, los_max))
+
+def sketch_quantiles(frame, quantiles=QUANTILES):
+    """Returns the LOS quantiles of each cell read from its histogram, by
+    linear interpolation within the bin holding each quantile.
+    """
+
+    hist = frame[BIN_COLS].to_numpy(float)
+    lower, upper = bin_bounds(frame)
+    cumulative = hist.cumsum(axis=1)
+    rows = np.arange(len(frame))
+
+    results = {}
+    for quantile in quantiles:
+        target = quantile * cumulative[:, -1]
+        bins = np.minimum((cumulative < target[:, None]).sum(axis=1),
+                          N_BINS - 1)
+        before = cumulative[rows, bins] - hist[rows, bins]
+        within = np.divide(target - before, hist[rows, bins],
+                           out=np.zeros(len(frame)),
+                           where=hist[rows, bins] > 0)
+        results[f'q{quantile * 100:g}'] = lower[rows, bins] + \
+            within * (upper[rows, bins] - lower[rows, bins])
+
+    return pd.DataFrame(results, index=frame.index)
+
+def summary(cube, column, by=None):
+    """Returns the admission count, mean LOS, LOS quantiles and box plot
+    whiskers of each category of a column, or of each pair of categories of
+    column and by.
+    """
+
+    frame = cells_of(cube, column, by)
+    quantiles = sketch_quantiles(frame)
+
+    result = pd.DataFrame({'count': frame['count'],
+                           'mean': frame.los_sum / frame['count'],
+                           'min': frame.los_min, 'max': frame.los_max},
+                          index=frame.index).join(quantiles)
+
+    # Whiskers reach 1.5 IQR past the quartiles, within the observed range
+    iqr = result.q75 - result.q25
+    result['whislo'] = np.maximum(result.q25 - 1.5 * iqr, result['min'])
+    result['whishi'] = np.minimum(result.q75 + 1.5 * iqr, result['max'])
+
+    return result
+
+def histogram(cube, column, by=None):
+    """Returns the LOS bin edges, closed by the overall minimum and maximum,
+    and a dataframe of each category's admission count per bin.
+    """
+
+    frame = cells_of(cube, column, by)
+    edges = np.concatenate([[min(frame.los_min.min(), SKETCH_EDGES[0])],
+                            SKETCH_EDGES,
+                            [max(frame.los_max.max(), SKETCH_EDGES[-1])]])
+
+    return edges, frame[BIN_COLS].set_axis(range(N_BINS), axis=1)
+
+def save_cube(cube, path=CUBE_PATH):
+    """Pickles a cube."""
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'wb') as file:
+        pickle.dump(cube, file)
+
+def load_cube(path=CUBE_PATH):
+    """Returns a pickled cube."""
+
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+def main(fmt=storage.DEFAULT_FORMAT):
+    """Builds and saves the cube of the feature engineered hospital data."""
+
+    save_cube(build_cube(storage.load_stage('feature_engineering_data',
+                                            fmt=fmt)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+This script compares length of stay models on a single encoded design matrix.
+The feature engineered data is encoded once, the matrix is placed in shared
+memory as cross_validation.py does, and each candidate model is fit on the
+same 80/20 split in a process pool. The result is a leaderboard of out of
+sample R^2, RMSE and MAE with fit and predict latency, and the scoring
+bundle of the best model by RMSE is saved.
+
+A candidate names an estimator and its parameters, and can change the
+target to log(1 + los) or keep only training admissions within an LOS
+range, as the notebook's 0 < los <= 30 model did. Every candidate is scored
+on the same unfiltered test admissions, in days, so the leaderboard rows are
+comparable, for example:
+
+    leaderboard = model_comparison.compare_models(*models.encode(data))
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from sklearn.model_selection import train_test_split
+
+import cross_validation as cv
+import instrumentation
+import models
+import scoring
+import storage
+
+BEST_BUNDLE_PATH = 'los_model_best_bundle.pkl'
+TEST_SIZE = .2
+RANDOM_STATE = 10
+LOS_RANGE = (0, 30)
+
+ESTIMATORS = {
+    **cv.ESTIMATORS,
+    'gradient_boosting': GradientBoostingRegressor,
+}
+
+def candidate(name, estimator, target='los', los_range=None, **params):
+    """Returns a candidate model: an estimator from ESTIMATORS with its
+    parameters, fit on the 'los' or 'log_los' target and on the training
+    admissions with low < los <= high when los_range is given.
+    """
+
+    return {'name': name, 'estimator': estimator, 'params': params,
+            'target': target, 'los_range': los_range}
+
+CANDIDATES = [
+    candidate('linear', 'linear'),
+    candidate('ridge', 'ridge', alpha=1),
+    candidate('lasso', 'lasso', alpha=.01),
+    candidate('gradient_boosting', 'gradient_boosting',
+              random_state=RANDOM_STATE),
+    candidate('linear_log_los', 'linear', target='log_los'),
+    candidate('linear_los_0_30', 'linear', los_range=LOS_RANGE),
+]
+
+def training_target(y, target):
+    """Returns the target a model is fit on. Negative stays are clipped to
+    zero before taking log(1 + los).
+    """
+
+    if target == 'log_los':
+        return np.log1p(np.clip(y, 0, None))
+    return y
+
+def predicted_los(predicted, target):
+    """Returns the predictions of a model in days."""
+
+    if target == 'log_los':
+        return np.expm1(predicted)
+    return predicted
+
+def _run_candidate(model):
+    """Fits one candidate model on the shared training admissions and
+    returns its scores on the test admissions, with the fitted estimator.
+    """
+
+    X, y = cv.shared('X'), cv.shared('y')
+    train, test = cv.shared('train'), cv.shared('test')
+
+    if model['los_range'] is not None:
+        low, high = model['los_range']
+        train = train[(y[train] > low) & (y[train] <= high)]
+    X_train, X_test = X[train], X[test]
+
+    estimator = ESTIMATORS[model['estimator']](**model['params'])
+    start = time.perf_counter()
+    estimator.fit(X_train, training_target(y[train], model['target']))
+    fit_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predicted = predicted_los(estimator.predict(X_test), model['target'])
+    predict_secs = time.perf_counter() - start
+
+    return {
+        'model': model['name'],
+        'r2': r2_score(y[test], predicted),
+        'rmse': np.sqrt(mean_squared_error(y[test], predicted)),
+        'mae': mean_absolute_error(y[test], predicted),
+        'fit_secs': fit_secs,
+        'predict_secs': predict_secs,
+        'predict_us_per_row': predict_secs / len(test) * 1e6,
+        'n_train': len(train),
+    }, estimator
+
+@instrumentation.instrumented
+def compare_models(X, y, vocabulary, numeric_cols, candidates=None,
+                   n_jobs=None, bundle_path=BEST_BUNDLE_PATH,
+                   test_size=TEST_SIZE, random_state=RANDOM_STATE):
+    """Fits every candidate model on the encoded design matrix and returns
+    the leaderboard, best out of sample RMSE first. Candidates run on n_jobs
+    processes, defaulting to one per core. The scoring bundle of the best
+    model is saved to bundle_path.
+    """
+
+    candidates = candidates or CANDIDATES
+    X = sparse.csr_matrix(X)
+    y = np.asarray(y, dtype=float)
+    train, test = train_test_split(np.arange(X.shape[0]), test_size=test_size,
+                                   random_state=random_state)
+    arrays = {'data': X.data, 'indices': X.indices, 'indptr': X.indptr,
+              'y': y, 'train': train, 'test': test}
+
+    with cv.shared_pool(arrays, X.shape, n_jobs) as pool:
+        results = pool.map(_run_candidate, candidates, chunksize=1)
+
+    scores, estimators = zip(*results)
+    leaderboard = pd.DataFrame(list(scores))
+    best = int(leaderboard.rmse.idxmin())
+    scoring.save_bundle(scoring.make_bundle(estimators[best], vocabulary,
+                                            numeric_cols,
+                                            candidates[best]['target']),
+                        bundle_path)
+
+    return leaderboard.sort_values('rmse').reset_index(drop=True)
+
+def main(fmt=storage.DEFAULT_FORMAT):
+    """Loads the feature engineered hospital data, encodes it once and prints
+    the leaderboard of the candidate models.
+    """
+
+    hospital_data = storage.load_stage('feature_engineering_data', fmt=fmt)
+    print(compare_models(*models.encode(hospital_data)).to_string(index=False))
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 """This script implements the final linear regression model for predicting a
 patients length of stay in the hospital. Additional testing and cross
 validation was performed separately and can be accessed in the notebook file.
+Cross validation and regularization sweeps run from cross_validation.py.
+scikit-learn is imported only when a model is fit, so encoding admissions
+does not pay for loading it.
 """
 
 import pickle
@@ -8,10 +11,15 @@ import pickle
 import pandas as pd
 import numpy as np
 
-from sklearn.metrics import mean_squared_error, mean_absolute_error
-from sklearn.linear_model import LinearRegression
-from sklearn.model_selection import train_test_split
+from scipy import sparse
 
+import instrumentation
+import scoring
+import stage_cache
+import storage
+
+@instrumentation.instrumented
+@stage_cache.cached()
 def dummy_cat_cols(data):
     """Returns a dataframe with one hot encoded categorical columns and rows
     grouped by by admission event (hadm_id). Each admission event is therefore
@@ -20,7 +28,8 @@ def dummy_cat_cols(data):
     Following grouping, subject_id and hadm_id which are no longer needed."""
 
     # One hot encoding
-    cat_cols = [col for col in data.columns if data[col].dtype == 'O']
+    cat_cols = data.select_dtypes(include=['object', 'string',
+                                           'category']).columns
     dummied_data = pd.get_dummies(data, drop_first=True, columns=cat_cols)
 
     # Group by admission event
@@ -29,25 +38,122 @@ def dummy_cat_cols(data):
 
     return select_data
 
-def splitting_test_and_train(data):
-    """Returns 80/20 train and test sets for model implementation."""
+def fit_vocabulary(data):
+    """Returns the one hot encoding vocabulary as a dictionary of each
+    categorical column to the categories that get a feature column. As with
+    pd.get_dummies(drop_first=True), the first sorted category of each column
+    is the baseline and has no column.
+    """
 
-    X, y = data.drop('los', axis=1), data['los']
+    vocabulary = {}
+    for col in data.select_dtypes(include=['object', 'string',
+                                           'category']).columns:
+        categories = np.sort(data[col].dropna().astype(str).unique())
+        vocabulary[col] = list(categories[1:])
 
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=.2,
-                                                        random_state=10)
+    return vocabulary
 
-    return X_train, X_test, y_train, y_test
+def numeric_feature_cols(data):
+    """Returns the numeric columns other than the ids and the target."""
 
+    return [col for col in data.select_dtypes(include=['number']).columns
+            if col not in storage.ID_COLS + ['los']]
 
+def feature_names(data, vocabulary):
+    """Returns the design matrix column names, matching pd.get_dummies."""
 
-def final_model_linreg(data):
+    names = numeric_feature_cols(data)
+    for col, categories in vocabulary.items():
+        names.extend(f'{col}_{category}' for category in categories)
+
+    return names
+
+def sparse_dummies(data, vocabulary):
+    """Returns a CSR matrix with one row per dataframe row and a column per
+    vocabulary category. Values outside the vocabulary encode as all zeros.
+    """
+
+    codes = np.empty((len(data), len(vocabulary)), dtype=np.int32)
+    offset = 0
+
+    for i, (col, categories) in enumerate(vocabulary.items()):
+        categorical = pd.Categorical(data[col])
+        lookup = pd.Index(categories).get_indexer(
+            categorical.categories.astype(str))
+        lookup = np.where(lookup >= 0, lookup + offset, -1)
+        # Code -1 marks a missing value, which picks up the trailing -1
+        codes[:, i] = np.append(lookup, -1)[categorical.codes]
+        offset += len(categories)
+
+    # Each row holds at most one column per vocabulary entry, in order
+    present = codes >= 0
+    indptr = np.append(0, np.cumsum(present.sum(axis=1)))
+    indices = codes[present]
+
+    return sparse.csr_matrix((np.ones(len(indices), dtype=np.int8), indices,
+                              indptr), shape=(len(data), offset))
+
+def sparse_group_max(matrix, groups):
+    """Returns the rows of a 0/1 CSR matrix combined per group with a logical
+    OR, the sparse equivalent of a groupby max, along with the sorted group
+    keys.
+    """
+
+    keys, inverse = np.unique(groups, return_inverse=True)
+    n_cols = matrix.shape[1]
+
+    # Unique (group, column) pairs, sorted by group then column
+    rows = np.repeat(inverse.astype(np.int64), np.diff(matrix.indptr))
+    pairs = np.unique(rows * n_cols + matrix.indices)
+    rows, cols = np.divmod(pairs, n_cols)
+
+    indptr = np.searchsorted(rows, np.arange(len(keys) + 1))
+    grouped = sparse.csr_matrix((np.ones(len(pairs)), cols.astype(np.int32),
+                                 indptr), shape=(len(keys), n_cols))
+    return grouped, keys
+
+@instrumentation.instrumented
+def sparse_design_matrix(data, vocabulary):
+    """Returns the CSR design matrix and los target with one row per
+    admission event (hadm_id), the sparse equivalent of dummy_cat_cols.
+    Numeric features take their maximum per admission.
+    """
+
+    dummies, _ = sparse_group_max(sparse_dummies(data, vocabulary),
+                                  data.hadm_id.to_numpy())
+
+    numeric_cols = numeric_feature_cols(data)
+    numeric = data.groupby('hadm_id')[numeric_cols + ['los']].max()
+
+    X = sparse.hstack([sparse.csr_matrix(numeric[numeric_cols].to_numpy(float)),
+                       dummies], format='csr')
+    return X, numeric.los.to_numpy()
+
+@instrumentation.instrumented
+def encode(data):
+    """Returns the sparse design matrix and los target of the feature
+    engineered data, along with the vocabulary and numeric columns a scoring
+    bundle needs to encode new admissions the same way.
+    """
+
+    vocabulary = fit_vocabulary(data)
+    X, y = sparse_design_matrix(data, vocabulary)
+
+    return X, y, vocabulary, numeric_feature_cols(data)
+
+@instrumentation.instrumented
+def fit_linreg(X, y, vocabulary, numeric_cols):
     """Runs linear regression for final model implementation on holdout
-    dataset. Prints in-sample and out of sampel R^2, RMSE, and MAE. Pickles
-    the model."""
+    dataset, fit on an encoded design matrix. Prints in-sample and out of
+    sampel R^2, RMSE, and MAE. Pickles the model along with a scoring bundle
+    for predict_los and returns the model."""
 
-    dummied_data = dummy_cat_cols(data)
-    X_train, X_test, y_train, y_test = splitting_test_and_train(dummied_data)
+    from sklearn.linear_model import LinearRegression
+    from sklearn.metrics import mean_absolute_error, mean_squared_error
+    from sklearn.model_selection import train_test_split
+
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=.2,
+                                                        random_state=10)
 
     #defining simple linear regression
     lm = LinearRegression()
@@ -71,13 +177,26 @@ def final_model_linreg(data):
     print('\nIn sample linear regression mae: ', in_mae, '\n')
 
     pickle.dump(lm, open('los_model.pkl', 'wb'))
+    scoring.save_bundle(scoring.make_bundle(lm, vocabulary, numeric_cols))
+
+    return lm
+
+@instrumentation.instrumented
+def final_model_linreg(data):
+    """Runs linear regression for final model implementation on holdout
+    dataset, fit on the sparse one hot design matrix. Prints in-sample and
+    out of sampel R^2, RMSE, and MAE. Pickles the model along with a scoring
+    bundle for predict_los."""
+
+    fit_linreg(*encode(data))
 
-def main():
+def main(fmt=storage.DEFAULT_FORMAT):
     """Loads cleaned and feature engineered hospital dataframe and predicts
     a patient's lengh of stay in the hospital.
     """
 
-    hospital_data = pd.read_csv('data/feature_engineering_data.csv')
+    hospital_data = storage.load_stage('feature_engineering_data', fmt=fmt)
     final_model_linreg(hospital_data)
 
-main()
+if __name__ == '__main__':
+    main()
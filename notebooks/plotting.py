@@ -66,3 +66,76 @@ def lineplots(x, y, title, xaxis, yaxis, save=False, rotate=False):
     if save:
         plt.savefig(title + '.png')
     return 
+
+# Helpers rendering from the pre-aggregated LOS cube summaries of los_cube.py
+# instead of the row level data
+
+def cube_labels(index):
+    return [' / '.join(map(str, label)) if isinstance(label, tuple) else
+            str(label) for label in index]
+
+def cube_hist_plots(summary, title, xaxis, yaxis, order=None, save=False,
+                    rotate=False):
+
+    summary = summary.loc[order] if order is not None else summary
+    plt.figure(figsize=(10,5))
+    plt.bar(cube_labels(summary.index), summary['count'],
+            color=bidmc_deep_blue)
+
+    plt.title(title, fontsize=18)
+    plt.ylabel(xaxis, fontsize=14)
+    plt.xlabel(yaxis, fontsize=14);
+
+    if rotate:
+        plt.xticks(rotation=45, ha='right')
+
+    if save:
+        plt.savefig(title + '.png')
+    return
+
+def cube_boxplots(summary, title, xaxis, yaxis, order=None, save=False,
+                  rotate=False):
+
+    summary = summary.loc[order] if order is not None else summary
+    stats = [{'label': label, 'med': row.q50, 'q1': row.q25, 'q3': row.q75,
+              'whislo': row.whislo, 'whishi': row.whishi, 'fliers': []}
+             for label, row in zip(cube_labels(summary.index),
+                                   summary.itertuples())]
+
+    plt.figure(figsize=(10,5))
+    ax = plt.gca()
+    # Listed top down, as seaborn orders the categories of a horizontal plot
+    ax.bxp(stats[::-1], vert=False, showfliers=False, patch_artist=True,
+           boxprops={'facecolor': 'white'}, medianprops={'color': 'black'});
+
+    ax.set_title(title, fontsize=18)
+    ax.set_ylabel(xaxis, fontsize=14)
+    ax.set_xlabel(yaxis, fontsize=14);
+    sns.despine()
+
+    if rotate:
+        plt.xticks(rotation=45, ha='right')
+
+    if save:
+        plt.savefig(title + '.png')
+    return
+
+def cube_los_hist_plots(edges, counts, title, xaxis, yaxis, save=False,
+                        rotate=False):
+
+    plt.figure(figsize=(10,5))
+    for label, row in zip(cube_labels(counts.index), counts.to_numpy()):
+        plt.stairs(row, edges, label=label)
+    plt.xscale('log')
+    plt.legend()
+
+    plt.title(title, fontsize=18)
+    plt.ylabel(xaxis, fontsize=14)
+    plt.xlabel(yaxis, fontsize=14);
+
+    if rotate:
+        plt.xticks(rotation=45, ha='right')
+
+    if save:
+        plt.savefig(title + '.png')
+    return
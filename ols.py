@@ -0,0 +1,181 @@
+"""
+This script fits the length of stay regression by ordinary least squares from
+sufficient statistics. X'X, X'y, y'y and the row count are accumulated chunk
+by chunk, so training can stream over admissions that do not fit in memory,
+and coefficients, standard errors and p-values are solved from the
+statistics alone. Saved statistics are updated with new admissions without
+reprocessing history, and cross validation folds are scored by subtracting
+each fold's statistics from the total.
+"""
+
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from scipy import sparse, stats
+from sklearn.model_selection import KFold
+
+import models
+import storage
+
+STATS_PATH = 'ols_statistics.pkl'
+
+class OLSStatistics:
+    """Sufficient statistics for an OLS fit with an intercept. Statistics of
+    disjoint sets of rows add, and subtracting removes rows.
+    """
+
+    def __init__(self, n_features):
+        self.n = 0
+        self.xtx = np.zeros((n_features + 1, n_features + 1))
+        self.xty = np.zeros(n_features + 1)
+        self.yty = 0.
+
+    @classmethod
+    def from_data(cls, X, y):
+        """Returns the statistics of a design matrix and target."""
+
+        return cls(X.shape[1]).update(X, y)
+
+    def update(self, X, y):
+        """Adds the rows of a design matrix chunk and target to the
+        statistics and returns them.
+        """
+
+        X = sparse.hstack([np.ones((X.shape[0], 1)), X], format='csr')
+        y = np.asarray(y, dtype=float)
+
+        self.n += X.shape[0]
+        self.xtx += (X.T @ X).toarray()
+        self.xty += X.T @ y
+        self.yty += y @ y
+        return self
+
+    def _combine(self, other, sign):
+        combined = OLSStatistics(len(self.xty) - 1)
+        combined.n = self.n + sign * other.n
+        combined.xtx = self.xtx + sign * other.xtx
+        combined.xty = self.xty + sign * other.xty
+        combined.yty = self.yty + sign * other.yty
+        return combined
+
+    def __add__(self, other):
+        return self._combine(other, 1)
+
+    def __sub__(self, other):
+        return self._combine(other, -1)
+
+    def solve(self):
+        """Returns the coefficients, intercept first. Collinear features get
+        the minimum norm solution.
+        """
+
+        return np.linalg.pinv(self.xtx) @ self.xty
+
+    def sse(self, coef):
+        """Returns the sum of squared errors of coefficients on these rows."""
+
+        return self.yty - 2 * coef @ self.xty + coef @ self.xtx @ coef
+
+    def score(self, coef):
+        """Returns the R^2 and RMSE of coefficients on these rows."""
+
+        sse = self.sse(coef)
+        total = self.yty - self.xty[0] ** 2 / self.n
+        return {'r2': 1 - sse / total, 'rmse': np.sqrt(sse / self.n)}
+
+    def summary(self, feature_names=None):
+        """Returns a dataframe with the coefficient, standard error, t
+        statistic and p-value of the intercept and each feature.
+        """
+
+        xtx_inv = np.linalg.pinv(self.xtx)
+        coef = xtx_inv @ self.xty
+        dof = self.n - np.linalg.matrix_rank(self.xtx)
+
+        std_err = np.sqrt(self.sse(coef) / dof * np.diag(xtx_inv))
+        t_stat = coef / std_err
+        names = ['intercept'] + list(feature_names or
+                                     range(len(coef) - 1))
+
+        return pd.DataFrame({'coef': coef, 'std_err': std_err,
+                             't': t_stat,
+                             'p_value': 2 * stats.t.sf(np.abs(t_stat), dof)},
+                            index=names)
+
+def stream_statistics(frames, vocabulary):
+    """Returns the statistics accumulated over an iterable of feature
+    engineered dataframes, encoded with a fixed vocabulary. Each dataframe
+    must hold every row of the admissions it contains, for example one
+    month of admissions.
+    """
+
+    statistics = None
+    for data in frames:
+        X, y = models.sparse_design_matrix(data, vocabulary)
+        if statistics is None:
+            statistics = OLSStatistics(X.shape[1])
+        statistics.update(X, y)
+
+    return statistics
+
+def cross_validate(X, y, n_folds=10, random_state=10):
+    """Returns the out of fold R^2 and RMSE of each fold. The statistics of
+    each fold are computed once and each fold is fit on the total minus its
+    own statistics.
+    """
+
+    splits = KFold(n_folds, shuffle=True, random_state=random_state)
+    folds = [OLSStatistics.from_data(X[test], y[test])
+             for _, test in splits.split(np.arange(X.shape[0]))]
+    total = sum(folds[1:], folds[0])
+
+    results = []
+    for i, fold in enumerate(folds):
+        coef = (total - fold).solve()
+        results.append(dict(fold=i, **fold.score(coef)))
+
+    return pd.DataFrame(results)
+
+def save_statistics(statistics, vocabulary, path=STATS_PATH):
+    """Pickles the statistics with the vocabulary used to encode them."""
+
+    with open(path, 'wb') as file:
+        pickle.dump({'statistics': statistics, 'vocabulary': vocabulary}, file)
+
+def load_statistics(path=STATS_PATH):
+    """Returns the pickled statistics and vocabulary."""
+
+    with open(path, 'rb') as file:
+        saved = pickle.load(file)
+    return saved['statistics'], saved['vocabulary']
+
+def update_model(new_data, path=STATS_PATH):
+    """Adds newly arrived feature engineered admissions to the saved
+    statistics and returns the refit coefficient summary. Categories outside
+    the saved vocabulary encode as the baseline.
+    """
+
+    statistics, vocabulary = load_statistics(path)
+    statistics = stream_statistics([new_data], vocabulary) + statistics
+    save_statistics(statistics, vocabulary, path)
+
+    return statistics.summary(models.feature_names(new_data, vocabulary))
+
+def main(fmt=storage.DEFAULT_FORMAT):
+    """Fits the model on the feature engineered hospital data, saves the
+    statistics and prints the coefficient summary.
+    """
+
+    hospital_data = storage.load_stage('feature_engineering_data', fmt=fmt)
+    vocabulary = models.fit_vocabulary(hospital_data)
+
+    statistics = stream_statistics([hospital_data], vocabulary)
+    save_statistics(statistics, vocabulary)
+
+    names = models.feature_names(hospital_data, vocabulary)
+    print(statistics.summary(names).to_string())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""
+This script runs the whole pipeline out of core, within a memory budget. The
+admissions, diagnoses, services and icustays sources are streamed in chunks
+and spilled to local disk in hadm_id range partitions, so every row of an
+admission lands in the same partition. Each partition is then merged,
+cleaned and feature engineered on its own and spilled again, and the model
+is fit by streaming the feature engineered partitions into the OLS
+sufficient statistics of ols.py. The LOS cube of los_cube.py is built on
+batches of partitions and combined. Only one partition is held in memory at a
+time, along with the patients table and a list of admission keys, which have
+one small row per patient and per admission.
+
+First visits depend on all of a patient's admissions, which can fall in
+different partitions. They are selected from the admission keys of every
+merged partition before the partitions are cleaned, so the result is the
+same as an in memory run.
+
+The number of partitions and the chunk size are planned from the size of the
+source files so that the data held by the run stays under the budget; the
+interpreter and the libraries it loads are not counted.
+"""
+
+import math
+import os
+import shutil
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+import feature_engineering as fe
+import importing_and_cleaning_data as ic
+import instrumentation
+import los_cube
+import scoring
+import storage
+
+SPILL_DIR = os.path.join(storage.STAGE_DIR, 'out_of_core')
+MEMORY_BUDGET_MB = 1024
+
+# Sources spilled in hadm_id range partitions, the others are read whole
+PARTITIONED_FILES = ['admissions_data', 'diagnoses_icd_data', 'services_data',
+                     'icustays']
+
+# Memory taken by the csv parser and parquet buffers whatever the data size,
+# the peak memory of a partition through merging, cleaning, feature
+# engineering and encoding per byte of source csv it holds, the memory of
+# the tables read whole per byte of source csv, the memory of the admission
+# keys and first visit ids held across partitions per byte of admissions csv
+# (0.32 at the peak of first visit selection), and the peak memory per row
+# of a chunk being read and of a batch of feature engineered rows being
+# summarized into the LOS cube, measured on the synthetic sources
+OVERHEAD_MB = 96
+PEAK_BYTES_PER_SOURCE_BYTE = 8
+WHOLE_BYTES_PER_SOURCE_BYTE = 1
+KEY_BYTES_PER_ADMISSION_BYTE = .5
+READ_BYTES_PER_ROW = 1000
+CUBE_BYTES_PER_ROW = 128
+
+def plan_partitions(memory_budget_mb=MEMORY_BUDGET_MB,
+                    directory=ic.SOURCE_DIR):
+    """Returns the number of hadm_id partitions and the chunk size that keep
+    a run over the sources in the directory within the memory budget. The
+    fixed overhead, the tables read whole and the admission keys held across
+    partitions are taken from the budget before the partitions are sized.
+    Raises a ValueError if the budget cannot hold them.
+    """
+
+    partitioned = sum(os.path.getsize(f'{directory}/{file}.csv')
+                      for file in PARTITIONED_FILES)
+    whole = sum(os.path.getsize(f'{directory}/{file}.csv')
+                for file in ic.SOURCE_FILES if file not in PARTITIONED_FILES)
+    admissions = os.path.getsize(f'{directory}/admissions_data.csv')
+
+    available = (memory_budget_mb - OVERHEAD_MB) * 2**20 - \
+        whole * WHOLE_BYTES_PER_SOURCE_BYTE - \
+        admissions * KEY_BYTES_PER_ADMISSION_BYTE
+    if available <= 0:
+        raise ValueError(f'A memory budget of {memory_budget_mb} MB is too '
+                         f'small for the sources in {directory}')
+
+    n_partitions = math.ceil(partitioned * PEAK_BYTES_PER_SOURCE_BYTE /
+                             available)
+    chunksize = min(ic.CHUNK_SIZE, int(available // READ_BYTES_PER_ROW))
+    return max(n_partitions, 1), chunksize
+
+def hadm_id_bounds(chunksize, directory=ic.SOURCE_DIR):
+    """Returns the smallest and largest hadm_id of the admissions."""
+
+    lows, highs = [], []
+    for chunk in ic.read_chunks('admissions_data', chunksize, directory):
+        if len(chunk):
+            lows.append(chunk.hadm_id.min())
+            highs.append(chunk.hadm_id.max())
+
+    return (int(min(lows)), int(max(highs))) if lows else (0, 0)
+
+def partition_of(hadm_ids, bounds, n_partitions):
+    """Returns the partition of each hadm_id, from equal width ranges of the
+    admission hadm_ids. Rows of admissions outside the range, which have no
+    admission to join, go to the nearest partition.
+    """
+
+    low, high = bounds
+    width = (high - low + 1) / n_partitions
+    partitions = (np.asarray(hadm_ids, dtype=np.int64) - low) // width
+    return np.clip(partitions, 0, n_partitions - 1).astype(np.int64)
+
+def partition_dir(spill_dir, name, partition):
+    """Returns the directory holding the chunks of a spilled partition."""
+
+    return os.path.join(spill_dir, name, f'part_{partition:04d}')
+
+def spill(data, spill_dir, name, partition, chunk, fmt):
+    """Writes one chunk of a partition to disk."""
+
+    storage.save_stage(data, f'chunk_{chunk:05d}', fmt,
+                       partition_dir(spill_dir, name, partition))
+
+def load_partition(spill_dir, name, partition, fmt):
+    """Returns the spilled chunks of a partition as a single dataframe, or
+    the empty schema of the spilled table when the partition has no rows.
+    """
+
+    directory = partition_dir(spill_dir, name, partition)
+    extension = storage.FORMATS[fmt][0]
+    chunks = sorted(file[:-len(extension)] for file in os.listdir(directory)) \
+        if os.path.isdir(directory) else []
+
+    if not chunks:
+        return storage.load_stage('schema', fmt=fmt,
+                                  directory=os.path.join(spill_dir, name))
+    return fe.concat_categorical([storage.load_stage(chunk, fmt=fmt,
+                                                     directory=directory)
+                                  for chunk in chunks], ignore_index=True)
+
+@instrumentation.instrumented
+def spill_sources(n_partitions, chunksize, spill_dir,
+                  directory=ic.SOURCE_DIR, fmt=storage.DEFAULT_FORMAT):
+    """Streams the partitioned source files into hadm_id range partitions on
+    disk and returns the patients table.
+    """
+
+    bounds = hadm_id_bounds(chunksize, directory)
+    for file in PARTITIONED_FILES:
+        for i, chunk in enumerate(ic.read_chunks(file, chunksize, directory)):
+            if i == 0:
+                storage.save_stage(chunk.iloc[:0], 'schema', fmt,
+                                   os.path.join(spill_dir, file))
+            partitions = partition_of(chunk.hadm_id, bounds, n_partitions)
+            for partition in np.unique(partitions):
+                spill(chunk[partitions == partition], spill_dir, file,
+                      partition, i, fmt)
+
+    return ic.read_source('patient_data', chunksize, directory)
+
+@instrumentation.instrumented
+def merge_partitions(patients, n_partitions, spill_dir,
+                     fmt=storage.DEFAULT_FORMAT):
+    """Merges each partition of the spilled sources with the patients and
+    spills the merged partitions. Returns the subject_id, hadm_id and
+    admittime of every admission with complete rows.
+    """
+
+    keys = []
+    for partition in range(n_partitions):
+        tables = [patients if file not in PARTITIONED_FILES else
+                  load_partition(spill_dir, file, partition, fmt)
+                  for file in ic.SOURCE_FILES]
+        merged = ic.merging_data(tables)
+        del tables
+
+        spill(merged, spill_dir, 'merged', partition, 0, fmt)
+        keys.append(merged.loc[ic.complete_rows(merged),
+                               ['subject_id', 'hadm_id', 'admittime']]
+                          .drop_duplicates('hadm_id'))
+
+    return pd.concat(keys, ignore_index=True)
+
+def first_visit_ids(keys):
+    """Returns the sorted hadm_ids of each patient's first admission."""
+
+    first_visit = ic.first_visit_mask(keys, np.ones(len(keys), dtype=bool))
+    return np.sort(keys.hadm_id.to_numpy()[first_visit])
+
+@instrumentation.instrumented
+def engineer_partitions(first_hadm_ids, n_partitions, spill_dir,
+                        fmt=storage.DEFAULT_FORMAT):
+    """Cleans and feature engineers the first visits of each merged
+    partition and spills the results. Returns the values found in each
+    categorical column, for the one hot vocabulary.
+    """
+
+    values = {}
+    for partition in range(n_partitions):
+        merged = load_partition(spill_dir, 'merged', partition, fmt)
+        first_visit = np.isin(merged.hadm_id.to_numpy(), first_hadm_ids,
+                              assume_unique=False)
+        instrumentation.record_filter('first_visit', len(merged),
+                                      first_visit.sum())
+
+        cleaned = ic.data_cleaning(merged[first_visit])
+        del merged
+        fe_data = fe.feature_engineering(cleaned)
+        spill(fe_data, spill_dir, 'features', partition, 0, fmt)
+
+        for col in fe_data.select_dtypes(include=['object', 'string',
+                                                  'category']):
+            values.setdefault(col, set()).update(
+                fe_data[col].dropna().astype(str).unique())
+
+    return values
+
+@instrumentation.instrumented
+def cube_partitions(n_partitions, batch_rows, spill_dir,
+                    fmt=storage.DEFAULT_FORMAT):
+    """Returns the LOS cube of the feature engineered partitions. Partitions
+    are gathered into batches of about batch_rows rows, and the cube of each
+    batch is combined with the cube of the batches before it.
+    """
+
+    cube, batch, rows = None, [], 0
+    for partition in range(n_partitions):
+        data = load_partition(spill_dir, 'features', partition, fmt)
+        batch.append(data[['hadm_id', 'los', *los_cube.cube_columns(data)]])
+        rows += len(data)
+        del data
+
+        if rows >= batch_rows or partition == n_partitions - 1:
+            batch_cube = los_cube.build_cube(
+                fe.concat_categorical(batch, ignore_index=True))
+            cube = batch_cube if cube is None else \
+                los_cube.combine([cube, batch_cube])
+            batch, rows = [], 0
+
+    return cube
+
+def vocabulary_from_values(values):
+    """Returns the one hot vocabulary of the categorical values, as
+    models.fit_vocabulary returns for a dataframe holding them.
+    """
+
+    return {col: sorted(found)[1:] for col, found in values.items()}
+
+@instrumentation.instrumented
+def fit_streaming(vocabulary, n_partitions, spill_dir,
+                  fmt=storage.DEFAULT_FORMAT):
+    """Fits the model on the feature engineered partitions, streamed from
+    disk one at a time, and saves the statistics and a scoring bundle.
+    Returns the coefficient summary.
+    """
+
+    import models
+    import ols
+
+    statistics = ols.stream_statistics(
+        (load_partition(spill_dir, 'features', partition, fmt)
+         for partition in range(n_partitions)), vocabulary)
+    ols.save_statistics(statistics, vocabulary)
+
+    schema = load_partition(spill_dir, 'features', 0, fmt).iloc[:0]
+    coef = statistics.solve()
+    model = SimpleNamespace(coef_=coef[1:], intercept_=coef[0])
+    scoring.save_bundle(scoring.make_bundle(
+        model, vocabulary, models.numeric_feature_cols(schema)))
+
+    return statistics.summary(models.feature_names(schema, vocabulary))
+
+def run(memory_budget_mb=MEMORY_BUDGET_MB, directory=ic.SOURCE_DIR,
+        spill_dir=SPILL_DIR, fmt=storage.DEFAULT_FORMAT, keep_spill=False):
+    """Runs the pipeline within the memory budget, saves the LOS cube and
+    returns the model coefficient summary. The spilled partitions are removed afterwards
+    unless keep_spill is set.
+    """
+
+    n_partitions, chunksize = plan_partitions(memory_budget_mb, directory)
+    if os.path.exists(spill_dir):
+        shutil.rmtree(spill_dir)
+
+    try:
+        patients = spill_sources(n_partitions, chunksize, spill_dir,
+                                 directory, fmt)
+        keys = merge_partitions(patients, n_partitions, spill_dir, fmt)
+        del patients
+
+        values = engineer_partitions(first_visit_ids(keys), n_partitions,
+                                     spill_dir, fmt)
+        del keys
+
+        batch_rows = chunksize * READ_BYTES_PER_ROW // CUBE_BYTES_PER_ROW
+        los_cube.save_cube(cube_partitions(n_partitions, batch_rows,
+                                           spill_dir, fmt))
+
+        return fit_streaming(vocabulary_from_values(values), n_partitions,
+                             spill_dir, fmt)
+    finally:
+        if not keep_spill:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+def main(memory_budget_mb=MEMORY_BUDGET_MB):
+    """Runs the pipeline out of core and prints the coefficient summary."""
+
+    print(run(memory_budget_mb).to_string())
+
+if __name__ == '__main__':
+    main()
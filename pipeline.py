@@ -0,0 +1,320 @@
+"""
+This script is the single command line entry point of the length of stay
+pipeline. The pipeline is a DAG of stages:
+
+    import -> merge -> clean -> feature_engineering -> encode -> fit
+                                                              -> compare
+                                                    -> cube
+
+Each stage runs once its dependencies have, and the stages in between --from
+and --until are run; the outputs of the stages before --from are loaded from
+the checkpoints an earlier run saved. The clean and feature engineering
+stages always save their stage files, as the individual scripts did, the
+cube stage saves the LOS summary cube of los_cube.py for plotting, the
+compare stage fits the candidate models of model_comparison.py on the same
+encoded matrix as the fit stage and saves the best one's bundle, and the last
+stage run saves its checkpoint so a later run can continue from it, for
+example:
+
+    python pipeline.py --until clean
+    python pipeline.py --from feature_engineering --jobs 4 --report
+    python pipeline.py --from compare --jobs 4
+
+The source files are loaded concurrently on a thread pool and scikit-learn is
+only imported when the fit or compare stage runs. With --memory-budget every
+stage runs out of core instead, see out_of_core.py.
+"""
+
+import argparse
+import os
+import pickle
+
+import feature_engineering as fe
+import importing_and_cleaning_data as ic
+import instrumentation
+import los_cube
+import out_of_core
+import stage_cache
+import storage
+
+ENCODED_PATH = os.path.join(storage.STAGE_DIR, 'encoded_hospital_data.pkl')
+
+def run_import(options):
+    """Returns the source dataframes, read concurrently."""
+
+    return ic.importing(ic.SOURCE_FILES, directory=options['source_dir'],
+                        n_threads=options['threads'])
+
+def save_sources(dataframes, options):
+    """Saves each source dataframe as a stage file."""
+
+    for file, data in zip(ic.SOURCE_FILES, dataframes):
+        storage.save_stage(data, f'source_{file}', options['fmt'])
+
+def load_sources(options):
+    """Returns the source dataframes saved by save_sources."""
+
+    return [storage.load_stage(f'source_{file}', fmt=options['fmt'])
+            for file in ic.SOURCE_FILES]
+
+def run_feature_engineering(data, options):
+    """Returns the cleaned data with feature engineering applied, partitioned
+    across processes when more than one job is asked for."""
+
+    if options['jobs'] == 1:
+        return fe.feature_engineering(data)
+    return fe.partitioned_feature_engineering(data, options['jobs'])
+
+def run_encode(data, options):
+    """Returns the design matrix, target, vocabulary and numeric columns."""
+
+    import models
+
+    return models.encode(data)
+
+def save_encoded(encoded, options):
+    """Pickles the output of the encode stage."""
+
+    os.makedirs(os.path.dirname(ENCODED_PATH), exist_ok=True)
+    with open(ENCODED_PATH, 'wb') as file:
+        pickle.dump(encoded, file)
+
+def load_encoded(options):
+    """Returns the pickled output of the encode stage."""
+
+    with open(ENCODED_PATH, 'rb') as file:
+        return pickle.load(file)
+
+def run_fit(encoded, options):
+    """Fits and saves the length of stay model on the encoded data."""
+
+    import models
+
+    return models.fit_linreg(*encoded)
+
+def run_compare(encoded, options):
+    """Fits the candidate models on the encoded data on --jobs processes,
+    prints their leaderboard and saves the best model's bundle.
+    """
+
+    import model_comparison
+
+    leaderboard = model_comparison.compare_models(*encoded,
+                                                  n_jobs=options['jobs'])
+    print(leaderboard.to_string(index=False))
+    return leaderboard
+
+def stage_file(name):
+    """Returns the save and load functions of a stage kept as a stage file."""
+
+    def save(data, options):
+        storage.save_stage(data, name, options['fmt'])
+
+    def load(options):
+        return storage.load_stage(name, fmt=options['fmt'])
+
+    return save, load
+
+# Each stage's dependencies, run function, checkpoint save and load functions
+# and whether its checkpoint is saved on every run. A stage's run function
+# takes the outputs of its dependencies followed by the run options.
+STAGES = {
+    'import': {'depends': [], 'run': run_import,
+               'checkpoint': (save_sources, load_sources), 'always_save': False},
+    'merge': {'depends': ['import'],
+              'run': lambda sources, options: ic.merging_data(sources),
+              'checkpoint': stage_file('merged_hospital_data'),
+              'always_save': False},
+    'clean': {'depends': ['merge'],
+              'run': lambda data, options: ic.data_cleaning(data),
+              'checkpoint': stage_file('raw_hospital_data'),
+              'always_save': True},
+    'feature_engineering': {'depends': ['clean'],
+                            'run': run_feature_engineering,
+                            'checkpoint': stage_file('feature_engineering_data'),
+                            'always_save': True},
+    'cube': {'depends': ['feature_engineering'],
+             'run': lambda data, options: los_cube.build_cube(data),
+             'checkpoint': (lambda cube, options: los_cube.save_cube(cube),
+                            lambda options: los_cube.load_cube()),
+             'always_save': True},
+    'encode': {'depends': ['feature_engineering'], 'run': run_encode,
+               'checkpoint': (save_encoded, load_encoded), 'always_save': False},
+    'fit': {'depends': ['encode'], 'run': run_fit, 'checkpoint': None,
+            'always_save': False},
+    'compare': {'depends': ['encode'], 'run': run_compare, 'checkpoint': None,
+                'always_save': False},
+}
+
+def topological_order(stages=STAGES):
+    """Returns the stage names ordered so that every stage follows its
+    dependencies. Raises a ValueError if the stages have a cycle.
+    """
+
+    order, visiting = [], set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f'Stage {name} depends on itself')
+        visiting.add(name)
+        for dependency in stages[name]['depends']:
+            visit(dependency)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+    return order
+
+def downstream(name, stages=STAGES):
+    """Returns the stage and every stage that depends on it."""
+
+    found = {name}
+    for stage in topological_order(stages):
+        if found.intersection(stages[stage]['depends']):
+            found.add(stage)
+    return found
+
+def upstream(name, stages=STAGES):
+    """Returns the stage and every stage it depends on."""
+
+    found = {name}
+    for dependency in stages[name]['depends']:
+        found |= upstream(dependency, stages)
+    return found
+
+def selected_stages(start=None, until=None, stages=STAGES):
+    """Returns the names of the stages from start to until, in run order."""
+
+    selected = set(stages)
+    if start is not None:
+        selected &= downstream(start, stages)
+    if until is not None:
+        selected &= upstream(until, stages)
+    if not selected:
+        raise ValueError(f'No stages run from {start} until {until}')
+
+    return [name for name in topological_order(stages) if name in selected]
+
+def run(start=None, until=None, options=None, stages=STAGES):
+    """Runs the stages from start to until and returns the output of the
+    last one. Dependencies outside the selection are loaded from their
+    checkpoints, and each output is released once the stages that need it
+    have run.
+    """
+
+    options = {'fmt': storage.DEFAULT_FORMAT, 'jobs': 1, 'threads': None,
+               'source_dir': ic.SOURCE_DIR, **(options or {})}
+    selected = selected_stages(start, until, stages)
+    outputs = {}
+
+    for name in selected:
+        stage = stages[name]
+        inputs = []
+        for dependency in stage['depends']:
+            if dependency not in outputs:
+                checkpoint = stages[dependency]['checkpoint']
+                if checkpoint is None:
+                    raise ValueError(f'Stage {dependency} has no checkpoint '
+                                     f'to run {name} from')
+                outputs[dependency] = checkpoint[1](options)
+            inputs.append(outputs[dependency])
+
+        outputs[name] = stage['run'](*inputs, options)
+        if stage['checkpoint'] is not None and \
+                (stage['always_save'] or name == selected[-1]):
+            stage['checkpoint'][0](outputs[name], options)
+
+        remaining = selected[selected.index(name) + 1:]
+        for done in list(outputs):
+            if done != name and not any(done in stages[later]['depends']
+                                        for later in remaining):
+                del outputs[done]
+
+    return outputs[selected[-1]]
+
+def parse_args(argv=None):
+    """Returns the parsed command line arguments."""
+
+    parser = argparse.ArgumentParser(
+        description='Runs the hospital length of stay pipeline.')
+    parser.add_argument('--from', dest='start', choices=list(STAGES),
+                        help='first stage to run, earlier outputs are loaded '
+                             'from checkpoints')
+    parser.add_argument('--until', choices=list(STAGES),
+                        help='last stage to run')
+    parser.add_argument('--format', dest='fmt', default=storage.DEFAULT_FORMAT,
+                        choices=list(storage.FORMATS),
+                        help='stage file format')
+    parser.add_argument('--source-dir', default=ic.SOURCE_DIR,
+                        help='directory of the source csv files')
+    parser.add_argument('--threads', type=int,
+                        help='threads loading source files, one per file by '
+                             'default')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='processes for feature engineering and model '
+                             'comparison')
+    parser.add_argument('--cache', nargs='?', const=stage_cache.CACHE_DIR,
+                        help='cache stage outputs in a directory')
+    parser.add_argument('--report', nargs='?', const=instrumentation.REPORT_PATH,
+                        help='write a JSON run report')
+    parser.add_argument('--profile',
+                        help='dump cProfile statistics of the slowest stage, '
+                             'implies --report')
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help='run every stage out of core within a memory '
+                             'budget in MB for the data the run holds, '
+                             'including the tables read whole and the '
+                             'admission keys')
+    parser.add_argument('--list', action='store_true',
+                        help='list the stages in run order and exit')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """Runs the pipeline stages selected on the command line."""
+
+    args = parse_args(argv)
+    try:
+        selected_stages(args.start, args.until)
+        if args.memory_budget is not None:
+            if args.start or args.until:
+                raise ValueError('--memory-budget runs every stage and '
+                                 'cannot be combined with --from or --until')
+            out_of_core.plan_partitions(args.memory_budget, args.source_dir)
+    except ValueError as error:
+        raise SystemExit(f'error: {error}')
+
+    if args.list:
+        for name in topological_order():
+            depends = ', '.join(STAGES[name]['depends'])
+            print(name + (f' (after {depends})' if depends else ''))
+        return
+
+    if args.cache:
+        stage_cache.enable(args.cache)
+    options = {'fmt': args.fmt, 'jobs': args.jobs, 'threads': args.threads,
+               'source_dir': args.source_dir}
+
+    if args.report or args.profile:
+        report_path = args.report or instrumentation.REPORT_PATH
+        with instrumentation.run_report(report_path, args.profile) as report:
+            execute(args, options)
+        print('\n'.join(instrumentation.summarize(report)))
+    else:
+        execute(args, options)
+
+def execute(args, options):
+    """Runs the selected stages, or every stage out of core when a memory
+    budget is given.
+    """
+
+    if args.memory_budget is None:
+        run(args.start, args.until, options)
+    else:
+        print(out_of_core.run(args.memory_budget, args.source_dir,
+                              fmt=args.fmt).to_string())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+This script draws small random samples shaped like the pipeline's data: raw
+categorical values, ICD9 codes, the cleaned raw stage, the imported source
+tables and raw admission records for scoring. The samples are built in
+memory, without source files, for benchmarks.py, load_generator.py and the
+tests.
+"""
+
+import numpy as np
+import pandas as pd
+
+import feature_engineering as fe
+import storage
+
+# Raw values not listed in any rule's 'equals', so that substring matches and
+# pass-through rows are timed as well
+OTHER_VALUES = {
+    'admission_type': ['ELECTIVE', 'NEWBORN'],
+    'first_careunit': ['NICU', 'not_admitted'],
+    'curr_service': ['MED', 'SURGERY'],
+    'ethnicity': ['WHITE', 'WHITE - RUSSIAN', 'ASIAN - CHINESE',
+                  'HISPANIC OR LATINO', 'BLACK/AFRICAN AMERICAN',
+                  'UNABLE TO OBTAIN', 'UNKNOWN/NOT SPECIFIED'],
+    'marital_status': ['SINGLE', 'LIFE_PARTNER'],
+    'religion': ['NOT SPECIFIED', 'UNOBTAINABLE'],
+    'admission_location': ['EMERGENCY ROOM ADMIT', 'TRANSFER FROM OTHER'],
+}
+
+def sample_categorical_data(n_rows, seed=10):
+    """Returns a dataframe of randomly drawn raw values for every column that
+    has compression rules.
+    """
+
+    rng = np.random.default_rng(seed)
+    data = {}
+
+    for column, rules in fe.COMPRESSION_RULES.items():
+        values = list(OTHER_VALUES[column])
+        for rule in rules:
+            values.extend(rule.get('equals', []))
+        data[column] = rng.choice(values, size=n_rows).astype(object)
+
+    return pd.DataFrame(data)
+
+def sample_icd9_codes(n_rows, n_unique=6000, seed=10):
+    """Returns a series of raw ICD9 code strings drawn from a pool of unique
+    numeric, V, E and M codes.
+    """
+
+    rng = np.random.default_rng(seed)
+    numbers = rng.integers(0, 100000, size=n_unique)
+    prefixes = rng.choice(['', '', '', '', '', '', 'V', 'E', 'M'],
+                          size=n_unique)
+    pool = [f'{prefix}{number:05d}'[:5] for prefix, number
+            in zip(prefixes, numbers)]
+
+    return pd.Series(rng.choice(pool, size=n_rows).astype(object),
+                     name='icd9_code')
+
+def sample_raw_data(n_rows, seed=10):
+    """Returns a dataframe shaped like the cleaned raw_hospital_data stage,
+    with timestamp columns as MIMIC formatted strings.
+    """
+
+    rng = np.random.default_rng(seed)
+    data = sample_categorical_data(n_rows, seed)
+    data['icd9_code'] = sample_icd9_codes(n_rows, seed=seed).to_numpy()
+    data['insurance'] = rng.choice(['Medicare', 'Private', 'Medicaid',
+                                    'Government', 'Self Pay'], size=n_rows)
+    data['gender'] = rng.choice(['M', 'F'], size=n_rows)
+
+    # Several diagnoses rows per admission, one admission per patient
+    hadm_id = np.sort(rng.integers(100000, 100000 + n_rows // 4, size=n_rows))
+    data.insert(0, 'hadm_id', hadm_id)
+    data.insert(0, 'subject_id', hadm_id - 90000)
+
+    admit_secs = rng.integers(0, 100 * 365 * 86400, size=n_rows // 4 + 1)
+    admit = pd.Timestamp('2100-01-01') + pd.to_timedelta(
+        admit_secs[hadm_id - 100000], unit='s')
+    stay = pd.to_timedelta(rng.exponential(8 * 86400, size=n_rows).astype(int),
+                           unit='s')
+    age = pd.to_timedelta(rng.integers(0, 100 * 365, size=n_rows), unit='D')
+
+    data['admittime'] = admit.strftime(storage.DATETIME_FORMAT)
+    data['dischtime'] = (admit + stay).strftime(storage.DATETIME_FORMAT)
+    data['dob'] = (admit - age).normalize().strftime(storage.DATETIME_FORMAT)
+
+    return data
+
+def sample_source_tables(n_admissions, seed=10):
+    """Returns admissions, patients, diagnoses, services and icustays
+    dataframes shaped like the imported source tables, with several
+    diagnoses, services and ICU stays per admission.
+    """
+
+    rng = np.random.default_rng(seed)
+    raw_data = sample_raw_data(n_admissions, seed)
+    hadm_id = np.arange(n_admissions) + 100000
+    subject_id = hadm_id // 2
+
+    adm = raw_data.drop(columns=['icd9_code', 'curr_service', 'first_careunit',
+                                 'gender', 'dob'])
+    adm['hadm_id'], adm['subject_id'] = hadm_id, subject_id
+    adm['deathtime'] = adm.dischtime.where(rng.random(n_admissions) < .1)
+    for col in ['admittime', 'dischtime', 'deathtime']:
+        adm[col] = pd.to_datetime(adm[col], format=storage.DATETIME_FORMAT)
+    for col in ['religion', 'marital_status']:
+        adm[col] = adm[col].where(rng.random(n_admissions) > .05)
+
+    pat = raw_data[['gender', 'dob']].groupby(subject_id).first() \
+                                     .rename_axis('subject_id').reset_index()
+    pat['dob'] = pd.to_datetime(pat.dob, format=storage.DATETIME_FORMAT)
+
+    def one_to_many(column, values, mean_rows):
+        rows = rng.poisson(mean_rows, size=n_admissions)
+        idx = np.repeat(np.arange(n_admissions), rows)
+        return pd.DataFrame({'subject_id': subject_id[idx],
+                             'hadm_id': hadm_id[idx],
+                             column: rng.choice(values, size=len(idx))})
+
+    diag = one_to_many('icd9_code', sample_icd9_codes(6000, seed=seed), 13)
+    serv = one_to_many('curr_service', raw_data.curr_service.unique(), 1.5)
+    icu = one_to_many('first_careunit', raw_data.first_careunit.unique(), 1)
+
+    return [adm, pat, diag, serv, icu]
+
+def sample_records(tables):
+    """Returns the source tables as a list of raw admission records for
+    scoring, one per admission.
+    """
+
+    adm, pat, diag, serv, icu = tables
+    data = adm.merge(pat, on='subject_id')
+    for col in data.select_dtypes(include=['datetime']).columns:
+        data[col] = data[col].dt.strftime(storage.DATETIME_FORMAT)
+    data = data.astype(object).where(data.notna(), None)
+
+    for table, col in [(diag, 'icd9_code'), (serv, 'curr_service'),
+                       (icu, 'first_careunit')]:
+        values = table.groupby('hadm_id')[col].agg(list)
+        data[col] = data.hadm_id.map(values)
+        data[col] = data[col].apply(lambda x: x if isinstance(x, list) else [])
+
+    return data.to_dict('records')
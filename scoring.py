@@ -0,0 +1,269 @@
+"""
+This script saves the fitted length of stay model as a versioned bundle and
+scores raw admission records with it. The bundle holds everything needed to
+go from raw admission fields to a prediction: the compression rules, the ICD9
+and age bins, the one hot vocabulary and the regression coefficients, or the
+fitted estimator for models without coefficients, such as gradient boosting.
+Scoring uses only the bundle, without re-running the pandas pipeline.
+
+A raw admission record is a dictionary of the admission fields, such as:
+
+    {'admission_type': 'URGENT', 'insurance': 'Medicare',
+     'admission_location': 'PHYS REFERRAL/NORMAL DELI',
+     'religion': 'CATHOLIC', 'marital_status': 'MARRIED',
+     'ethnicity': 'WHITE', 'gender': 'F',
+     'admittime': '2150-01-01 14:00:00', 'dob': '2080-03-02 00:00:00',
+     'icd9_code': ['4019', 'V3000'], 'curr_service': ['MED'],
+     'first_careunit': []}
+
+icd9_code, curr_service and first_careunit may be single values or lists,
+since an admission can have several of each.
+"""
+
+import bisect
+import os
+import pickle
+from datetime import date
+
+import numpy as np
+
+from scipy import sparse
+
+import feature_engineering as fe
+
+# Version 2 bundles record their target and hold either coefficients or a
+# fitted estimator; version 1 bundles are linear models of los
+BUNDLE_VERSION = 2
+SUPPORTED_VERSIONS = {1, 2}
+BUNDLE_PATH = 'los_model_bundle.pkl'
+
+def make_bundle(model, vocabulary, numeric_cols, target='los'):
+    """Returns a model bundle for a fitted model and the vocabulary and
+    numeric columns of its design matrix. Linear models are kept as their
+    coefficients, other models as the fitted estimator. target is 'log_los'
+    for models fit on log(1 + los).
+    """
+
+    bundle = {
+        'version': BUNDLE_VERSION,
+        'compression_rules': fe.COMPRESSION_RULES,
+        'icd9_bins': fe.ICD9_BINS,
+        'age_bins': fe.AGE_BINS,
+        'age_labels': fe.AGE_LABELS,
+        'vocabulary': vocabulary,
+        'numeric_cols': numeric_cols,
+        'target': target,
+    }
+
+    if hasattr(model, 'coef_'):
+        bundle['coef'] = np.asarray(model.coef_, dtype=float)
+        bundle['intercept'] = float(model.intercept_)
+    else:
+        bundle['estimator'] = model
+    return bundle
+
+def save_bundle(bundle, path=BUNDLE_PATH):
+    """Pickles a model bundle."""
+
+    with open(path, 'wb') as file:
+        pickle.dump(bundle, file)
+
+def load_bundle(path=BUNDLE_PATH):
+    """Returns a pickled model bundle, checking its version. Version 1
+    bundles are given the los target.
+    """
+
+    with open(path, 'rb') as file:
+        bundle = pickle.load(file)
+
+    if bundle.get('version') not in SUPPORTED_VERSIONS:
+        raise ValueError(f"Model bundle version {bundle.get('version')} is "
+                         f"not supported, expected one of "
+                         f"{sorted(SUPPORTED_VERSIONS)}")
+    bundle.setdefault('target', 'los')
+    return bundle
+
+def compress_value(value, rules):
+    """Returns a single raw value with the compression rules applied in
+    order, as compress_categories does for a column.
+    """
+
+    for rule in rules:
+        if value in rule.get('equals', []) or \
+           any(sub in value for sub in rule.get('contains', [])):
+            value = rule['value']
+    return value
+
+def icd9_category(code, bins):
+    """Returns the diagnoses category of a single raw ICD9 code, as
+    icd9_categories does for an array of codes.
+    """
+
+    if 'V' in code:
+        value = .1
+    elif 'M' in code:
+        value = .8
+    elif 'E' in code:
+        value = .5
+    else:
+        value = float(code[:3])
+
+    lowers = [b[0] for b in bins]
+    _, upper, inclusive, label = bins[bisect.bisect_right(lowers, value) - 1]
+
+    if inclusive:
+        in_bin = value <= upper
+    else:
+        in_bin = value < upper
+    return label if in_bin else value
+
+def age_category(admittime, dob, age_bins, age_labels):
+    """Returns the age group for an admission and date of birth, as
+    new_features and age_to_cat compute it for a column.
+    """
+
+    # Timestamps start with an ISO date, which parses much faster than the
+    # full DATETIME_FORMAT
+    admit, birth = [date.fromisoformat(value[:10])
+                    if isinstance(value, str) else value.date()
+                    for value in [admittime, dob]]
+    age = round((admit - birth).days / 365)
+
+    idx = bisect.bisect_left(age_bins, age)
+    if 0 < idx < len(age_bins):
+        return age_labels[idx - 1]
+    return None
+
+class LOSScorer:
+    """Scores batches of raw admission records with a model bundle. Raw
+    values are resolved to feature columns once and cached, so a batch is
+    scored with dictionary lookups and a single weighted sum.
+    """
+
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.numeric_cols = bundle['numeric_cols']
+        self.coef = bundle.get('coef')
+        self.intercept = bundle.get('intercept')
+        self.estimator = bundle.get('estimator')
+
+        # Feature column index of each category, after the numeric columns
+        self.index = {}
+        offset = len(self.numeric_cols)
+        for col, categories in bundle['vocabulary'].items():
+            self.index[col] = {category: offset + i
+                               for i, category in enumerate(categories)}
+            offset += len(categories)
+        self.n_features = offset
+
+        self._cache = {col: {} for col in self.index}
+
+    def category(self, col, value):
+        """Returns the feature engineering category of a raw record value."""
+
+        if col == 'diagnoses':
+            return icd9_category(value, self.bundle['icd9_bins'])
+        if col in self.bundle['compression_rules']:
+            return compress_value(value, self.bundle['compression_rules'][col])
+        return value
+
+    def feature(self, col, value):
+        """Returns the feature column of a raw value, or -1 for the baseline
+        category and values outside the vocabulary.
+        """
+
+        cache = self._cache[col]
+        if value not in cache:
+            category = self.category(col, value)
+            cache[value] = self.index[col].get(str(category), -1)
+        return cache[value]
+
+    def record_features(self, record):
+        """Returns the set of feature columns that are 1 for a record."""
+
+        features = set()
+
+        for col, cache in self._cache.items():
+            if col == 'age':
+                values = [age_category(record['admittime'], record['dob'],
+                                       self.bundle['age_bins'],
+                                       self.bundle['age_labels'])]
+            else:
+                values = record.get('icd9_code' if col == 'diagnoses'
+                                    else col)
+                if not isinstance(values, list):
+                    values = [values]
+                if col == 'first_careunit' and not any(values):
+                    values = ['not_admitted']
+
+            for value in values:
+                if value is None:
+                    continue
+                feature = cache.get(value)
+                if feature is None:
+                    feature = self.feature(col, value)
+                features.add(feature)
+
+        features.discard(-1)
+        return features
+
+    def numeric_values(self, records):
+        """Returns the numeric feature values of the records as an array."""
+
+        return np.array([[record[col] for col in self.numeric_cols]
+                         for record in records], dtype=float)
+
+    def design_matrix(self, records, record_ids, features):
+        """Returns the CSR design matrix rows of the records, laid out as
+        models.sparse_design_matrix lays them out.
+        """
+
+        n_records, n_numeric = len(records), len(self.numeric_cols)
+        rows = np.append(np.repeat(np.arange(n_records), n_numeric),
+                         record_ids)
+        cols = np.append(np.tile(np.arange(n_numeric), n_records), features)
+        values = np.append(self.numeric_values(records).ravel(),
+                           np.ones(len(features)))
+
+        return sparse.csr_matrix((values, (rows, cols)),
+                                 shape=(n_records, self.n_features))
+
+    def predict(self, records):
+        """Returns the predicted length of stay in days for each record."""
+
+        record_ids, features = [], []
+        for i, record in enumerate(records):
+            record_features = self.record_features(record)
+            record_ids.extend([i] * len(record_features))
+            features.extend(record_features)
+        record_ids = np.array(record_ids, dtype=np.int64)
+
+        if self.estimator is not None:
+            predictions = self.estimator.predict(
+                self.design_matrix(records, record_ids, features))
+        else:
+            predictions = np.bincount(record_ids, weights=self.coef[features],
+                                      minlength=len(records))
+            if self.numeric_cols:
+                predictions += self.numeric_values(records) @ \
+                    self.coef[:len(self.numeric_cols)]
+            predictions += self.intercept
+
+        if self.bundle.get('target') == 'log_los':
+            return np.expm1(predictions)
+        return predictions
+
+# Scorer of each bundle path, with the modification time of the file it was
+# loaded from
+_scorers = {}
+
+def predict_los(records, path=BUNDLE_PATH):
+    """Returns the predicted length of stay in days for a batch of raw
+    admission records, using the model bundle saved at path. The bundle is
+    reloaded whenever the file changes, such as when a model is refit.
+    """
+
+    mtime = os.stat(path).st_mtime_ns
+    if path not in _scorers or _scorers[path][0] != mtime:
+        _scorers[path] = (mtime, LOSScorer(load_bundle(path)))
+    return _scorers[path][1].predict(records)
@@ -0,0 +1,260 @@
+"""
+This script serves length of stay predictions over HTTP on the local machine
+using asyncio. Admissions are posted as JSON raw admission records (see
+scoring.py) to /predict, either a single record or a list of records.
+Concurrent requests are grouped into micro-batches so that each batch is
+scored with one vectorized predict call. A body that is not a record or a
+list of records gets a 400 response before it is queued, and a batch that
+fails to score is scored again request by request, so only the requests
+with bad records fail. /stats returns request latency percentiles and
+throughput counters.
+"""
+
+import asyncio
+import json
+import time
+from collections import deque
+
+import numpy as np
+
+import scoring
+
+HOST = '127.0.0.1'
+PORT = 8350
+
+# A batch is scored once it holds MAX_BATCH_SIZE admissions or the oldest
+# request has waited MAX_BATCH_WAIT seconds
+MAX_BATCH_SIZE = 512
+MAX_BATCH_WAIT = .002
+
+# Number of recent request latencies kept for the percentiles
+LATENCY_WINDOW = 10_000
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+               500: 'Internal Server Error'}
+
+# Scoring errors caused by a malformed admission record
+RECORD_ERRORS = (ValueError, KeyError, TypeError, AttributeError, IndexError)
+
+class LatencyStats:
+    """Records request latencies and counts for the /stats endpoint."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.admissions = 0
+        self.batches = 0
+
+    def record_request(self, latency, n_admissions):
+        self.latencies.append(latency)
+        self.requests += 1
+        self.admissions += n_admissions
+
+    def summary(self):
+        """Returns the latency percentiles in milliseconds and throughput."""
+
+        elapsed = time.perf_counter() - self.started
+        latencies = np.array(self.latencies) * 1000
+        p50, p99 = np.percentile(latencies, [50, 99]) if self.requests \
+            else (0., 0.)
+
+        return {
+            'requests': self.requests,
+            'admissions': self.admissions,
+            'batches': self.batches,
+            'mean_batch_size': self.admissions / max(self.batches, 1),
+            'p50_ms': float(p50),
+            'p99_ms': float(p99),
+            'requests_per_s': self.requests / elapsed,
+            'admissions_per_s': self.admissions / elapsed,
+        }
+
+class ScoringServer:
+    """Local HTTP server that micro-batches prediction requests."""
+
+    def __init__(self, scorer, max_batch_size=MAX_BATCH_SIZE,
+                 max_batch_wait=MAX_BATCH_WAIT):
+        self.scorer = scorer
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+        self.stats = LatencyStats()
+        self._queue = None
+        self._batcher = None
+
+    async def start(self, host=HOST, port=PORT):
+        """Starts the batcher and returns the listening asyncio server."""
+
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._run_batches())
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def predict(self, records):
+        """Returns the predictions for a list of records once the batch they
+        are queued in has been scored.
+        """
+
+        if not isinstance(records, list):
+            raise TypeError('Expected a list of admission records')
+        if not records:
+            return []
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((records, future))
+        return await future
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self._queue.get()]
+
+            # An unexpected error fails the batch's requests rather than
+            # ending the task, which would leave later requests waiting
+            try:
+                size = len(batch[0][0])
+                deadline = loop.time() + self.max_batch_wait
+
+                while size < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(),
+                                                      timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    batch.append(item)
+                    size += len(item[0])
+
+                self._score(batch)
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def _score(self, batch):
+        """Scores the requests of a batch with one predict call. When the
+        batch fails, each request is scored on its own so that only the
+        requests with bad records fail.
+        """
+
+        records = [record for request, _ in batch for record in request]
+        try:
+            predictions = self.scorer.predict(records).tolist()
+        except Exception as error:
+            if len(batch) > 1:
+                for item in batch:
+                    self._score([item])
+            elif not batch[0][1].done():
+                batch[0][1].set_exception(error)
+            return
+
+        self.stats.batches += 1
+        start = 0
+        for request, future in batch:
+            # A request whose client went away has a cancelled future
+            if not future.done():
+                future.set_result(predictions[start:start + len(request)])
+            start += len(request)
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, headers = \
+                        await self._read_head(request_line, reader)
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError(f'negative Content-Length {length}')
+                except ValueError as error:
+                    self._write_response(writer, 400, {
+                        'error': f'Malformed request: {error}'})
+                    await writer.drain()
+                    break
+
+                body = await reader.readexactly(length) if length else b''
+
+                status, response = await self._route(method, path, body)
+                self._write_response(writer, status, response)
+                await writer.drain()
+
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_head(self, request_line, reader):
+        """Returns the method, path and lower cased headers of a request.
+        Raises a ValueError if the request line or a header is malformed.
+        """
+
+        method, path, _ = request_line.decode().split(' ', 2)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode().split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        return method, path, headers
+
+    async def _route(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats.summary()
+        if method != 'POST' or path != '/predict':
+            return 404, {'error': f'No route for {method} {path}'}
+
+        start = time.perf_counter()
+        try:
+            records = json.loads(body)
+        except ValueError as error:
+            return 400, {'error': f'Invalid JSON: {error}'}
+
+        if isinstance(records, dict):
+            records = [records]
+        if not isinstance(records, list) or \
+                not all(isinstance(record, dict) for record in records):
+            return 400, {'error': 'Expected an admission record or a list of '
+                                  'admission records'}
+
+        try:
+            predictions = await self.predict(records)
+        except RECORD_ERRORS as error:
+            return 400, {'error': f'Invalid admission record: {error!r}'}
+        except Exception as error:
+            return 500, {'error': repr(error)}
+
+        self.stats.record_request(time.perf_counter() - start, len(records))
+        return 200, {'los': predictions}
+
+    def _write_response(self, writer, status, response):
+        body = json.dumps(response).encode()
+        writer.write(f'HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n'
+                     'Content-Type: application/json\r\n'
+                     f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+
+async def serve(bundle_path=scoring.BUNDLE_PATH, host=HOST, port=PORT):
+    """Serves predictions from a saved model bundle until cancelled."""
+
+    scorer = scoring.LOSScorer(scoring.load_bundle(bundle_path))
+    server = await ScoringServer(scorer).start(host, port)
+    print(f'Serving length of stay predictions on http://{host}:{port}')
+
+    async with server:
+        await server.serve_forever()
+
+def main():
+    """Serves predictions from the model bundle saved by models.py."""
+
+    asyncio.run(serve())
+
+if __name__ == '__main__':
+    main()
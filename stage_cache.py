@@ -0,0 +1,284 @@
+"""
+This script caches the outputs of the pipeline stages on local disk, keyed on
+the content of their inputs. A stage's key is a hash of its input data, the
+source code of the stage and of the helpers it relies on, and the
+configuration it reads (compression rules, ICD9 bins and so on). Re-running a
+stage on unchanged inputs loads the stored output instead of recomputing it,
+along with the rows its filters dropped so that run reports still count
+them. Editing a stage, a helper or a rule changes the key so stale outputs
+are never returned. The cache directory is capped in size and the least recently
+used outputs are evicted first.
+
+Hashing a large dataframe costs about as much as a cheap stage, so a
+dataframe returned by a cached stage is not hashed again when it is passed
+on to the next stage: the key of the stage that produced it stands in for its
+content. The stand-in is dropped once a column of the dataframe is assigned,
+but values modified in place outside a cached stage (for example with
+.loc[...] = value) are not detected, so such dataframes should be copied
+first.
+
+Caching is off until enable() is called or the STAGE_CACHE_DIR environment
+variable names a cache directory.
+"""
+
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+import time
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+
+import instrumentation
+
+CACHE_DIR = '.stage_cache'
+MAX_CACHE_BYTES = 4 * 2**30
+
+# Layout of a stored entry, part of every key: version 2 entries hold the
+# output and the rows dropped by each filter the stage applied
+ENTRY_VERSION = 2
+
+# Temporary files older than this were left by interrupted writes, younger
+# ones may still be written by another process sharing the cache
+STALE_TEMP_SECS = 3600
+
+_settings = {
+    'directory': os.environ.get('STAGE_CACHE_DIR'),
+    'max_bytes': int(os.environ.get('STAGE_CACHE_MAX_BYTES', MAX_CACHE_BYTES)),
+}
+
+# id of each dataframe returned by a cached stage -> (weak reference, column
+# arrays guard, key of the stage that produced it)
+_lineage = {}
+
+def enable(directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """Turns on caching of stage outputs in the directory, which is kept
+    under max_bytes.
+    """
+
+    _settings['directory'] = directory
+    _settings['max_bytes'] = max_bytes
+
+def disable():
+    """Turns off caching. Stored outputs are left on disk."""
+
+    _settings['directory'] = None
+
+def _guard(data):
+    """Returns the column labels and the identity of the column arrays of a
+    dataframe, which change whenever a column is assigned.
+    """
+
+    return (tuple(map(str, data.columns)),
+            tuple(id(array) for array in data._mgr.arrays))
+
+def _record_lineage(data, key):
+    """Records that a dataframe is the output of the stage call with key."""
+
+    def forget(ref, data_id=id(data)):
+        if _lineage.get(data_id, (None,))[0] is ref:
+            del _lineage[data_id]
+
+    _lineage[id(data)] = (weakref.ref(data, forget), _guard(data), key)
+
+def _lineage_key(data):
+    """Returns the key of the stage that produced a dataframe, or None when
+    it was not produced by a cached stage or has since been modified.
+    """
+
+    ref, guard, key = _lineage.get(id(data), (None, None, None))
+    if ref is not None and ref() is data and guard == _guard(data):
+        return key
+    return None
+
+def _update(digest, obj):
+    """Feeds the content of a stage argument into a hash."""
+
+    producer = _lineage_key(obj) if isinstance(obj, pd.DataFrame) else None
+    if producer is not None:
+        digest.update(f'stage output {producer}'.encode())
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        digest.update(type(obj).__name__.encode())
+        if isinstance(obj, pd.DataFrame):
+            digest.update(repr([(str(col), str(dtype))
+                                for col, dtype in obj.dtypes.items()]).encode())
+        else:
+            digest.update(repr((obj.name, str(obj.dtype))).encode())
+        digest.update(repr(obj.shape).encode())
+        digest.update(pd.util.hash_pandas_object(obj, index=True).to_numpy())
+    elif isinstance(obj, np.ndarray):
+        digest.update(repr((obj.shape, obj.dtype.str)).encode())
+        digest.update(np.ascontiguousarray(obj).data if obj.dtype != object
+                      else pickle.dumps(obj))
+    elif sparse.issparse(obj):
+        obj = sparse.csr_matrix(obj)
+        digest.update(repr(obj.shape).encode())
+        for array in [obj.data, obj.indices, obj.indptr]:
+            _update(digest, array)
+    elif isinstance(obj, (list, tuple)):
+        digest.update(f'{type(obj).__name__}{len(obj)}'.encode())
+        for item in obj:
+            _update(digest, item)
+    elif isinstance(obj, dict):
+        digest.update(f'dict{len(obj)}'.encode())
+        for key, value in obj.items():
+            _update(digest, key)
+            _update(digest, value)
+    else:
+        digest.update(repr(obj).encode())
+
+def stage_key(func, dependencies, config, args, kwargs):
+    """Returns the cache key of a stage call: a SHA-256 digest of the stage
+    and helper sources, the configuration and the arguments.
+    """
+
+    digest = hashlib.sha256(f'entry v{ENTRY_VERSION}'.encode())
+    for code in [func, *dependencies]:
+        digest.update(f'{code.__module__}.{code.__qualname__}'.encode())
+        digest.update(inspect.getsource(code).encode())
+    _update(digest, config() if config is not None else None)
+    _update(digest, list(args))
+    _update(digest, sorted(kwargs.items()))
+
+    return digest.hexdigest()
+
+def entry_path(key, directory):
+    """Returns the path of the stored output for a key."""
+
+    return os.path.join(directory, f'{key}.pkl')
+
+def _store(result, path):
+    """Pickles an output, via a temporary file so that an interrupted write
+    never leaves a partial entry behind.
+    """
+
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def _entries(directory, suffix='.pkl'):
+    """Returns the modification time, size and path of each file in the
+    cache directory with the suffix. Several processes may share the cache,
+    so files removed by another process while they are listed are skipped.
+    """
+
+    entries = []
+    try:
+        listing = list(os.scandir(directory))
+    except FileNotFoundError:
+        return entries
+
+    for entry in listing:
+        if entry.name.endswith(suffix):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+def _remove(path):
+    """Removes a file, returning False if another process removed it first."""
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def cache_size(directory=None):
+    """Returns the total size in bytes of the stored outputs."""
+
+    directory = directory or _settings['directory']
+    return sum(size for _, size, _ in _entries(directory))
+
+def evict(directory=None, max_bytes=None):
+    """Removes the least recently used outputs until the cache is no larger
+    than max_bytes, along with temporary files left by interrupted writes.
+    Returns the number of outputs removed.
+    """
+
+    directory = directory or _settings['directory']
+    max_bytes = _settings['max_bytes'] if max_bytes is None else max_bytes
+
+    stale = time.time() - STALE_TEMP_SECS
+    for mtime, _, path in _entries(directory, '.tmp'):
+        if mtime < stale:
+            _remove(path)
+
+    # Hits refresh the modification time, so it orders entries by last use
+    entries = sorted(_entries(directory))
+    total = sum(size for _, size, _ in entries)
+
+    removed = 0
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        removed += _remove(path)
+        total -= size
+
+    return removed
+
+def clear(directory=None):
+    """Removes every stored output."""
+
+    evict(directory, max_bytes=0)
+
+def cached(*dependencies, config=None):
+    """Decorator that caches a stage's output on disk. dependencies are the
+    helper functions the stage calls and config is a function returning the
+    configuration it reads; both are part of the key, so changing them
+    invalidates the stored outputs.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            directory = _settings['directory']
+            if directory is None:
+                return func(*args, **kwargs)
+
+            # The key is taken before the stage runs, since stages may modify
+            # their input dataframe in place
+            key = stage_key(func, dependencies, config, args, kwargs)
+            path = entry_path(key, directory)
+
+            try:
+                with open(path, 'rb') as file:
+                    result, filters = pickle.load(file)
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                with instrumentation.collected_filters() as filters:
+                    result = func(*args, **kwargs)
+                os.makedirs(directory, exist_ok=True)
+                _store((result, filters), path)
+                evict(directory)
+            else:
+                # The stage did not run, so its filters are recorded from
+                # the counts stored with its output
+                instrumentation.record_filters(filters)
+
+                # Another process may have evicted the entry since it was read
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+
+            if isinstance(result, pd.DataFrame):
+                _record_lineage(result, key)
+            return result
+
+        return wrapper
+
+    return decorator
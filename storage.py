@@ -0,0 +1,89 @@
+"""
+This script saves and loads the dataframes handed between pipeline stages.
+Stage outputs are written as typed columnar files (Parquet by default, or
+Feather) so that categorical and datetime columns survive each hop without
+re-parsing strings. CSV remains available as an export format.
+"""
+
+import os
+
+import pandas as pd
+
+STAGE_DIR = 'data'
+DEFAULT_FORMAT = 'parquet'
+
+# Patient and admission id columns, read as integers
+ID_COLS = ['subject_id', 'hadm_id']
+
+# Timestamp columns stored as datetime64 rather than strings
+DATETIME_COLUMNS = ['admittime', 'dischtime', 'dob', 'deathtime']
+# MIMIC timestamps, e.g. '2150-01-01 14:00:00'
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def _write_parquet(data, path):
+    data.to_parquet(path, index=False)
+
+def _read_parquet(path, columns):
+    return pd.read_parquet(path, columns=columns, memory_map=True)
+
+def _write_feather(data, path):
+    data.reset_index(drop=True).to_feather(path)
+
+def _read_feather(path, columns):
+    from pyarrow import feather
+
+    return feather.read_table(path, columns=columns,
+                              memory_map=True).to_pandas()
+
+def _write_csv(data, path):
+    data.to_csv(path, index=False, date_format=DATETIME_FORMAT)
+
+def _read_csv(path, columns):
+    data = pd.read_csv(path, usecols=columns, dtype={'icd9_code': str})
+    return compact_dtypes(data)
+
+# Registered stage formats as name: (file extension, writer, reader). Readers
+# take the path and the list of columns to load, or None for all columns.
+FORMATS = {
+    'parquet': ('.parquet', _write_parquet, _read_parquet),
+    'feather': ('.feather', _write_feather, _read_feather),
+    'csv': ('.csv', _write_csv, _read_csv),
+}
+
+def register_format(name, extension, writer, reader):
+    """Adds a stage format that can be passed to save_stage and load_stage."""
+
+    FORMATS[name] = (extension, writer, reader)
+
+def stage_path(name, fmt=DEFAULT_FORMAT, directory=STAGE_DIR):
+    """Returns the file path for a stage output in the given format."""
+
+    extension = FORMATS[fmt][0]
+    return os.path.join(directory, name + extension)
+
+def compact_dtypes(data):
+    """Returns the dataframe with timestamp strings parsed to datetime64 and
+    all other string columns converted to categoricals.
+    """
+
+    for col in data.select_dtypes(include=['object', 'string']).columns:
+        if col in DATETIME_COLUMNS:
+            data[col] = pd.to_datetime(data[col], format=DATETIME_FORMAT)
+        else:
+            data[col] = data[col].astype('category')
+
+    return data
+
+def save_stage(data, name, fmt=DEFAULT_FORMAT, directory=STAGE_DIR):
+    """Writes a stage output with compact dtypes and returns its path."""
+
+    path = stage_path(name, fmt, directory)
+    os.makedirs(directory, exist_ok=True)
+
+    FORMATS[fmt][1](compact_dtypes(data.copy(deep=False)), path)
+    return path
+
+def load_stage(name, columns=None, fmt=DEFAULT_FORMAT, directory=STAGE_DIR):
+    """Returns a stage output, reading only the requested columns."""
+
+    return FORMATS[fmt][2](stage_path(name, fmt, directory), columns)
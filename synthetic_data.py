@@ -0,0 +1,367 @@
+"""
+This script generates synthetic source csv files shaped like the MIMIC-III
+tables the pipeline imports: admissions, patients, diagnoses, services and
+icustays, with MIMIC's column names and extra columns. Cardinalities and
+value frequencies follow MIMIC-III. Patients have one or more admissions,
+admissions have several diagnoses including V and E (and a few M) ICD9
+codes, some admissions end in death, some patients are newborns, and
+patients over 89 have the shifted dates of birth MIMIC uses. The output is
+fully determined by the seed.
+
+The scale is set by the number of diagnoses rows, from ten thousand to tens
+of millions. Rows are generated and appended a block of admissions at a
+time, so memory use does not grow with the scale.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import importing_and_cleaning_data as ic
+
+SYNTHETIC_DIR = 'synthetic_data'
+N_DIAGNOSES = 650_000
+SEED = 10
+
+# MIMIC-III has about 11 diagnoses, 1.2 services and 1 ICU stay per
+# admission and 1.25 admissions per patient
+DIAGNOSES_PER_ADMISSION = 11
+SERVICES_PER_ADMISSION = 1.25
+ICU_STAYS = {0: .03, 1: .88, 2: .07, 3: .02}
+READMISSION_RATE = .2
+
+NEWBORN_RATE = .13
+DEATH_RATE = .1
+OVER_89_RATE = .025
+N_ICD9_CODES = 6900
+
+BLOCK_ADMISSIONS = 200_000
+FIRST_SUBJECT_ID = 1
+FIRST_HADM_ID = 100001
+FIRST_ICUSTAY_ID = 200001
+
+# Value frequencies, roughly as in MIMIC-III
+ADMISSION_TYPES = {'EMERGENCY': .82, 'ELECTIVE': .15, 'URGENT': .03}
+ADMISSION_LOCATIONS = {
+    'EMERGENCY ROOM ADMIT': .38, 'PHYS REFERRAL/NORMAL DELI': .27,
+    'CLINIC REFERRAL/PREMATURE': .21, 'TRANSFER FROM HOSP/EXTRAM': .14,
+    'TRANSFER FROM SKILLED NUR': .02, 'TRANSFER FROM OTHER HEALT': .01,
+    'HMO REFERRAL/SICK': .002, '** INFO NOT AVAILABLE **': .001,
+    'TRSF WITHIN THIS FACILITY': .001,
+}
+DISCHARGE_LOCATIONS = {
+    'HOME': .33, 'HOME HEALTH CARE': .24, 'SNF': .13,
+    'REHAB/DISTINCT PART HOSP': .11, 'LONG TERM CARE HOSPITAL': .05,
+    'DISC-TRAN CANCER/CHLDRN H': .01, 'SHORT TERM HOSPITAL': .02,
+    'HOME WITH HOME IV PROVIDR': .01,
+}
+INSURANCES = {'Medicare': .48, 'Private': .38, 'Medicaid': .1,
+              'Government': .03, 'Self Pay': .01}
+LANGUAGES = {'ENGL': .9, 'SPAN': .04, 'RUSS': .02, 'PTUN': .02, 'CANT': .01,
+             'HAIT': .01}
+RELIGIONS = {
+    'CATHOLIC': .35, 'NOT SPECIFIED': .19, 'UNOBTAINABLE': .14,
+    'PROTESTANT QUAKER': .13, 'JEWISH': .09, 'OTHER': .04,
+    'EPISCOPALIAN': .01, 'GREEK ORTHODOX': .005, 'CHRISTIAN SCIENTIST': .005,
+    'BUDDHIST': .004, 'MUSLIM': .004, "JEHOVAH'S WITNESS": .003,
+    'UNITARIAN-UNIVERSALIST': .002, 'HINDU': .002, 'ROMANIAN EAST. ORTH': .002,
+    '7TH DAY ADVENTIST': .001, 'BAPTIST': .001, 'METHODIST': .001,
+    'LUTHERAN': .001, 'HEBREW': .001,
+}
+MARITAL_STATUSES = {'MARRIED': .49, 'SINGLE': .28, 'WIDOWED': .14,
+                    'DIVORCED': .06, 'SEPARATED': .01,
+                    'UNKNOWN (DEFAULT)': .01, 'LIFE PARTNER': .001}
+ETHNICITIES = {
+    'WHITE': .7, 'BLACK/AFRICAN AMERICAN': .09, 'UNKNOWN/NOT SPECIFIED': .08,
+    'HISPANIC OR LATINO': .03, 'OTHER': .03, 'ASIAN': .02,
+    'UNABLE TO OBTAIN': .01, 'PATIENT DECLINED TO ANSWER': .01,
+    'ASIAN - CHINESE': .005, 'WHITE - RUSSIAN': .005,
+    'BLACK/CAPE VERDEAN': .004, 'HISPANIC/LATINO - PUERTO RICAN': .004,
+    'MULTI RACE ETHNICITY': .002, 'PORTUGUESE': .001, 'MIDDLE EASTERN': .001,
+    'AMERICAN INDIAN/ALASKA NATIVE': .001,
+    'NATIVE HAWAIIAN OR OTHER PACIFIC ISLANDER': .0005,
+    'SOUTH AMERICAN': .0005, 'CARIBBEAN ISLAND': .0005,
+}
+SERVICES = {
+    'MED': .34, 'CMED': .14, 'CSURG': .12, 'SURG': .09, 'NMED': .06,
+    'NSURG': .06, 'TRAUM': .05, 'OMED': .04, 'VSURG': .03, 'TSURG': .02,
+    'ORTHO': .02, 'OBS': .01, 'GYN': .005, 'ENT': .005, 'GU': .005,
+    'PSURG': .003, 'DENT': .001, 'PSYCH': .001,
+}
+NEWBORN_SERVICES = {'NB': .9, 'NBB': .1}
+CAREUNITS = {'MICU': .4, 'CSRU': .17, 'SICU': .16, 'CCU': .14, 'TSICU': .13}
+NEWBORN_DIAGNOSES = {'V3000': .7, 'V3001': .25, 'V3101': .05}
+
+# Frequent codes get the highest ranks of the long tailed code distribution
+COMMON_ICD9_CODES = ['4019', '4280', '42731', '41401', '5849', '25000',
+                     '2724', '51881', '5990', '53081', '2720', 'V053',
+                     'V290', '2859', '2449', '486', '2851', '496', '99592',
+                     'V5861', 'E8798', 'E8497']
+
+# Null rates of the source columns that have missing values
+NULL_RATES = {'religion': .008, 'marital_status': .17, 'language': .43,
+              'icd9_code': .0001}
+
+def draw(rng, frequencies, size, null_rate=0):
+    """Returns an object array of values drawn with the given frequencies,
+    with a fraction of them missing.
+    """
+
+    weights = np.array(list(frequencies.values()))
+    values = rng.choice(np.array(list(frequencies), dtype=object), size=size,
+                        p=weights / weights.sum())
+    if null_rate:
+        values[rng.random(size) < null_rate] = None
+    return values
+
+def icd9_codes(rng, n_codes=N_ICD9_CODES):
+    """Returns a pool of unique raw ICD9 code strings and the probability of
+    each. Most codes are numeric with 3 to 5 digits, about one in eight are
+    supplemental (V), a few are external cause (E) and a handful are
+    morphology (M) codes. Frequencies fall off with rank like MIMIC's.
+    """
+
+    kinds = rng.choice(['numeric', 'V', 'E', 'M'], size=2 * n_codes,
+                       p=[.84, .12, .035, .005])
+    numbers = rng.integers(1, 1000, size=2 * n_codes)
+    digits = rng.integers(0, 3, size=2 * n_codes)
+    suffixes = rng.integers(0, 100, size=2 * n_codes)
+
+    codes = []
+    for kind, number, n_digits, suffix in zip(kinds, numbers, digits,
+                                              suffixes):
+        suffix = f'{suffix:02d}'[:n_digits]
+        if kind == 'numeric':
+            codes.append(f'{number:03d}{suffix}')
+        elif kind == 'V':
+            codes.append(f'V{number % 91:02d}{suffix}')
+        elif kind == 'E':
+            codes.append(f'E{800 + number % 200}{suffix[:1]}')
+        else:
+            codes.append(f'M{8000 + number}{suffix[:1]}')
+
+    codes = pd.unique(np.array(COMMON_ICD9_CODES + codes, dtype=object))
+    codes = codes[:n_codes]
+    weights = 1 / np.arange(1, len(codes) + 1) ** 1.1
+    return codes, weights / weights.sum()
+
+def format_times(times):
+    """Returns MIMIC formatted timestamp strings, with None for NaT."""
+
+    times = np.asarray(times, dtype='datetime64[s]')
+    strings = np.char.replace(np.datetime_as_string(times), 'T', ' ') \
+                     .astype(object)
+    strings[np.isnat(times)] = None
+    return strings
+
+def admission_offsets(rng, n_admissions):
+    """Returns the subject index of each admission and the admission number
+    of each within its patient. Patients have one admission plus a
+    geometric number of readmissions.
+    """
+
+    counts = rng.geometric(1 - READMISSION_RATE, size=n_admissions)
+    subjects = np.repeat(np.arange(n_admissions), counts)[:n_admissions]
+
+    starts = np.searchsorted(subjects, subjects)
+    return subjects, np.arange(n_admissions) - starts
+
+def generate_block(rng, n_admissions, first_ids, codes, code_p,
+                   diagnoses_per_admission=DIAGNOSES_PER_ADMISSION):
+    """Returns the admissions, patients, diagnoses, services and icustays
+    dataframes of one block of patients, with ids and row ids numbered from
+    first_ids.
+    """
+
+    subjects, visit = admission_offsets(rng, n_admissions)
+    n_patients = subjects[-1] + 1
+    subject_id = first_ids['subject_id'] + subjects
+    hadm_id = first_ids['hadm_id'] + np.arange(n_admissions)
+
+    # Patients: newborns are admitted at birth, adults at 16-89 and a few
+    # over 89 have their dob shifted back by about 300 years
+    newborn_patient = rng.random(n_patients) < NEWBORN_RATE
+    age_days = (rng.normal(64, 17, n_patients).clip(16, 89) * 365.25)
+    age_days[rng.random(n_patients) < OVER_89_RATE] = 300 * 365.25
+    age_days[newborn_patient] = 0
+
+    first_admit = np.datetime64('2100-01-01T00:00:00') + \
+        rng.integers(0, 100 * 365 * 86400, n_patients).astype('timedelta64[s]')
+    dob = (first_admit - age_days.astype('timedelta64[D]')) \
+        .astype('datetime64[D]')
+
+    # Admissions: readmissions follow the first admission by weeks to years
+    gaps = rng.exponential(400, n_admissions).astype('timedelta64[D]')
+    gaps[visit == 0] = 0
+    gaps = pd.Series(gaps).groupby(subjects).cumsum().to_numpy() \
+        .astype('timedelta64[s]')
+    admittime = first_admit[subjects] + gaps
+    newborn = newborn_patient[subjects] & (visit == 0)
+
+    stay = np.where(newborn, rng.lognormal(1, .6, n_admissions),
+                    rng.lognormal(1.9, .8, n_admissions))
+    dischtime = admittime + (stay * 86400).astype('timedelta64[s]')
+
+    last_visit = np.append(subjects[1:] != subjects[:-1], True)
+    died = last_visit & ~newborn & (rng.random(n_admissions) < DEATH_RATE /
+                                    (1 - READMISSION_RATE))
+    deathtime = np.where(died, dischtime, np.datetime64('NaT'))
+
+    admission_type = draw(rng, ADMISSION_TYPES, n_admissions)
+    admission_type[newborn] = 'NEWBORN'
+    discharge_location = draw(rng, DISCHARGE_LOCATIONS, n_admissions)
+    discharge_location[died] = 'DEAD/EXPIRED'
+
+    adm = pd.DataFrame({
+        'ROW_ID': first_ids['admissions'] + np.arange(n_admissions),
+        'SUBJECT_ID': subject_id,
+        'HADM_ID': hadm_id,
+        'ADMITTIME': format_times(admittime),
+        'DISCHTIME': format_times(dischtime),
+        'DEATHTIME': format_times(deathtime),
+        'ADMISSION_TYPE': admission_type,
+        'ADMISSION_LOCATION': draw(rng, ADMISSION_LOCATIONS, n_admissions),
+        'DISCHARGE_LOCATION': discharge_location,
+        'INSURANCE': draw(rng, INSURANCES, n_admissions),
+        'LANGUAGE': draw(rng, LANGUAGES, n_admissions,
+                         NULL_RATES['language']),
+        'RELIGION': draw(rng, RELIGIONS, n_admissions,
+                         NULL_RATES['religion']),
+        'MARITAL_STATUS': draw(rng, MARITAL_STATUSES, n_admissions,
+                               NULL_RATES['marital_status']),
+        'ETHNICITY': draw(rng, ETHNICITIES, n_admissions),
+        'HOSPITAL_EXPIRE_FLAG': died.astype(int),
+    })
+
+    dod = np.full(n_patients, np.datetime64('NaT'), dtype='datetime64[s]')
+    dod[subjects[died]] = deathtime[died]
+    pat = pd.DataFrame({
+        'ROW_ID': first_ids['patients'] + np.arange(n_patients),
+        'SUBJECT_ID': first_ids['subject_id'] + np.arange(n_patients),
+        'GENDER': draw(rng, {'M': .56, 'F': .44}, n_patients),
+        'DOB': format_times(dob),
+        'DOD': format_times(dod),
+        'EXPIRE_FLAG': (~np.isnat(dod)).astype(int),
+    })
+
+    # Diagnoses: newborns are coded with a V30 live birth code first
+    n_diag = 1 + rng.poisson(diagnoses_per_admission - 1,
+                             n_admissions).clip(0, 38)
+    admission = np.repeat(np.arange(n_admissions), n_diag)
+    seq_num = np.arange(len(admission)) - np.repeat(np.cumsum(n_diag) - n_diag,
+                                                    n_diag) + 1
+    icd9_code = rng.choice(codes, size=len(admission), p=code_p)
+    birth = newborn[admission] & (seq_num == 1)
+    icd9_code[birth] = draw(rng, NEWBORN_DIAGNOSES, birth.sum())
+    icd9_code[rng.random(len(admission)) < NULL_RATES['icd9_code']] = None
+
+    diag = pd.DataFrame({
+        'ROW_ID': first_ids['diagnoses'] + np.arange(len(admission)),
+        'SUBJECT_ID': subject_id[admission],
+        'HADM_ID': hadm_id[admission],
+        'SEQ_NUM': seq_num,
+        'ICD9_CODE': icd9_code,
+    })
+
+    # Services: each transfer starts a new service during the stay
+    n_serv = 1 + rng.poisson(SERVICES_PER_ADMISSION - 1, n_admissions)
+    admission = np.repeat(np.arange(n_admissions), n_serv)
+    curr_service = draw(rng, SERVICES, len(admission))
+    births = newborn[admission]
+    curr_service[births] = draw(rng, NEWBORN_SERVICES, births.sum())
+    first = np.append(True, admission[1:] != admission[:-1])
+    prev_service = np.append(None, curr_service[:-1]).astype(object)
+    prev_service[first] = None
+    transfer = admittime[admission] + \
+        (rng.random(len(admission)) * stay[admission] * 86400 * ~first) \
+        .astype('timedelta64[s]')
+
+    serv = pd.DataFrame({
+        'ROW_ID': first_ids['services'] + np.arange(len(admission)),
+        'SUBJECT_ID': subject_id[admission],
+        'HADM_ID': hadm_id[admission],
+        'TRANSFERTIME': format_times(transfer),
+        'PREV_SERVICE': prev_service,
+        'CURR_SERVICE': curr_service,
+    })
+
+    # ICU stays: newborns go to the NICU
+    n_icu = rng.choice(list(ICU_STAYS), size=n_admissions,
+                       p=list(ICU_STAYS.values()))
+    admission = np.repeat(np.arange(n_admissions), n_icu)
+    careunit = draw(rng, CAREUNITS, len(admission))
+    careunit[newborn[admission]] = 'NICU'
+    intime = admittime[admission] + \
+        (rng.random(len(admission)) * 86400).astype('timedelta64[s]')
+    icu_los = rng.lognormal(.8, .9, len(admission))
+    outtime = intime + (icu_los * 86400).astype('timedelta64[s]')
+
+    icu = pd.DataFrame({
+        'ROW_ID': first_ids['icustays'] + np.arange(len(admission)),
+        'SUBJECT_ID': subject_id[admission],
+        'HADM_ID': hadm_id[admission],
+        'ICUSTAY_ID': first_ids['icustay_id'] + np.arange(len(admission)),
+        'DBSOURCE': draw(rng, {'carevue': .55, 'metavision': .45},
+                         len(admission)),
+        'FIRST_CAREUNIT': careunit,
+        'LAST_CAREUNIT': careunit,
+        'INTIME': format_times(intime),
+        'OUTTIME': format_times(outtime),
+        'LOS': icu_los.round(4),
+    })
+
+    return [adm, pat, diag, serv, icu]
+
+def generate(directory=SYNTHETIC_DIR, n_diagnoses=N_DIAGNOSES, seed=SEED):
+    """Writes the five synthetic source csv files to the directory, named as
+    ic.SOURCE_FILES, with about n_diagnoses diagnoses rows. Returns the
+    number of rows written to each file.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    paths = [f'{directory}/{file}.csv' for file in ic.SOURCE_FILES]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+    rng = np.random.default_rng(seed)
+    codes, code_p = icd9_codes(rng)
+
+    n_admissions = max(1, round(n_diagnoses / DIAGNOSES_PER_ADMISSION))
+    first_ids = {'subject_id': FIRST_SUBJECT_ID, 'hadm_id': FIRST_HADM_ID,
+                 'icustay_id': FIRST_ICUSTAY_ID, 'admissions': 1,
+                 'patients': 1, 'diagnoses': 1, 'services': 1, 'icustays': 1}
+    counts = dict.fromkeys(ic.SOURCE_FILES, 0)
+
+    for block, start in enumerate(range(0, n_admissions, BLOCK_ADMISSIONS)):
+        block_rng = np.random.default_rng([seed, block])
+        tables = generate_block(block_rng,
+                                min(BLOCK_ADMISSIONS, n_admissions - start),
+                                first_ids, codes, code_p,
+                                n_diagnoses / n_admissions)
+
+        for file, path, table in zip(ic.SOURCE_FILES, paths, tables):
+            table.to_csv(path, mode='a', header=block == 0, index=False)
+            counts[file] += len(table)
+
+        adm, pat, diag, serv, icu = tables
+        first_ids['subject_id'] = pat.SUBJECT_ID.iloc[-1] + 1
+        first_ids['hadm_id'] = adm.HADM_ID.iloc[-1] + 1
+        for name, table in zip(['admissions', 'patients', 'diagnoses',
+                                'services', 'icustays'], tables):
+            first_ids[name] += len(table)
+        first_ids['icustay_id'] += len(icu)
+
+    return counts
+
+def main(directory=SYNTHETIC_DIR, n_diagnoses=N_DIAGNOSES):
+    """Writes MIMIC-III sized synthetic source files and prints the row
+    counts.
+    """
+
+    for file, count in generate(directory, n_diagnoses).items():
+        print(f'{file:>20}: {count:,} rows')
+
+if __name__ == '__main__':
+    main()
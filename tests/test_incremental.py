@@ -0,0 +1,79 @@
+"""
+Runs the incremental stages over synthetic sources that arrive in two
+batches and compares them with one full run.
+"""
+
+import os
+import shutil
+
+import pandas as pd
+
+import importing_and_cleaning_data as ic
+import incremental
+import storage
+import synthetic_data
+
+N_DIAGNOSES = 20_000
+
+def write_first_batch(full_dir, batch_dir, hadm_ids):
+    """Writes the source rows of the given admissions, and every patient,
+    to batch_dir as the first batch.
+    """
+
+    os.makedirs(batch_dir)
+    for file in ic.SOURCE_FILES:
+        table = pd.read_csv(f'{full_dir}/{file}.csv', dtype=str)
+        if 'HADM_ID' in table:
+            table = table[table.HADM_ID.astype(int).isin(hadm_ids)]
+        table.to_csv(f'{batch_dir}/{file}.csv', index=False)
+
+def stage_rows(name):
+    """Returns a stored stage output sorted by admission, with categorical
+    columns as strings so the category order does not matter.
+    """
+
+    data = storage.load_stage(name)
+    data = data.astype({col: str for col in
+                        data.select_dtypes(include=['category']).columns})
+    return data.sort_values(list(data.columns)).reset_index(drop=True)
+
+def test_two_batches_match_one_full_run(tmp_path, monkeypatch):
+    full_dir = str(tmp_path / 'sources')
+    synthetic_data.generate(full_dir, N_DIAGNOSES)
+
+    # The first batch holds the admissions before a cutoff, so returning
+    # patients have later admissions that only arrive in the second
+    admissions = ic.importing(['admissions_data'], directory=full_dir)[0]
+    early = admissions.admittime < admissions.admittime.quantile(.7)
+    returning = set(admissions.subject_id[early]) & \
+        set(admissions.subject_id[~early])
+    assert returning
+
+    os.makedirs(tmp_path / 'full')
+    monkeypatch.chdir(tmp_path / 'full')
+    shutil.copytree(full_dir, ic.SOURCE_DIR)
+    assert incremental.run() == admissions.subject_id.nunique()
+    expected = {name: stage_rows(name) for name in
+                ['raw_hospital_data', 'feature_engineering_data']}
+
+    os.makedirs(tmp_path / 'batches')
+    monkeypatch.chdir(tmp_path / 'batches')
+    write_first_batch(full_dir, ic.SOURCE_DIR, admissions.hadm_id[early])
+    incremental.run()
+
+    shutil.rmtree(ic.SOURCE_DIR)
+    shutil.copytree(full_dir, ic.SOURCE_DIR)
+    assert incremental.run() == admissions.subject_id[~early].nunique()
+
+    for name, rows in expected.items():
+        pd.testing.assert_frame_equal(stage_rows(name), rows)
+
+    # Unchanged sources match the manifest fingerprints and rerun nothing
+    manifest = incremental.load_manifest()
+    assert manifest['sources'] == {
+        file: incremental.file_fingerprint(f'{ic.SOURCE_DIR}/{file}.csv')
+        for file in ic.SOURCE_FILES}
+    modified = os.path.getmtime(storage.stage_path('raw_hospital_data'))
+    assert incremental.run() == 0
+    assert os.path.getmtime(storage.stage_path('raw_hospital_data')) == \
+        modified
@@ -0,0 +1,59 @@
+"""
+Checks that LOS cubes combine across partitions and that the sketch
+quantiles stay close to the exact ones.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import feature_engineering as fe
+import importing_and_cleaning_data as ic
+import los_cube
+import sample_data
+
+# Consecutive sketch edges differ by this factor, so a quantile read from the
+# bin holding the exact quantile is within BIN_RATIO - 1 (about 5.2%) of it,
+# about 0.25 days for a 5 day median
+BIN_RATIO = los_cube.SKETCH_EDGES[1] / los_cube.SKETCH_EDGES[0]
+
+@pytest.fixture(scope='module')
+def data():
+    """Returns feature engineered sampled admissions."""
+
+    tables = sample_data.sample_source_tables(3000)
+    return fe.feature_engineering(ic.data_cleaning(ic.merging_data(tables)))
+
+def test_combined_halves_match_the_whole_cube(data):
+    first = data.hadm_id <= data.hadm_id.median()
+    whole = los_cube.build_cube(data)
+    combined = los_cube.combine([los_cube.build_cube(data[first]),
+                                 los_cube.build_cube(data[~first])])
+
+    assert combined['n_admissions'] == whole['n_admissions']
+    assert combined['cells'].keys() == whole['cells'].keys()
+    for key, cells in whole['cells'].items():
+        pd.testing.assert_frame_equal(combined['cells'][key].sort_index(),
+                                      cells.sort_index(), check_names=False)
+
+def test_sketch_medians_are_within_a_bin_of_the_exact_medians(data):
+    cube = los_cube.build_cube(data)
+
+    for key, cells in cube['cells'].items():
+        columns = list(key)
+        rows = data[['hadm_id', *columns, 'los']] \
+            .drop_duplicates(['hadm_id', *columns])
+        rows = rows.astype({col: str for col in columns})
+
+        # The exact median is the LOS of the first admission at or past half
+        # of the cell, as the sketch counts admissions
+        exact = rows.groupby(columns).los \
+                    .agg(lambda los: np.quantile(los, .5,
+                                                 method='inverted_cdf')) \
+                    .reindex(cells.index).to_numpy()
+        sketch = los_cube.sketch_quantiles(cells, [.5]).q50.to_numpy()
+
+        # Stays under an hour share the first bin, bounded by the cell minimum
+        tolerance = np.where(exact < los_cube.SKETCH_EDGES[0],
+                             los_cube.SKETCH_EDGES[0], exact * (BIN_RATIO - 1))
+        assert np.all(np.abs(sketch - exact) <= tolerance + 1e-9), key
@@ -0,0 +1,80 @@
+"""
+Checks the OLS sufficient statistics against scikit-learn fits on the same
+design matrix.
+"""
+
+import numpy as np
+import pytest
+
+from scipy import sparse
+from sklearn.linear_model import LinearRegression
+from sklearn.metrics import mean_squared_error, r2_score
+
+import ols
+
+@pytest.fixture(scope='module')
+def design():
+    """Returns a sparse design matrix of numeric and one hot columns, with a
+    noisy linear target.
+    """
+
+    rng = np.random.default_rng(10)
+    n_rows = 2000
+    numeric = rng.normal(50, 15, size=(n_rows, 2))
+    dummies = (rng.random((n_rows, 6)) < .3).astype(float)
+    X = sparse.csr_matrix(np.hstack([numeric, dummies]))
+    y = X @ rng.normal(size=X.shape[1]) + 4 + rng.normal(size=n_rows)
+
+    return X, y
+
+def sklearn_fit(X, y):
+    """Returns scikit-learn's coefficients, intercept first, and model."""
+
+    model = LinearRegression().fit(X.toarray(), y)
+    return np.append(model.intercept_, model.coef_), model
+
+def assert_scores_match(statistics, coef, model, X, y):
+    """Asserts the statistics score coef as scikit-learn scores the model."""
+
+    predicted = model.predict(X.toarray())
+    assert np.allclose(statistics.sse(coef), np.sum((y - predicted) ** 2))
+
+    scores = statistics.score(coef)
+    assert np.isclose(scores['r2'], r2_score(y, predicted))
+    assert np.isclose(scores['rmse'],
+                      np.sqrt(mean_squared_error(y, predicted)))
+
+def test_solve_matches_sklearn(design):
+    X, y = design
+    statistics = ols.OLSStatistics.from_data(X, y)
+    expected, model = sklearn_fit(X, y)
+
+    coef = statistics.solve()
+    assert np.allclose(coef, expected)
+    assert_scores_match(statistics, coef, model, X, y)
+
+def test_chunks_add_to_the_full_statistics(design):
+    X, y = design
+    full = ols.OLSStatistics.from_data(X, y)
+    merged = ols.OLSStatistics.from_data(X[:700], y[:700]) + \
+        ols.OLSStatistics.from_data(X[700:], y[700:])
+
+    assert merged.n == full.n
+    assert np.allclose(merged.xtx, full.xtx)
+    assert np.allclose(merged.solve(), full.solve())
+    assert np.isclose(merged.sse(merged.solve()), full.sse(full.solve()))
+
+def test_subtracting_a_fold_matches_a_refit_without_it(design):
+    X, y = design
+    fold = np.arange(300, 500)
+    rest = np.setdiff1d(np.arange(X.shape[0]), fold)
+
+    total = ols.OLSStatistics.from_data(X, y)
+    fold_statistics = ols.OLSStatistics.from_data(X[fold], y[fold])
+    coef = (total - fold_statistics).solve()
+
+    expected, model = sklearn_fit(X[rest], y[rest])
+    assert np.allclose(coef, expected)
+    assert np.allclose(coef, ols.OLSStatistics.from_data(X[rest],
+                                                         y[rest]).solve())
+    assert_scores_match(fold_statistics, coef, model, X[fold], y[fold])
@@ -0,0 +1,59 @@
+"""
+Compares the out of core run with the in memory pipeline on synthetic
+sources.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import feature_engineering as fe
+import importing_and_cleaning_data as ic
+import models
+import ols
+import out_of_core
+import synthetic_data
+
+N_DIAGNOSES = 20_000
+
+@pytest.fixture(scope='module')
+def sources(tmp_path_factory):
+    """Returns a directory of synthetic sources and the OLS coefficients of
+    the in memory pipeline on them.
+    """
+
+    directory = str(tmp_path_factory.mktemp('sources'))
+    synthetic_data.generate(directory, N_DIAGNOSES)
+
+    tables = ic.importing(ic.SOURCE_FILES, directory=directory)
+    data = fe.feature_engineering(ic.data_cleaning(ic.merging_data(tables)))
+    statistics = ols.stream_statistics([data], models.fit_vocabulary(data))
+
+    return directory, statistics.solve()
+
+@pytest.mark.parametrize('n_partitions', [1, 7, 53])
+def test_matches_the_in_memory_coefficients(sources, n_partitions, tmp_path,
+                                            monkeypatch):
+    directory, expected = sources
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(out_of_core, 'plan_partitions',
+                        lambda memory_budget_mb, directory: (n_partitions,
+                                                             5000))
+
+    summary = out_of_core.run(directory=directory)
+    assert np.allclose(summary.coef.to_numpy(), expected, rtol=0, atol=4e-12)
+
+def test_budget_covers_the_whole_tables_and_admission_keys(sources):
+    directory, _ = sources
+    whole = os.path.getsize(f'{directory}/patient_data.csv') * \
+        out_of_core.WHOLE_BYTES_PER_SOURCE_BYTE
+    keys = os.path.getsize(f'{directory}/admissions_data.csv') * \
+        out_of_core.KEY_BYTES_PER_ADMISSION_BYTE
+
+    # A budget holding the whole tables and half the keys is too small
+    with pytest.raises(ValueError):
+        out_of_core.plan_partitions(
+            out_of_core.OVERHEAD_MB + (whole + keys / 2) / 2**20, directory)
+    assert out_of_core.plan_partitions(
+        out_of_core.OVERHEAD_MB + (whole + keys * 2) / 2**20, directory)[0] > 1
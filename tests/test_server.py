@@ -0,0 +1,146 @@
+"""
+Drives a local scoring server with the load generator and with malformed
+requests.
+"""
+
+import asyncio
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import feature_engineering as fe
+import importing_and_cleaning_data as ic
+import load_generator
+import models
+import sample_data
+import scoring
+import server
+
+@pytest.fixture(scope='module')
+def scored_records():
+    """Returns a scorer fit on sampled admissions and their raw records."""
+
+    tables = sample_data.sample_source_tables(2000)
+    data = fe.feature_engineering(ic.data_cleaning(ic.merging_data(tables)))
+    X, y, vocabulary, numeric_cols = models.encode(data)
+
+    design = np.hstack([np.ones((X.shape[0], 1)), X.toarray()])
+    coef = np.linalg.lstsq(design, y, rcond=None)[0]
+    model = SimpleNamespace(coef_=coef[1:], intercept_=coef[0])
+    scorer = scoring.LOSScorer(scoring.make_bundle(model, vocabulary,
+                                                   numeric_cols))
+
+    return scorer, sample_data.sample_records(tables)
+
+async def send(port, message):
+    """Sends raw request bytes and returns the status code and decoded
+    body of the response.
+    """
+
+    reader, writer = await asyncio.open_connection(server.HOST, port)
+    writer.write(message)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line == b'\r\n':
+            break
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':')[1])
+    response = json.loads(await reader.readexactly(length))
+
+    writer.close()
+    await writer.wait_closed()
+    return status, response
+
+async def request(port, method, path, body=b''):
+    """Sends one request and returns the status code and decoded body."""
+
+    return await send(port, f'{method} {path} HTTP/1.1\r\n'
+                            'Connection: close\r\n'
+                            f'Content-Length: {len(body)}\r\n\r\n'.encode()
+                      + body)
+
+def run_server(scorer, client, **options):
+    """Runs client(port) against a server on a free port and returns its
+    result along with the server.
+    """
+
+    async def run():
+        scoring_server = server.ScoringServer(scorer, **options)
+        listener = await scoring_server.start(port=0)
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            return await asyncio.wait_for(client(port), 30), scoring_server
+        finally:
+            listener.close()
+
+    return asyncio.run(run())
+
+def test_generate_load(scored_records):
+    scorer, records = scored_records
+
+    async def client(port):
+        load = await load_generator.generate_load(
+            records, port=port, concurrency=8, n_requests=200, batch_size=3)
+        return load, await request(port, 'POST', '/predict',
+                                   json.dumps(records[:5]).encode())
+
+    (load, (status, response)), scoring_server = run_server(scorer, client)
+
+    assert load['requests'] == 200
+    assert status == 200
+    assert np.allclose(response['los'], scorer.predict(records[:5]))
+
+    stats = scoring_server.stats.summary()
+    assert stats['requests'] == 201
+    assert stats['admissions'] == 605
+    assert 0 < stats['batches'] <= 201
+
+def test_bad_bodies_do_not_stop_the_server(scored_records):
+    scorer, records = scored_records
+    valid = json.dumps(records[0]).encode()
+
+    async def client(port):
+        return [await request(port, 'POST', '/predict', body)
+                for body in [valid, b'5', b'["a", "b"]', b'{', valid]]
+
+    responses, _ = run_server(scorer, client)
+    assert [status for status, _ in responses] == [200, 400, 400, 400, 200]
+    assert responses[0][1] == responses[-1][1]
+
+@pytest.mark.parametrize('message', [
+    b'GET/stats\r\n\r\n',
+    b'GET /stats HTTP/1.1\r\nConnection close\r\n\r\n',
+    b'POST /predict HTTP/1.1\r\nContent-Length: ten\r\n\r\n',
+], ids=['request_line', 'header', 'content_length'])
+def test_malformed_requests_get_a_400(scored_records, message):
+    scorer, _ = scored_records
+
+    async def client(port):
+        return await send(port, message), await request(port, 'GET', '/stats')
+
+    ((status, response), (stats_status, _)), _ = run_server(scorer, client)
+    assert status == 400
+    assert response['error'].startswith('Malformed request')
+    assert stats_status == 200
+
+def test_bad_record_fails_only_its_request(scored_records):
+    scorer, records = scored_records
+    bad = dict(records[0], admittime=None)
+
+    async def client(port):
+        return await asyncio.gather(
+            request(port, 'POST', '/predict', json.dumps(records[:2]).encode()),
+            request(port, 'POST', '/predict', json.dumps(bad).encode()),
+            request(port, 'POST', '/predict', json.dumps(records[2]).encode()))
+
+    responses, scoring_server = run_server(scorer, client, max_batch_wait=.2)
+    assert [status for status, _ in responses] == [200, 400, 200]
+    assert np.allclose(responses[0][1]['los'], scorer.predict(records[:2]))
+    assert np.allclose(responses[2][1]['los'], scorer.predict(records[2:3]))
+    assert scoring_server.stats.summary()['requests'] == 2
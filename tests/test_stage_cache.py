@@ -0,0 +1,136 @@
+"""
+Checks when cached stages hit and miss, how the cache evicts entries and
+that it tolerates entries removed by another process.
+"""
+
+import importlib
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+import instrumentation
+import stage_cache
+
+STAGE_SOURCE = '''
+import instrumentation
+import stage_cache
+
+SCALE = 2
+CALLS = []
+
+def helper(values):
+    return values * {factor}
+
+@stage_cache.cached(helper, config=lambda: SCALE)
+def stage(data):
+    CALLS.append(len(data))
+    kept = data[data.a > 0]
+    instrumentation.record_filter('positive', len(data), len(kept))
+    return kept.assign(b=helper(kept.a) + SCALE)
+'''
+
+def write_stage(directory, factor):
+    """Writes the stage module with the helper multiplying by factor."""
+
+    with open(os.path.join(directory, 'cached_stage.py'), 'w') as file:
+        file.write(STAGE_SOURCE.format(factor=factor))
+
+@pytest.fixture
+def module(tmp_path, monkeypatch):
+    """Returns a freshly imported stage module, cached in tmp_path."""
+
+    write_stage(tmp_path, 3)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+    monkeypatch.setitem(stage_cache._settings, 'directory',
+                        str(tmp_path / 'cache'))
+    monkeypatch.setitem(stage_cache._settings, 'max_bytes',
+                        stage_cache.MAX_CACHE_BYTES)
+    sys.modules.pop('cached_stage', None)
+
+    yield importlib.import_module('cached_stage')
+    sys.modules.pop('cached_stage', None)
+
+def frame(values=(-1, 1, 2, 3)):
+    """Returns a stage input with the given values of column a."""
+
+    return pd.DataFrame({'a': list(values)})
+
+def test_hit_returns_the_result_and_filter_counts(module):
+    with instrumentation.collected_filters() as missed:
+        expected = module.stage(frame())
+    with instrumentation.collected_filters() as hit:
+        result = module.stage(frame())
+
+    assert module.CALLS == [4]
+    pd.testing.assert_frame_equal(result, expected)
+    assert missed == hit == {'positive': 1}
+
+def test_helper_source_change_misses(module, tmp_path):
+    module.stage(frame())
+    module.stage(frame())
+    assert len(module.CALLS) == 1
+
+    write_stage(tmp_path, 4)
+    module = importlib.reload(module)
+    assert module.stage(frame()).b.tolist() == [6, 10, 14]
+    assert module.CALLS == [4]
+
+def test_config_change_misses(module):
+    module.stage(frame())
+    module.SCALE = 5
+    assert module.stage(frame()).b.tolist() == [8, 11, 14]
+    assert len(module.CALLS) == 2
+
+def test_input_change_misses(module):
+    module.stage(frame())
+    module.stage(frame())
+    assert module.stage(frame((-1, 1, 2, 4))).b.tolist() == [5, 8, 14]
+    assert len(module.CALLS) == 2
+
+def test_evicts_least_recently_used_first(module, tmp_path):
+    directory = str(tmp_path / 'cache')
+    for i, values in enumerate([(1,), (2,), (3,)]):
+        module.stage(frame(values))
+        path = max(stage_cache._entries(directory))[2]
+        os.utime(path, (1000 + i, 1000 + i))
+
+    # A hit refreshes the oldest entry, leaving (2,) least recently used
+    module.stage(frame((1,)))
+    assert len(module.CALLS) == 3
+
+    size = max(size for _, size, _ in stage_cache._entries(directory))
+    assert stage_cache.evict(directory, max_bytes=2 * size) == 1
+
+    module.stage(frame((1,)))
+    module.stage(frame((3,)))
+    assert len(module.CALLS) == 3
+    module.stage(frame((2,)))
+    assert len(module.CALLS) == 4
+
+def test_tolerates_entries_removed_by_another_process(module, tmp_path,
+                                                      monkeypatch):
+    directory = str(tmp_path / 'cache')
+    module.stage(frame((1,)))
+    module.stage(frame((2,)))
+    paths = sorted(path for _, _, path in stage_cache._entries(directory))
+
+    # Another process removes an entry after it is listed
+    scandir = os.scandir
+
+    def listing_then_removal(path):
+        entries = list(scandir(path))
+        os.remove(paths[0])
+        return iter(entries)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(stage_cache.os, 'scandir', listing_then_removal)
+        assert [path for _, _, path in stage_cache._entries(directory)] == \
+            paths[1:]
+
+    assert not stage_cache._remove(paths[0])
+    assert stage_cache._remove(paths[1])
+    assert stage_cache._entries(str(tmp_path / 'missing')) == []
+    assert stage_cache.evict(directory, max_bytes=0) == 0